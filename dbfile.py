@@ -2,7 +2,7 @@
 
 
 from os.path import basename, abspath, dirname
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from abc import ABC, abstractmethod
 import datetime
 import time
@@ -15,15 +15,28 @@ import json
 import sqlite3
 import socket
 import re
+import itertools
+import contextlib
+import asyncio
+import weakref
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import pymysql
+import pymysql.cursors
+from pymysql.constants import FIELD_TYPE, ER, SERVER_STATUS
 import configparser
 
 try:
     import boto3
-    from botocore.exceptions import ClientError
+    from botocore.exceptions import BotoCoreError, ClientError
 except ImportError:
     pass
 
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
 
 """
 This is the dbfile.py (database file)
@@ -54,14 +67,20 @@ The following classes are provided:
 
   DBSQL() - An abstract SQLDatbase class. Largely wraps the Python API.
   DBSqlite3(DBQSL) - DBSQL for SQLite3. The __init__ method lets one specify the file.
+  DBPool() - A bounded, thread-safe pool of database connections with idle timeout, maximum
+             lifetime, and liveness checks after idle periods.
   DBMySQLAuth() - An authentication object for MySQL. Allows host, database, user, password to
-                  be passed as a single parameter. Also holds a debug flag and a cached
-                  database connection that uses these authentication parameters.
+                  be passed as a single parameter. Also holds a debug flag, the DBPool of
+                  database connections that use these authentication parameters, and optional
+                  read replicas to which csfr() routes SELECT, SHOW and DESCRIBE.
 
   DBMySQL(DBSQL) - DBSQL for MySQL. Includes logic for retrying, and a class method
                    that makes INSERT and SELECT an automic operation with automatic retry.
                  - *many* functions in this should probably be migrated to DBSQL().
 
+  DBMySQLAsync() - asyncio counterpart of DBMySQL.csfr(), using aiomysql (optional) with a bounded
+                   connection pool per event loop.
+
 The main DBMySQL class method that we use is:
 
   DBMySQL.csfr(auth, cmd, vals, quiet, rowcount, time_zone, get_column_names, asDicts, debug)
@@ -71,6 +90,31 @@ The main DBMySQL class method that we use is:
 cmd - Statements should use "%s" for substituted arguments; this is turned to ? for SQLite3
     - Use INSERT IGNORE; this is turned to "INSERT OR IGNORE" for MySQL
 
+For large SELECTs, DBMySQL.csfr_stream() and DBSqlite3.csfr_stream() are generators that stream rows
+(or batches of rows) from the server without materializing the whole result.
+
+For analytics, csfr_columns() returns a SELECT as a dictionary of typed NumPy arrays, and to_frame() as a
+pandas DataFrame, converting the rows in batches instead of building a dictionary per row.
+
+If the DBMySQLAuth has read replicas, csfr() sends SELECT, SHOW and DESCRIBE to the replica with the fewest
+outstanding requests and everything else to the primary. Transactions, reads of session state such as
+LAST_INSERT_ID() or @variables, and calls with primary=True use the primary. DBMySQL.csfr_many(auth, queries)
+runs independent queries concurrently and returns their results in order.
+
+Every statement can be observed by callbacks registered with query_hooks; install_default_hooks() adds a
+SlowQueryLog and a per-fingerprint LatencyHistogram.
+
+csfr() keeps each distinct SQL text in a StatementCache, so parsing the statement is done once, and records
+per-statement call counts, latencies and rows. statement_report() returns them, and
+statement_cache.print_report() prints them.
+
+csfr(..., cache=True) serves identical SELECTs from a ResultCache for RESULT_CACHE_TTL seconds; writes made
+through the same auth invalidate the cached results of the tables they touch. cache defaults to False: it used to
+default to True but did nothing, and turning caching on for existing callers would serve them stale results.
+
+For loading many rows, DBMySQL.bulk_insert(auth, table, rows) and DBSqlite3.bulk_insert(None, table, rows)
+insert in batches with executemany() inside explicit transactions and report rows/sec.
+
 When running as a server, credentials can be managed by storing them in a bash script.
 
 For example, let's say you have a WSGI script that needs to know read-only MySQL credentails for a web application. You create a MySQL username called "dbreader" with the password "magic-password-1234" on your MySQL server at mysql.company.com. You give this user SELECT access to the database "database1". You might then create a script called 'dbreader.bash' and put it at /home/www/dbreader.bash:
@@ -116,7 +160,10 @@ MYSQL_USER = 'MYSQL_USER'
 MYSQL_PASSWORD = 'MYSQL_PASSWORD'
 MYSQL_DATABASE = 'MYSQL_DATABASE'
 MYSQL_PORT  = 'MYSQL_PORT'
+MYSQL_REPLICAS = 'MYSQL_REPLICAS'   # comma-separated read replica hosts, same credentials as MYSQL_HOST
 MYSQL_DEFAULT_PORT = 3306
+SECRET_TTL = 3600           # seconds a secret from AWS Secrets Manager is used before it is fetched again
+SECRET_REFRESH_BEFORE = 300 # seconds before expiry at which a background thread refreshes a secret
 # Errors we do not retry. This used to be a long list, but it got shortened?
 ERRORS_NO_RETRY = []
 
@@ -125,14 +172,39 @@ HOST = 'HOST'
 USER = 'USER'
 PASSWORD = 'PASSWORD'
 DATABASE = 'DATABASE'
+REPLICAS = 'REPLICAS'
 
 AWS_SECRET_NAME = 'AWS_SECRET_NAME'
 AWS_REGION_NAME = 'AWS_REGION_NAME'
 SECRETSMANAGER = 'secretsmanager'
 DEFAULT_PORT = 3306
 CACHE_SIZE = 2000000
+POOL_SIZE = 10               # connections per DBPool (per process)
+POOL_TIMEOUT = 30            # seconds checkout() waits for a connection when all are in use
+POOL_IDLE_TIMEOUT = 300      # close connections idle longer than this
+POOL_MAX_LIFETIME = 3600     # close connections older than this when they are checked in
+POOL_PING_AFTER = 30         # check connections idle longer than this with is_alive() before reuse
+REPLICA_RETRY_AFTER = 30     # seconds route() skips a replica that could not be reached
+STATEMENT_CACHE_SIZE = 1000  # distinct SQL statements remembered by the StatementCache
+STATEMENT_TIMES = 1000       # most recent latencies kept per statement, for percentiles
+SLOW_QUERY_SECONDS = 1.0     # threshold of the SlowQueryLog
+RESULT_CACHE_TTL = 5         # seconds a cached SELECT result is served by csfr(..., cache=True)
+RESULT_CACHE_BYTES = 64 * 1024 * 1024      # approximate memory cap of the ResultCache
+INGEST_MMAP_BYTES = 1024 * 1024 * 1024     # SQLite mmap_size during DBSqlite3.ingest()
+INGEST_CACHE_BYTES = 256 * 1024 * 1024     # SQLite page cache during DBSqlite3.ingest()
+INGEST_COMMIT_ROWS = 10000   # csfr() writes per commit during DBSqlite3.ingest()
+COLUMN_BATCH_SIZE = 10000    # rows converted to NumPy arrays at a time by csfr_columns()
+BULK_BATCH_SIZE = 1000       # rows per executemany() call and transaction in bulk_insert()
 SQL_SET_CACHE = "PRAGMA cache_size = {};".format(CACHE_SIZE)
 
+# NumPy dtypes for MySQL column type codes in cursor.description; other types become object arrays.
+# Integer columns that contain NULLs become float64 with NaN.
+MYSQL_NUMPY_DTYPES = {**{t: 'int64' for t in [FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.LONG, FIELD_TYPE.INT24,
+                                             FIELD_TYPE.LONGLONG, FIELD_TYPE.YEAR]},
+                      **{t: 'float64' for t in [FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE, FIELD_TYPE.DECIMAL,
+                                               FIELD_TYPE.NEWDECIMAL]},
+                      **{t: 'datetime64[us]' for t in [FIELD_TYPE.DATE, FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP]}}
+
 sys.path.append(dirname(dirname(abspath(__file__))))
 
 # 2022-02-06 update to be pure pymysql
@@ -141,20 +213,84 @@ class SecretsManagerError(Exception):
     """ SecretsManagerError """
 
 
-def get_aws_secret_for_section(section):
-    if (AWS_SECRET_NAME in section) and (AWS_REGION_NAME) in section:
-        secret_name = os.path.expandvars(section[AWS_SECRET_NAME])
-        region_name = os.path.expandvars(section[AWS_REGION_NAME])
-        logging.debug("secret_name=%s region_name=%s",secret_name, region_name)
-        session = boto3.session.Session()
-        client = session.client( service_name=SECRETSMANAGER,
-                                 region_name=region_name)
+class SecretCache:
+    """A process-wide cache of AWS Secrets Manager secrets, with one client per region.
+    A secret is fetched on first use and reused for ttl seconds. When it is used within refresh_before
+    seconds of expiring, a background thread fetches it again, so callers do not wait for Secrets Manager.
+    get(..., refresh=True) fetches immediately, for example after the database rejects a rotated password.
+    """
+
+    def __init__(self, ttl=SECRET_TTL, refresh_before=SECRET_REFRESH_BEFORE):
+        self.ttl = ttl
+        self.refresh_before = refresh_before
+        self.lock = threading.Lock()
+        self.secrets = {}       # (secret_name, region_name) -> (secret, fetched)
+        self.refreshing = set()
+        self.clients = {}
+        self.fetches = 0
+
+    def client(self, region_name):
+        with self.lock:
+            if region_name not in self.clients:
+                self.clients[region_name] = boto3.session.Session().client(service_name=SECRETSMANAGER,
+                                                                           region_name=region_name)
+            return self.clients[region_name]
+
+    def fetch(self, secret_name, region_name):
+        """Fetch the secret from Secrets Manager and cache it"""
+        logging.debug("secret_name=%s region_name=%s", secret_name, region_name)
         try:
-            get_secret_value_response = client.get_secret_value( SecretId=secret_name )
+            get_secret_value_response = self.client(region_name).get_secret_value(SecretId=secret_name)
         except ClientError as e:
             raise SecretsManagerError(e)
         secret = json.loads(get_secret_value_response['SecretString'])
+        with self.lock:
+            self.secrets[(secret_name, region_name)] = (secret, time.time())
+            self.fetches += 1
         return secret
+
+    def _background_fetch(self, key):
+        try:
+            self.fetch(*key)
+        except (SecretsManagerError, BotoCoreError, ValueError) as e:
+            logging.warning("background refresh of secret %s failed: %s", key[0], e)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def get(self, secret_name, region_name, refresh=False):
+        key = (secret_name, region_name)
+        with self.lock:
+            entry = self.secrets.get(key)
+        age = time.time() - entry[1] if entry else None
+        if refresh or entry is None or age > self.ttl:
+            return self.fetch(secret_name, region_name)
+        if age > self.ttl - self.refresh_before:
+            with self.lock:
+                start = key not in self.refreshing
+                self.refreshing.add(key)
+            if start:
+                threading.Thread(target=self._background_fetch, args=(key,), daemon=True).start()
+        return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.secrets.clear()
+
+
+secret_cache = SecretCache()
+
+
+def aws_secret_for_section(section):
+    """Return (secret_name, region_name) if the section names an AWS secret, otherwise None"""
+    if (AWS_SECRET_NAME in section) and (AWS_REGION_NAME) in section:
+        return (os.path.expandvars(section[AWS_SECRET_NAME]), os.path.expandvars(section[AWS_REGION_NAME]))
+    return None
+
+
+def get_aws_secret_for_section(section, refresh=False):
+    if (names := aws_secret_for_section(section)) is not None:
+        return secret_cache.get(*names, refresh=refresh)
     return None
 
 
@@ -169,9 +305,12 @@ def hostname():
 
 
 class DBSQL(ABC):
+    serials = itertools.count()
+
     def __init__(self, dicts=True, time_zone=None, debug=False):
         self.dicts = dicts
         self.debug = debug
+        self.serial = next(DBSQL.serials)     # identifies this connection in ResultCache keys
 
     def __enter__(self):
         return self
@@ -184,17 +323,29 @@ class DBSQL(ABC):
         if self.debug or debug:
             print(f"execute: {cmd}", file=sys.stderr)
             t0 = time.time()
+        event = None
+        if query_hooks.enabled():
+            event = query_hooks.start(cmd, args[0] if args else kwargs.get('args', ()),
+                                      connection_id=self.connection_id())
         try:
             res = self.conn.cursor().execute(cmd, *args, **kwargs)
         except (sqlite3.Error, pymysql.MySQLError) as e:
+            query_hooks.finish(event, error=e)
             print(cmd, *args, file=sys.stderr)
             print(e, file=sys.stderr)
             exit(1)
+        query_hooks.finish(event, rowcount=getattr(res, 'rowcount', res))
+        if cmd.strip() and cmd.split(None, 1)[0].upper() in WRITE_VERBS:
+            result_cache.invalidate(self, statement_tables(cmd))
         if self.debug or debug:
             t1 = time.time()
             print(f"time: {t1-t0}", file=sys.stderr)
         return res
 
+    def connection_id(self):
+        """Identifies the connection in a QueryEvent"""
+        return id(self.conn)
+
     def cursor(self, *args, **kwargs):
         self.conn.ping()        # may need to reconnect
         return self.conn.cursor(*args, **kwargs)
@@ -217,6 +368,114 @@ class DBSQL(ABC):
                     print("Error:", e, file=sys.stderr)
                     exit(1)
 
+    def reusable(self):
+        """Return True if the connection can be given to another caller by DBPool.checkin()"""
+        return True
+
+    def is_alive(self):
+        """Return True if the connection still works"""
+        try:
+            self.conn.cursor().execute("SELECT 1")
+            return True
+        except (sqlite3.Error, pymysql.MySQLError, OSError):
+            return False
+
+    @staticmethod
+    def insert_statement(table, columns, ignore=False):
+        """Return an INSERT statement for one row of columns, with %s parameters"""
+        return "INSERT {}INTO {} ({}) VALUES ({})".format("IGNORE " if ignore else "", table,
+                                                         ",".join(columns), ",".join(["%s"] * len(columns)))
+
+    @staticmethod
+    def row_batches(rows, columns, batch_size):
+        """Return (columns, generator) where the generator yields lists of at most batch_size tuples.
+        rows may be sequences (in the order of columns) or dictionaries; if columns is None it is taken
+        from the keys of the first dictionary."""
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return (columns, iter([]))
+        if columns is None:
+            if not isinstance(first, dict):
+                raise ValueError("columns must be provided when rows are not dictionaries")
+            columns = list(first.keys())
+        rows = itertools.chain([first], rows)
+        if isinstance(first, dict):
+            rows = (tuple(row[col] for col in columns) for row in rows)
+
+        def batches():
+            while batch := list(itertools.islice(rows, batch_size)):
+                yield batch
+        return (columns, batches())
+
+    @staticmethod
+    def numpy_dtype(type_code, values):
+        """Return the NumPy dtype for a column, from its cursor.description type_code if known (MySQL),
+        otherwise from the Python types of its non-NULL values (SQLite), or None if they are all NULL."""
+        if type_code is not None:
+            return MYSQL_NUMPY_DTYPES.get(type_code, 'object')
+        types = {type(v) for v in values if v is not None}
+        if not types:
+            return None
+        if types <= {int, bool}:
+            return 'int64'
+        if types <= {int, bool, float}:
+            return 'float64'
+        return 'object'
+
+    @staticmethod
+    def columns_from_batches(batches, description):
+        """Convert an iterator of row batches into a dictionary of NumPy arrays, one per column.
+        description is filled in (as by csfr_stream(get_description=)) before the first batch is returned.
+        Each batch is transposed and converted on its own, so no per-row objects outlive the batch.
+        The dtype of each batch is chosen separately and the batches are then combined into a dtype that holds
+        them all, so an integer column becomes float64 if any batch has a NULL or a REAL value."""
+        import numpy
+        chunks = None       # per column, a list of arrays and of the lengths of batches that were all NULL
+        for batch in batches:
+            if chunks is None:
+                chunks = [[] for d in description]
+            for (i, col) in enumerate(zip(*batch)):
+                dtype = DBSQL.numpy_dtype(description[i][1], col)
+                if dtype is None:
+                    chunks[i].append(len(col))
+                    continue
+                if dtype == 'int64' and None in col:
+                    dtype = 'float64'
+                chunks[i].append(numpy.array(col, dtype=dtype))
+        columns = {}
+        for (d, chunk) in zip(description, chunks or [[] for d in description]):
+            arrays = [c for c in chunk if not isinstance(c, int)]
+            dtype = numpy.result_type(*arrays) if arrays else numpy.dtype(DBSQL.numpy_dtype(d[1], ()) or 'object')
+            if dtype.kind == 'i' and len(arrays) < len(chunk):
+                dtype = numpy.dtype('float64')
+            parts = [numpy.array([None] * c, dtype=dtype) if isinstance(c, int) else c.astype(dtype, copy=False)
+                     for c in chunk]
+            columns[d[0]] = (parts[0] if len(parts) == 1 else
+                             numpy.concatenate(parts) if parts else numpy.array([], dtype=dtype))
+        return columns
+
+    @staticmethod
+    def stream_rows(c, names, batch_size):
+        """Yield the rows of cursor c as tuples or, if names is given, as dictionaries.
+        If batch_size is given, yield lists of up to batch_size rows."""
+        while rows := c.fetchmany(batch_size or BULK_BATCH_SIZE):
+            if names is not None:
+                rows = [dict(zip(names, row)) for row in rows]
+            if batch_size:
+                yield rows
+            else:
+                yield from rows
+
+    @staticmethod
+    def bulk_insert_report(table, count, t0):
+        """Log and return the statistics of a bulk_insert()"""
+        seconds = time.time() - t0
+        ret = {'rows': count, 'seconds': seconds, 'rows_per_sec': count / seconds if seconds > 0 else 0}
+        logging.info("bulk_insert %s: %d rows in %.3f seconds (%.0f rows/sec)",
+                     table, count, seconds, ret['rows_per_sec'])
+        return ret
+
     def execselect(self, sql, vals=()):
         """Execute a SQL query and return the first line"""
         self.conn.ping()
@@ -231,6 +490,8 @@ class DBSQL(ABC):
 class DBSqlite3(DBSQL):
     def __init__(self, time_zone=None, fname=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.commit_every = None    # set by ingest()
+        self.uncommitted = 0
         try:
             self.conn = sqlite3.connect(fname)
             if self.dicts:
@@ -242,64 +503,740 @@ class DBSqlite3(DBSQL):
 
     def set_cache_bytes(self, b):
         # negative numbers are multiples of 1024
-        self.execute(f"PRAGMA cache_size = {-b/1024}")
+        self.execute(f"PRAGMA cache_size = {-(b // 1024)}")
+
+    def pragma(self, name, value=None):
+        """Set PRAGMA name to value, if value is given. Returns the current value."""
+        if value is not None:
+            self.conn.execute(f"PRAGMA {name} = {value}")
+        return self.conn.execute(f"PRAGMA {name}").fetchone()[0]
+
+    @contextlib.contextmanager
+    def ingest(self, *, synchronous='OFF', commit_every=INGEST_COMMIT_ROWS, mmap_bytes=INGEST_MMAP_BYTES,
+               cache_bytes=INGEST_CACHE_BYTES, defer_indexes=True):
+        """Context manager for loading large amounts of data. Inside the block the database uses WAL journaling,
+        PRAGMA synchronous=synchronous ('OFF' or 'NORMAL'), memory-mapped I/O and a large page cache, and
+        csfr() commits every commit_every writes (use bulk_insert() for batched executemany()).
+        If defer_indexes is True, the plain (non-UNIQUE) indexes that exist are dropped at the start and rebuilt
+        at the end, which is much faster than updating them row by row. UNIQUE indexes, and indexes behind
+        PRIMARY KEY or UNIQUE constraints, are kept so that constraints and INSERT OR IGNORE still work.
+        On exit the data is committed, the indexes are rebuilt and the previous settings are restored.
+        The settings are restored even if an index cannot be rebuilt.
+        With synchronous='OFF', a crash of the operating system during the load can corrupt the database.
+        """
+        self.conn.commit()
+        saved = {name: self.pragma(name) for name in ['journal_mode', 'synchronous', 'mmap_size', 'cache_size']}
+        indexes = []
+        if defer_indexes:
+            for (name, table, sql) in self.conn.execute(
+                    "SELECT name, tbl_name, sql FROM sqlite_master WHERE type='index' AND sql IS NOT NULL").fetchall():
+                unique = {row[1]: row[2] for row in self.conn.execute(f'PRAGMA index_list("{table}")')}
+                if not unique.get(name, 1):
+                    indexes.append((name, sql))
+            for (name, sql) in indexes:
+                self.conn.execute(f'DROP INDEX "{name}"')
+            self.conn.commit()
+        self.pragma('journal_mode', 'WAL')
+        self.pragma('synchronous', synchronous)
+        self.pragma('mmap_size', mmap_bytes)
+        self.set_cache_bytes(cache_bytes)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        try:
+            yield self
+        finally:
+            self.commit_every = None
+            errors = []
+            try:
+                self.conn.commit()
+                for (name, sql) in indexes:
+                    try:
+                        self.conn.execute(sql)
+                        self.conn.commit()
+                    except sqlite3.Error as e:
+                        logging.error("cannot rebuild index %s: %s", name, e)
+                        errors.append(e)
+            finally:
+                if saved['journal_mode'].upper() != 'WAL':
+                    self.pragma('wal_checkpoint', 'TRUNCATE')
+                for (name, value) in saved.items():
+                    self.pragma(name, value)
+            if errors:
+                raise errors[0]
 
     # For sqlite3, csfr doesn't need to be a static method, because we don't disconnect from the database
     # Notice that we try to keep API compatiability, but we lose 'auth'. We also change '%s' into '?'
     def csfr(self, auth, cmd, vals=[], *, quiet=True, rowcount=None, time_zone=None,
-             get_column_names=None, asDicts=False, debug=False, cache=True):
+             get_column_names=None, asDicts=False, debug=False, cache=False):
+        """See DBMySQL.csfr(). cache=True (or a TTL in seconds) serves identical SELECTs from the result_cache."""
         assert auth is None
         assert get_column_names is None  # not implemented yet
-        cmd = cmd.replace("%s", "?")
-        cmd = cmd.replace("INSERT IGNORE", "INSERT OR IGNORE")
+        stmt = statement_cache.get(cmd)
+        cmd = stmt.sqlite_cmd
+        key = result_key(self, stmt, vals) if cache else None
+        if key is not None:
+            if (hit := result_cache.get(key)) is not None:
+                return list(hit[0])
+            generation = result_cache.generation(key, stmt.tables)
 
         if not quiet:
             print(f"PID{os.getpid()}: cmd:{cmd} vals:{vals}")
         if debug or self.debug:
             print(f"PID{os.getpid()}: cmd:{cmd} vals:{vals}", file=sys.stderr)
 
+        t0 = time.time()
+        event = query_hooks.start(stmt.cmd, vals, connection_id=id(self.conn))
+        rowcount = None
+        error = None
         try:
-            c = self.conn.execute(cmd, vals)
-        except (sqlite3.OperationalError, sqlite3.InterfaceError) as e:
-            print(f"cmd: {cmd}", file=sys.stderr)
-            print(f"vals: {vals}", file=sys.stderr)
-            print(str(e), file=sys.stderr)
-            raise RuntimeError("Invalid SQL")
-
-        verb = cmd.split()[0].upper()
-        if verb in ['INSERT', 'DELETE', 'UPDATE']:
+            try:
+                c = self.conn.execute(cmd, vals)
+            except (sqlite3.OperationalError, sqlite3.InterfaceError) as e:
+                error = e
+                print(f"cmd: {cmd}", file=sys.stderr)
+                print(f"vals: {vals}", file=sys.stderr)
+                print(str(e), file=sys.stderr)
+                raise RuntimeError("Invalid SQL")
+
+            verb = stmt.verb
+            if verb in WRITE_VERBS:
+                result_cache.invalidate(self, stmt.tables)
+            if verb in ['INSERT', 'DELETE', 'UPDATE']:
+                rowcount = c.rowcount
+                statement_cache.record(stmt, time.time() - t0, rowcount)
+                if self.commit_every:
+                    self.uncommitted += 1
+                    if self.uncommitted >= self.commit_every:
+                        self.conn.commit()
+                        self.uncommitted = 0
+                return
+            elif verb in ['SELECT', 'DESCRIBE', 'SHOW']:
+                result = c.fetchall()
+                rowcount = len(result)
+                statement_cache.record(stmt, time.time() - t0, rowcount)
+                if key is not None:
+                    result_cache.put(key, stmt.tables, result, None, ttl=None if cache is True else cache,
+                                     generation=generation)
+                    result = list(result)
+                return result
+            else:
+                raise RuntimeError(f"Unknown SQLite3 verb '{verb}'")
+        finally:
+            query_hooks.finish(event, rowcount=rowcount, error=error or sys.exc_info()[1])
+
+    def csfr_stream(self, auth, cmd, vals=[], *, asDicts=False, batch_size=None, get_column_names=None,
+                    get_description=None):
+        """Like csfr() for a SELECT, but a generator that fetches rows from the cursor as they are consumed,
+        so memory use does not grow with the size of the result. API-compatible with DBMySQL.csfr_stream().
+        Yields rows, or lists of up to batch_size rows if batch_size is given."""
+        assert auth is None
+        stmt = statement_cache.get(cmd)
+        t0 = time.time()
+        event = query_hooks.start(cmd, vals, connection_id=id(self.conn))
+        count = 0
+        error = None
+        try:
+            c = self.conn.execute(stmt.sqlite_cmd, vals)
+            try:
+                names = [d[0] for d in c.description]
+                if get_column_names is not None:
+                    get_column_names[:] = names
+                if get_description is not None:
+                    get_description[:] = c.description
+                for item in DBSQL.stream_rows(c, names if asDicts else None, batch_size):
+                    count += len(item) if batch_size else 1
+                    yield item
+                statement_cache.record(stmt, time.time() - t0, count)
+            finally:
+                c.close()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            query_hooks.finish(event, rowcount=count, error=error)
+
+    def csfr_columns(self, auth, cmd, vals=[], *, batch_size=COLUMN_BATCH_SIZE):
+        """Run a SELECT and return a dictionary of NumPy arrays, one per column. API-compatible with
+        DBMySQL.csfr_columns(). Column types are taken from the values, since SQLite does not report them."""
+        description = []
+        return DBSQL.columns_from_batches(
+            self.csfr_stream(auth, cmd, vals, batch_size=batch_size, get_description=description), description)
+
+    def to_frame(self, auth, cmd, vals=[], *, batch_size=COLUMN_BATCH_SIZE):
+        """Run a SELECT and return a pandas DataFrame built from csfr_columns()"""
+        import pandas
+        return pandas.DataFrame(self.csfr_columns(auth, cmd, vals, batch_size=batch_size), copy=False)
+
+    def bulk_insert(self, auth, table, rows, *, columns=None, batch_size=BULK_BATCH_SIZE, ignore=False):
+        """Insert rows into table with executemany(), committing every batch_size rows.
+        API-compatible with DBMySQL.bulk_insert(). Returns a dictionary with rows, seconds and rows_per_sec."""
+        assert auth is None
+        t0 = time.time()
+        count = 0
+        (columns, batches) = self.row_batches(rows, columns, batch_size)
+        if columns is None:
+            return self.bulk_insert_report(table, count, t0)
+        cmd = self.insert_statement(table, columns, ignore)
+        cmd = cmd.replace("%s", "?").replace("INSERT IGNORE", "INSERT OR IGNORE")
+        try:
+            for batch in batches:
+                with self.conn:     # one transaction per batch
+                    self.conn.executemany(cmd, batch)
+                count += len(batch)
+        finally:
+            result_cache.invalidate(self, statement_tables(cmd))
+        return self.bulk_insert_report(table, count, t0)
+
+
+TABLE_RE = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE)\s+([^\s,;()]+)", re.I)
+FROM_LIST_RE = re.compile(r"\bFROM\s+(.+?)(?:\bWHERE\b|\bGROUP\b|\bORDER\b|\bLIMIT\b|\bHAVING\b|"
+                          r"\bUNION\b|\b(?:LEFT|RIGHT|INNER|OUTER|CROSS|STRAIGHT_JOIN|NATURAL)\b|\bJOIN\b|[;)]|$)",
+                          re.I | re.S)
+
+# Reads that depend on the session or take locks, so they must run on the primary
+PRIMARY_READ_RE = re.compile(r"@|\b(?:LAST_INSERT_ID|FOUND_ROWS|ROW_COUNT|CONNECTION_ID|GET_LOCK|RELEASE_LOCK|"
+                             r"IS_FREE_LOCK|IS_USED_LOCK)\s*\(|\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\s+MODE\b", re.I)
+
+
+def statement_tables(cmd):
+    """Return the set of table names (lowercase, without database or quotes) that cmd reads or writes.
+    This is a scanner, not a parser: it may name too many tables, which only costs extra cache invalidation.
+    Returns an empty set for a read with subqueries, in which case results are not cached. A write is
+    scanned even if it has subqueries, so that its target table is invalidated; a write whose tables
+    are not found (e.g. DROP or TRUNCATE) returns an empty set, which invalidates everything."""
+    verb = cmd.split(None, 1)[0].upper() if cmd.strip() else ''
+    if verb not in WRITE_VERBS and re.search(r"\(\s*SELECT\b", cmd, re.I):
+        return frozenset()
+    names = TABLE_RE.findall(cmd)
+    for m in FROM_LIST_RE.finditer(cmd):
+        names.extend(item.split()[0] for item in m.group(1).split(",") if item.strip())
+    return frozenset(name.replace("`", "").split(".")[-1].lower() for name in names)
+
+
+FINGERPRINT_RES = [(re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\""), "?"),  # string literals
+                   (re.compile(r"\b\d+(?:\.\d+)?\b|%s"), "?"),                         # numbers and parameters
+                   (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),              # IN lists and VALUES rows
+                   (re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+"), "(...)"),       # multi-row VALUES
+                   (re.compile(r"\s+"), " ")]
+
+
+def fingerprint(cmd):
+    """Return cmd with literals and parameters replaced by ? and lists collapsed to (...), so that statements
+    that differ only in their values are counted together"""
+    for (regex, repl) in FINGERPRINT_RES:
+        cmd = regex.sub(repl, cmd)
+    return cmd.strip()
+
+
+class Statement:
+    """A SQL statement with the work csfr() needs done on its text computed once, and its timing statistics"""
+    __slots__ = ['cmd', 'verb', 'nparams', 'sqlite_cmd', 'tables', 'fingerprint', 'replica_ok', 'calls',
+                 'total_time', 'rows', 'times']
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.verb = cmd.split()[0].upper() if cmd.strip() else ''
+        self.nparams = cmd.count("%s")
+        self.sqlite_cmd = cmd.replace("%s", "?").replace("INSERT IGNORE", "INSERT OR IGNORE")
+        self.tables = statement_tables(cmd)
+        self.fingerprint = fingerprint(cmd)
+        self.replica_ok = self.verb in READ_VERBS and not PRIMARY_READ_RE.search(cmd)
+        self.calls = 0
+        self.total_time = 0.0
+        self.rows = 0
+        self.times = deque(maxlen=STATEMENT_TIMES)
+
+    def percentile(self, p):
+        """Return the latency at percentile p (0..100) of the recent calls"""
+        if not self.times:
+            return 0.0
+        times = sorted(self.times)
+        return times[min(len(times) - 1, int(len(times) * p / 100))]
+
+
+class StatementCache:
+    """An LRU cache of Statement objects keyed by SQL text, shared by all threads.
+    record() accumulates per-statement call counts, latency and rows; report() returns them."""
+
+    def __init__(self, maxsize=STATEMENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.statements = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, cmd):
+        with self.lock:
+            try:
+                stmt = self.statements[cmd]
+                self.statements.move_to_end(cmd)
+            except KeyError:
+                stmt = self.statements[cmd] = Statement(cmd)
+                if len(self.statements) > self.maxsize:
+                    self.statements.popitem(last=False)
+            return stmt
+
+    def record(self, stmt, seconds, rows):
+        with self.lock:
+            stmt.calls += 1
+            stmt.total_time += seconds
+            stmt.rows += rows or 0
+            stmt.times.append(seconds)
+
+    def report(self):
+        """Return a list of dictionaries of statement statistics, most total time first"""
+        with self.lock:
+            stmts = [stmt for stmt in self.statements.values() if stmt.calls > 0]
+            return sorted(({'cmd': stmt.cmd,
+                            'calls': stmt.calls,
+                            'total_time': stmt.total_time,
+                            'mean_time': stmt.total_time / stmt.calls,
+                            'p99_time': stmt.percentile(99),
+                            'rows': stmt.rows} for stmt in stmts),
+                          key=lambda r: r['total_time'], reverse=True)
+
+    def print_report(self, file=sys.stdout, limit=20):
+        print(f"{'calls':>8} {'total':>10} {'mean':>10} {'p99':>10} {'rows':>10}  statement", file=file)
+        for r in self.report()[:limit]:
+            print(f"{r['calls']:8} {r['total_time']:10.3f} {r['mean_time']:10.6f} {r['p99_time']:10.6f} {r['rows']:10}  "
+                  f"{' '.join(r['cmd'].split())[:DBMySQL.MAX_EXPLAIN_LEN]}", file=file)
+
+    def clear(self):
+        with self.lock:
+            self.statements.clear()
+
+
+statement_cache = StatementCache()
+
+
+def statement_report():
+    """Return the per-statement statistics of csfr() calls in this process"""
+    return statement_cache.report()
+
+
+class QueryEvent:
+    """What an instrumentation hook is told about one statement. before hooks see it before the statement runs;
+    after hooks see it with duration, rowcount and error filled in."""
+    __slots__ = ['cmd', 'vals', 'fingerprint', 'retries', 'connection_id', 'start', 'duration', 'rowcount', 'error']
+
+    def __init__(self, cmd, vals, fingerprint, *, retries=0, connection_id=None):
+        self.cmd = cmd
+        self.vals = vals
+        self.fingerprint = fingerprint
+        self.retries = retries                  # how many earlier attempts of this call failed
+        self.connection_id = connection_id      # MySQL thread id, or id() of the SQLite connection
+        self.start = time.time()
+        self.duration = None
+        self.rowcount = None
+        self.error = None
+
+    def __repr__(self):
+        return (f"<QueryEvent {self.fingerprint!r} duration={self.duration} rowcount={self.rowcount} "
+                f"retries={self.retries} connection_id={self.connection_id} error={self.error!r}>")
+
+
+class QueryHooks:
+    """Registry of instrumentation callbacks, called with a QueryEvent before and after every statement run by
+    DBSQL.execute(), csfr(), csfr_stream() and DBMySQLAsync.csfr(). A hook that raises is logged and ignored.
+    When no hooks are registered, the statements pay only for an empty-list check."""
+
+    def __init__(self):
+        self.before = []
+        self.after = []
+
+    def register(self, before=None, after=None):
+        if before is not None:
+            self.before.append(before)
+        if after is not None:
+            self.after.append(after)
+
+    def unregister(self, hook):
+        for hooks in (self.before, self.after):
+            while hook in hooks:
+                hooks.remove(hook)
+
+    def enabled(self):
+        """Return True if any hooks are registered"""
+        return bool(self.before or self.after)
+
+    def start(self, cmd, vals, *, retries=0, connection_id=None):
+        """Return a QueryEvent after calling the before hooks, or None if no hooks are registered"""
+        if not (self.before or self.after):
+            return None
+        event = QueryEvent(cmd, vals, statement_cache.get(cmd).fingerprint, retries=retries,
+                           connection_id=connection_id)
+        self.call(self.before, event)
+        return event
+
+    def finish(self, event, *, rowcount=None, error=None):
+        """Fill in the results of event and call the after hooks. event may be None."""
+        if event is None:
             return
-        elif verb in ['SELECT', 'DESCRIBE', 'SHOW']:
-            return c.fetchall()
-        else:
-            raise RuntimeError(f"Unknown SQLite3 verb '{verb}'")
+        event.duration = time.time() - event.start
+        event.rowcount = rowcount
+        event.error = error
+        self.call(self.after, event)
+
+    @staticmethod
+    def call(hooks, event):
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception as e:  # pylint: disable=broad-except  # a failing hook must not fail the query
+                logging.error("query hook %s failed: %s", hook, e)
+
+
+query_hooks = QueryHooks()
+
+
+class SlowQueryLog:
+    """An after hook that logs statements that take at least threshold seconds"""
+
+    def __init__(self, threshold=SLOW_QUERY_SECONDS, logger=None):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger(__name__ + '.slow')
+
+    def __call__(self, event):
+        if event.duration >= self.threshold:
+            self.logger.warning("slow query: %.3fs rows=%s retries=%s connection=%s error=%s: %s",
+                                event.duration, event.rowcount, event.retries, event.connection_id, event.error,
+                                DBMySQL.explain(event.cmd, event.vals) if event.vals else event.cmd)
+
+
+class LatencyHistogram:
+    """An after hook that counts statement latencies per fingerprint in logarithmic buckets
+    (0.1ms, 0.2ms, 0.4ms ... doubling), so hot and slow statements can be found without logging each one."""
+    BUCKETS = [0.0001 * 2 ** i for i in range(20)]      # upper bounds in seconds; the last bucket is unbounded
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}        # fingerprint -> list of counts, one per bucket plus overflow
+        self.totals = {}        # fingerprint -> total seconds
+
+    def __call__(self, event):
+        i = next((i for (i, bound) in enumerate(self.BUCKETS) if event.duration <= bound), len(self.BUCKETS))
+        with self.lock:
+            counts = self.counts.setdefault(event.fingerprint, [0] * (len(self.BUCKETS) + 1))
+            counts[i] += 1
+            self.totals[event.fingerprint] = self.totals.get(event.fingerprint, 0.0) + event.duration
+
+    def percentile(self, fp, p):
+        """Return the upper bound of the bucket that holds percentile p (0..100) of fingerprint fp"""
+        with self.lock:
+            counts = list(self.counts.get(fp, []))
+        target = sum(counts) * p / 100
+        seen = 0
+        for (i, n) in enumerate(counts):
+            seen += n
+            if n and seen >= target:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else float('inf')
+        return 0.0
+
+    def report(self):
+        """Return a list of dictionaries of fingerprint statistics, most total time first"""
+        with self.lock:
+            fps = [(fp, sum(counts), self.totals[fp]) for (fp, counts) in self.counts.items()]
+        return sorted(({'fingerprint': fp, 'calls': calls, 'total_time': total,
+                        'p50_time': self.percentile(fp, 50), 'p99_time': self.percentile(fp, 99)}
+                       for (fp, calls, total) in fps),
+                      key=lambda r: r['total_time'], reverse=True)
+
+
+def install_default_hooks(slow_query_seconds=SLOW_QUERY_SECONDS):
+    """Register a SlowQueryLog and a LatencyHistogram with query_hooks and return them"""
+    slow_log = SlowQueryLog(slow_query_seconds)
+    histogram = LatencyHistogram()
+    query_hooks.register(after=slow_log)
+    query_hooks.register(after=histogram)
+    return (slow_log, histogram)
+
+
+class ResultCache:
+    """A cache of SELECT results for csfr(..., cache=True), keyed by (result_cache_id(auth), cmd, vals),
+    shared by all threads. Entries expire after their TTL, and the least recently used entries are evicted
+    to keep the estimated size under max_bytes. invalidate() drops every result that read a table written
+    through the same auth; csfr(), DBMySQLAsync.csfr() and bulk_insert() call it after INSERT, UPDATE, DELETE
+    and REPLACE. Writes made by other programs or connections are only seen when the TTL expires.
+    invalidate() also counts a generation for each table. A caller reads generation() before running its
+    query and passes it to put(), so a result read before a concurrent write is not cached after it.
+    """
+
+    def __init__(self, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> (expires, nbytes, tables, rows, names)
+        self.by_table = {}              # (auth id, table) -> set of keys
+        self.generations = {}           # (auth id, table) -> number of invalidations
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def estimate_bytes(rows):
+        return sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in rows)
+
+    def _remove(self, key):
+        (expires, nbytes, tables, rows, names) = self.entries.pop(key)
+        self.nbytes -= nbytes
+        for table in tables:
+            keys = self.by_table.get((key[0], table))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_table[(key[0], table)]
+
+    def get(self, key):
+        """Return (rows, names) for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return (entry[3], entry[4])
+
+    def _generation(self, auth_id, tables):
+        return self.generations.get((auth_id, None), 0) + sum(self.generations.get((auth_id, table), 0)
+                                                              for table in tables)
+
+    def generation(self, key, tables):
+        """Return the generation of tables for key, to pass to put()"""
+        with self.lock:
+            return self._generation(key[0], tables)
+
+    def put(self, key, tables, rows, names, ttl=None, generation=None):
+        """Cache rows and names for key. If generation is given and tables were invalidated since it was
+        read, the result may be stale and is not cached."""
+        nbytes = self.estimate_bytes(rows)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if generation is not None and generation != self._generation(key[0], tables):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time() + (ttl or self.ttl), nbytes, tables, rows, names)
+            self.nbytes += nbytes
+            for table in tables:
+                self.by_table.setdefault((key[0], table), set()).add(key)
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, auth, tables):
+        """Remove the cached results for auth that read any of tables, or all of them if tables is empty"""
+        auth_id = result_cache_id(auth)
+        with self.lock:
+            if not tables:
+                self.generations[(auth_id, None)] = self.generations.get((auth_id, None), 0) + 1
+                for key in [key for key in self.entries if key[0] == auth_id]:
+                    self._remove(key)
+            for table in tables:
+                self.generations[(auth_id, table)] = self.generations.get((auth_id, table), 0) + 1
+                for key in list(self.by_table.get((auth_id, table), ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_table.clear()
+            self.nbytes = 0
+
+
+result_cache = ResultCache()
+
+
+def result_cache_id(auth):
+    """Identify the database of auth in ResultCache keys without holding a reference to auth, so that closed
+    connections can be freed. A DBSqlite3 is identified by its serial number, MySQL credentials (or a
+    DBMySQL connection made with them) by their host, port, database and user."""
+    if isinstance(auth, DBMySQL):
+        auth = auth.auth
+    elif isinstance(auth, DBSQL):
+        return ('sqlite3', auth.serial)
+    return (auth.host, auth.port, auth.database, auth.user)
+
+
+def result_key(auth, stmt, vals, *extra):
+    """Return the ResultCache key for stmt, or None if its result should not be cached"""
+    if stmt.verb != 'SELECT' or not stmt.tables:
+        return None
+    return (result_cache_id(auth), stmt.cmd, tuple(vals)) + extra
+
+
+WRITE_VERBS = ['INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'TRUNCATE', 'DROP', 'ALTER', 'RENAME']
+READ_VERBS = ['SELECT', 'SHOW', 'DESCRIBE']
+SESSION_VERBS = ['SET', 'LOCK', 'UNLOCK', 'USE', 'PREPARE']   # statements that leave state in the session
+
+
+class DBPool:
+    """A bounded pool of database connections shared by the threads of one process.
+    checkout() returns an idle connection or calls connect() to open a new one, and blocks for up to
+    timeout seconds when size connections are already checked out. Connections idle for more than
+    idle_timeout seconds or older than max_lifetime seconds are closed rather than reused. A connection
+    that has been idle more than ping_after seconds is checked with is_alive() before it is returned,
+    so busy connections are reused without an extra round trip. A connection that is not reusable()
+    (for example, one with an open transaction) is closed at checkin() rather than handed to another thread.
+    A thread may pin() a connection to keep it between calls, for example for a transaction.
+    """
+
+    def __init__(self, connect, *, size=POOL_SIZE, timeout=POOL_TIMEOUT, idle_timeout=POOL_IDLE_TIMEOUT,
+                 max_lifetime=POOL_MAX_LIFETIME, ping_after=POOL_PING_AFTER):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.cond = threading.Condition()
+        self.idle = deque()     # (db, last_used), most recently used on the right
+        self.created = {}       # id(db) -> creation time, for every open connection
+        self.count = 0          # open connections, including those being opened
+        self.closed = False
+        self.pins = {}          # thread ident -> connection that thread holds between calls
+        self.stats = {'opened': 0, 'reused': 0, 'pinged': 0, 'discarded': 0, 'waited': 0}
+
+    def _close(self, db):
+        """Close db and release its slot. Call with self.cond held."""
+        self.created.pop(id(db), None)
+        self.count -= 1
+        self.stats['discarded'] += 1
+        self.cond.notify()
+        try:
+            db.close()
+        except (pymysql.Error, sqlite3.Error, OSError) as e:
+            logging.debug("DBPool: error closing %s: %s", db, e)
+
+    def _expired(self, db, last_used, now):
+        return (now - last_used > self.idle_timeout) or (now - self.created[id(db)] > self.max_lifetime)
+
+    def checkout(self):
+        """Return a connection. It must be given back with checkin()."""
+        deadline = time.time() + self.timeout
+        while True:
+            with self.cond:
+                if self.closed:
+                    raise RuntimeError("DBPool is closed")
+                entry = None
+                if self.idle:
+                    entry = self.idle.pop()
+                elif self.count < self.size:
+                    self.count += 1
+                else:
+                    self.stats['waited'] += 1
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or not self.cond.wait(remaining):
+                        raise TimeoutError(f"no connection available in {self.timeout} seconds")
+                    continue
+                if entry is not None:
+                    (db, last_used) = entry
+                    now = time.time()
+                    if self._expired(db, last_used, now):
+                        self._close(db)
+                        continue
+            if entry is None:
+                try:
+                    db = self.connect()
+                except BaseException:
+                    with self.cond:
+                        self.count -= 1
+                        self.cond.notify()
+                    raise
+                with self.cond:
+                    self.created[id(db)] = time.time()
+                    self.stats['opened'] += 1
+                return db
+            if now - last_used > self.ping_after:
+                with self.cond:
+                    self.stats['pinged'] += 1
+                if not db.is_alive():
+                    with self.cond:
+                        self._close(db)
+                    continue
+            with self.cond:
+                self.stats['reused'] += 1
+            return db
+
+    def checkin(self, db, discard=False):
+        """Return a connection to the pool. Use discard=True if it may be broken.
+        Connections that are not reusable() are closed."""
+        with self.cond:
+            now = time.time()
+            if discard or self.closed or (now - self.created[id(db)] > self.max_lifetime) or not db.reusable():
+                self._close(db)
+            else:
+                self.idle.append((db, now))
+                self.cond.notify()
+            while self.idle and now - self.idle[0][1] > self.idle_timeout:
+                self._close(self.idle.popleft()[0])
+
+    def pin(self, db):
+        """Keep the checked out connection db for the calling thread; pinned() returns it until unpin()"""
+        self.pins[threading.get_ident()] = db
+
+    def pinned(self):
+        """Return the connection the calling thread pinned, or None"""
+        return self.pins.get(threading.get_ident())
+
+    def unpin(self):
+        """Forget the calling thread's pinned connection and return it (it is still checked out), or None"""
+        return self.pins.pop(threading.get_ident(), None)
+
+    def close(self):
+        """Close the idle connections. Connections checked out are closed when they are checked in."""
+        with self.cond:
+            self.closed = True
+            while self.idle:
+                self._close(self.idle.popleft()[0])
+
+    def outstanding(self):
+        """Return the number of connections checked out"""
+        return self.count - len(self.idle)
+
+    def __len__(self):
+        return self.count
 
 
 class DBMySQLAuth:
-    """Class that represents MySQL credentials. Will cache the connection. """
+    """Class that represents MySQL credentials. Holds a DBPool of connections for each process."""
 
     __slots__ = ['host', 'database', 'user',
-                 'password', 'debug', 'dbcache', 'prefix', 'port']
-
-    def __init__(self, *, host, database, user, password, prefix="", debug=False, port=MYSQL_DEFAULT_PORT):
+                 'password', 'debug', 'dbcache', 'prefix', 'port', 'replicas', 'secret']
+    down = {}                   # (host, port) of a replica -> time until which route() skips it
+    turns = itertools.count()   # breaks ties between replicas in route() round-robin
+
+    def __init__(self, *, host, database, user, password, prefix="", debug=False, port=MYSQL_DEFAULT_PORT,
+                 replicas=(), secret=None):
+        """:param replicas: read replicas, as DBMySQLAuth objects or as host names that share these credentials.
+        :param secret: (secret_name, region_name) of the AWS secret the credentials came from, if any.
+        """
+        self.secret = secret
         self.host = host
         self.database = database
         self.user = user
         self.password = password
         self.debug = debug   # enable debugging
-        self.dbcache = dict()  # dictionary of cached connections.
+        self.dbcache = dict()  # pid -> DBPool of connections.
         self.prefix = prefix  # available for use
         self.port = port
         if (self.port is None) or (self.port==0):
             self.port = MYSQL_DEFAULT_PORT
+        self.replicas = [r if isinstance(r, DBMySQLAuth) else
+                         DBMySQLAuth(host=r, database=database, user=user, password=password, prefix=prefix,
+                                     debug=debug, port=self.port, secret=secret)
+                         for r in replicas]
 
     def __eq__(self, other):
-        return ((self.host == other.host) and (self.database == other.database)
+        return ((self.host == other.host) and (self.database == other.database) and (self.port == other.port)
                 and (self.user == other.user) and (self.password == other.password)
                 and (self.prefix == other.prefix) and (self.debug == other.debug))
 
     def __hash__(self):
-        return hash(self.host) ^ hash(self.database) ^ hash(self.user) ^ hash(self.password)
+        # The credentials are left out, so that refresh_secret() does not change the hash of an auth
+        # that is a dictionary key (in DBMySQLAsync.pools, for example)
+        return hash(self.host) ^ hash(self.database) ^ hash(self.port)
 
     def __repr__(self):
         return f"<DBMySQLAuth host={self.host} database={self.database} user={self.user} prefix={self.prefix} debug={self.debug}>"
@@ -322,7 +1259,7 @@ class DBMySQLAuth:
                             val = val[1:-1]
                         ret[name] = val
         for name in (MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE):
-            if name not in ret:
+            if name not in ret and AWS_SECRET_NAME not in ret:
                 try:
                     ret[name] = os.environ[name]
                 except KeyError:
@@ -334,10 +1271,16 @@ class DBMySQLAuth:
 
     @classmethod
     def FromBashEnvFile(this, filename, cache=True):
-        """Returns a DBMySQLAuth formed by reading MYSQL_USER, MYSQL_PASSWORD, MYSQL_HOST and MYSQL_DATABASE envrionemnt variables from a bash script. Caches by default"""
+        """Returns a DBMySQLAuth formed by reading MYSQL_USER, MYSQL_PASSWORD, MYSQL_HOST and MYSQL_DATABASE envrionemnt variables from a bash script. Caches by default.
+        If the script exports AWS_SECRET_NAME and AWS_REGION_NAME, the credentials come from that secret."""
         if cache and filename in this.auth_cache:
             return this.auth_cache[filename]
         env = DBMySQLAuth.GetBashEnvFromFile(filename)
+        if aws_secret_for_section(env) is not None:
+            auth = DBMySQLAuth.FromConfig(env)
+            if cache:
+                this.auth_cache[filename] = auth
+            return auth
         try:
             auth = DBMySQLAuth(host=env[MYSQL_HOST],
                                user=env[MYSQL_USER],
@@ -355,18 +1298,22 @@ class DBMySQLAuth:
     @staticmethod
     def FromConfig(section, debug=None):
         """Returns from the section of a config file.
-        First checks to see if there is an AWS_SECRET, and uses that if possible.
+        First checks to see if there is an AWS_SECRET, and uses that if possible. Secrets are cached by secret_cache.
         Then tries with MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD and MYSQL_DATABASE, which is the standard used from 2005-2023.
         Finally tries with the modern MySQL varialbe names of HOST, USER, PASSWORD and DATABASE.
+        Read replicas may be listed, comma-separated, in MYSQL_REPLICAS or REPLICAS.
         Environment variable expansion allows the name or region to be stored in an enviornment variable for multiple deployments.
         """
+        replicas = [h.strip() for h in section.get(MYSQL_REPLICAS, section.get(REPLICAS, "")).split(",") if h.strip()]
         if (secret:= get_aws_secret_for_section( section )) is not None:
             logging.debug("retrieved secret for host %s username %s",secret['host'],secret['username'])
             return DBMySQLAuth(host=secret['host'],
                                user=secret['username'],
                                password=secret['password'],
                                database=secret['dbname'],
-                               port=int(secret['port']))
+                               port=int(secret['port']),
+                               replicas=replicas,
+                               secret=aws_secret_for_section(section))
 
         # Look for
         try:
@@ -374,7 +1321,8 @@ class DBMySQLAuth:
                                user=section[MYSQL_USER],
                                password=section[MYSQL_PASSWORD],
                                database=section.get(MYSQL_DATABASE,None),
-                               debug=debug)
+                               debug=debug,
+                               replicas=replicas)
         except KeyError:
             pass
 
@@ -383,7 +1331,8 @@ class DBMySQLAuth:
                                user=section[USER],
                                password=section[PASSWORD],
                                database=section.get(DATABASE,None),
-                               debug=debug)
+                               debug=debug,
+                               replicas=replicas)
         except KeyError:
             pass
 
@@ -413,15 +1362,105 @@ class DBMySQLAuth:
                            database=os.environ[MYSQL_DATABASE],
                            debug=debug)
 
-    def cache_store(self, db):
-        self.dbcache[(os.getpid(), threading.get_ident())] = db
+    def pool(self, **kwargs):
+        """Return this process's DBPool of DBMySQL connections, creating it with kwargs if necessary.
+        A forked child gets its own pool rather than sharing the parent's sockets."""
+        pid = os.getpid()
+        try:
+            return self.dbcache[pid]
+        except KeyError:
+            return self.dbcache.setdefault(pid, DBPool(lambda: DBMySQL(self), **kwargs))
+
+    def route(self, verb, primary=False):
+        """Return the DBMySQLAuth that should run a statement starting with verb: the replica with the fewest
+        outstanding requests for SELECT, SHOW and DESCRIBE (if there are replicas), otherwise this primary.
+        Replicas that checkout() could not reach are skipped for REPLICA_RETRY_AFTER seconds.
+        Replicas lag the primary, so a read that must see a write just made should pass primary=True."""
+        if primary or not self.replicas or verb not in READ_VERBS:
+            return self
+        now = time.time()
+        up = [(r.pool().outstanding(), r) for r in self.replicas
+              if DBMySQLAuth.down.get((r.host, r.port), 0) <= now]
+        if not up:
+            return self
+        least = min(outstanding for (outstanding, r) in up)
+        tied = [r for (outstanding, r) in up if outstanding == least]
+        return tied[next(DBMySQLAuth.turns) % len(tied)]
+
+    def checkout(self, verb, primary=False):
+        """Return (pool, db): a connection checked out from the pool that route(verb, primary) selects.
+        If a replica cannot be reached, the primary is used instead.
+        If this thread pinned a primary connection (see checkin()), that connection is returned."""
+        if (db := self.pool().pinned()) is not None:
+            return (self.pool(), db)
+        target = self.route(verb, primary)
+        try:
+            return (target.pool(), target.pool().checkout())
+        except (pymysql.OperationalError, OSError) as e:
+            if target is self:
+                raise
+            logging.warning("replica %s unavailable (%s); using primary %s", target.host, e, self.host)
+            DBMySQLAuth.down[(target.host, target.port)] = time.time() + REPLICA_RETRY_AFTER
+            return (self.pool(), self.pool().checkout())
+
+    def checkin(self, pool, db, *, discard=False, pin=None):
+        """Give back a connection from checkout().
+        :param pin: - True to keep db for this thread's next checkout() (an open transaction), False to
+                      release it to pool, None to leave a pinned connection pinned.
+        A connection that is discarded is never kept."""
+        if pool.pinned() is db:
+            if pin is False or discard:
+                pool.unpin()
+            else:
+                return
+        elif pin and not discard:
+            pool.pin(db)
+            return
+        pool.checkin(db, discard=discard)
+
+    def refresh_secret(self):
+        """Fetch the AWS secret these credentials came from again, for example after the password was rotated.
+        If the user or password changed, update them, close the pooled connections and return True.
+        Otherwise return False. Replicas that came from the same secret (or share the old credentials)
+        are updated too, and replicas with a secret of their own are refreshed from it."""
+        changed = False
+        for replica in self.replicas:
+            if replica.secret is not None and replica.secret != self.secret:
+                changed = replica.refresh_secret() or changed
+        if self.secret is None:
+            return changed
+        secret = secret_cache.get(*self.secret, refresh=True)
+        credentials = (secret['username'], secret['password'])
+        old = (self.user, self.password)
+        for auth in [self] + [r for r in self.replicas if r.secret == self.secret
+                                         or (r.secret is None and (r.user, r.password) == old)]:
+            if (auth.user, auth.password) != credentials:
+                logging.warning("credentials for %s changed in secret %s; reconnecting", auth.host, self.secret[0])
+                (auth.user, auth.password) = credentials
+                auth.cache_clear()
+                changed = True
+        return changed
 
     def cache_get(self):
-        return self.dbcache[(os.getpid(), threading.get_ident())]
+        """Deprecated: use checkout() and checkin(). Return this thread's connection, checking one out of
+        the pool and pinning it to the thread if there is none. It stays checked out until cache_clear()."""
+        warnings.warn("DBMySQLAuth.cache_get() is deprecated; use checkout()", DeprecationWarning, stacklevel=2)
+        pool = self.pool()
+        if (db := pool.pinned()) is None:
+            db = pool.checkout()
+            pool.pin(db)
+        return db
+
+    def cache_store(self, db):
+        """Deprecated: use checkout() and checkin(). Keep db, a connection from cache_get() or checkout(),
+        for this thread."""
+        warnings.warn("DBMySQLAuth.cache_store() is deprecated; use checkin()", DeprecationWarning, stacklevel=2)
+        self.checkin(self.pool(), db, pin=True)
 
     def cache_clear(self):
+        """Close the idle connections in this process's pool"""
         try:
-            del self.dbcache[(os.getpid(), threading.get_ident())]
+            self.dbcache.pop(os.getpid()).close()
         except KeyError:
             pass
 
@@ -443,6 +1482,8 @@ class DBMySQL(DBSQL):
                                     password=auth.password,
                                     port = auth.port,
                                     autocommit=True)
+        self.time_zone = None   # session time zone set by set_time_zone()
+        self.session = False    # True once a statement may have left session state (variables, locks)
         if self.debug:
             print(f"Successfully connected to {auth}", file=sys.stderr)
 
@@ -451,6 +1492,31 @@ class DBMySQL(DBSQL):
     IGNORED = 'IGNORED'
     MAX_EXPLAIN_LEN = 1000
 
+    def connection_id(self):
+        return self.conn.thread_id()
+
+    def reusable(self):
+        """A connection with autocommit off, an open transaction or session state is not given to another caller"""
+        return (not self.session and self.conn.get_autocommit()
+                and not self.conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS)
+
+    def set_time_zone(self, c, time_zone):
+        """Set the session time zone with cursor c, or restore the server's default if time_zone is None.
+        A statement is only sent when the time zone changes."""
+        if time_zone != self.time_zone:
+            if time_zone is None:
+                c.execute('SET @@session.time_zone = @@global.time_zone')
+            else:
+                c.execute('SET @@session.time_zone = "{}"'.format(time_zone))
+            self.time_zone = time_zone
+
+    def is_alive(self):
+        try:
+            self.conn.ping(reconnect=False)
+            return True
+        except (pymysql.MySQLError, OSError):
+            return False
+
     @staticmethod
     def explain(cmd, vals):
         if (not isinstance(vals, list)) and (not isinstance(vals, tuple)) and (vals is not None):
@@ -468,7 +1534,8 @@ class DBMySQL(DBSQL):
     @staticmethod
     def csfr(auth, cmd, vals=[], *,
              quiet=True, rowcount=None, time_zone=None, setup=None, setup_vals=(),
-             get_column_names=None, asDicts=False, debug=False, dry_run=False, cache=True, nolog=[], ignore=[], autocommit=True):
+             get_column_names=None, asDicts=False, debug=False, dry_run=False, cache=False, nolog=[], ignore=[], autocommit=True,
+             primary=False):
         """Connect, select, fetchall, and retry as necessary.
         :param auth:      - authentication otken
         :param cmd:       - SQL query
@@ -479,35 +1546,58 @@ class DBMySQL(DBSQL):
         :param quiet:     - don't print anything
         :param get_column_names: - an array in which to return the column names.
         :param asDict:    - True to return each row as a dictionary
+        :param cache:     - True (or a TTL in seconds) to serve identical SELECTs from the result_cache.
+                            Defaults to False (the old default of True did nothing).
         :param nolog:     - array of error codes that shouldn't be logged with logging.errror
         :param ignore:    - array of error codes to silently ignore.
+        :param autocommit: - False to run in a transaction. The connection is kept for this thread's later
+                             calls until one is made with autocommit=True, which commits.
+        :param primary:   - True to run a read on the primary even if there are replicas, e.g. to see a write
+                            just made. Transactions, setup, and reads of session state (LAST_INSERT_ID(), @var,
+                            locks) always run on the primary.
+        Connections come from a pool. A connection that ran setup or a SET, LOCK or USE statement is closed
+        afterwards rather than reused, so session state does not leak into other callers.
         """
 
-        for name in DBMySQLAuth.__slots__:
-            if not hasattr(auth, name):
-                raise TypeError(
-                    f"auth (val={auth}) (type {type(auth)}) does not have {name} slot")
+        if not isinstance(auth, DBMySQLAuth):
+            for name in DBMySQLAuth.__slots__:
+                if not hasattr(auth, name):
+                    raise TypeError(
+                        f"auth (val={auth}) (type {type(auth)}) does not have {name} slot")
 
-        if cmd.count("%s") != len(vals):
-            raise ValueError(f"cmd={cmd} cmd.count('%s')={cmd.count('%s')} len(vals)={len(vals)}")
+        stmt = statement_cache.get(cmd)
+        if stmt.nparams != len(vals):
+            raise ValueError(f"cmd={cmd} cmd.count('%s')={stmt.nparams} len(vals)={len(vals)}")
+
+        # Results read inside a transaction may include its uncommitted writes, so they are not cached
+        key = (result_key(auth, stmt, vals, time_zone) if (cache and autocommit and setup is None and not dry_run)
+               else None)
+        if key is not None:
+            if (hit := result_cache.get(key)) is not None:
+                return DBMySQL.select_result(*hit, asDicts, get_column_names)
+            generation = result_cache.generation(key, stmt.tables)
 
         for i in range(1, DBMySQL.RETRIES):
+            if i > 2:
+                logging.warning(f"Reconnecting. i={i}")
+            try:
+                (pool, db) = auth.checkout(stmt.verb, primary or not autocommit or setup is not None
+                                           or not stmt.replica_ok)
+            except pymysql.OperationalError as e:
+                # A rotated secret shows up as access denied when a new connection is opened
+                if e.args[0] == ER.ACCESS_DENIED_ERROR and auth.refresh_secret():
+                    continue
+                raise
+            discard = False
+            event = None
+            error = None
             try:
-                try:
-                    db = auth.cache_get()
-                except KeyError:
-                    if i > 2:
-                        logging.warning(f"Reconnecting. i={i}")
-                    db = DBMySQL(auth)
-                    auth.cache_store(db)
                 result = None
-                c = db.cursor()
-                if autocommit:
-                    c.execute('SET autocommit=1')
-                if time_zone is not None:
-                    # MySQL
-                    c.execute(
-                        'SET @@session.time_zone = "{}"'.format(time_zone))
+                # The pool checks liveness after idle periods, so there is no ping here.
+                c = db.conn.cursor()
+                if db.conn.get_autocommit() != autocommit:
+                    db.conn.autocommit(autocommit)
+                db.set_time_zone(c, time_zone)
 
                 try:
                     if (not quiet) or debug:
@@ -524,9 +1614,12 @@ class DBMySQL(DBSQL):
 
                     # If there are multiple queries, execute them all.
                     # Hopefully there is no semi-colon in a quoted string.
+                    if setup is not None or stmt.verb in SESSION_VERBS:
+                        db.session = True
                     if setup is not None:
                         c.execute(setup, setup_vals)
                     t0 = time.time()
+                    event = query_hooks.start(cmd, vals, retries=i - 1, connection_id=db.connection_id())
                     c.execute(cmd, vals)
                     t1 = time.time()
                     ###
@@ -560,22 +1653,23 @@ class DBMySQL(DBSQL):
                             "Count of parameters: %s  count of values: %s", cmd.count("%"), len(vals))
                     raise e
 
-                verb = cmd.split()[0].upper()
+                verb = stmt.verb
                 if verb in ['SELECT', 'DESCRIBE', 'SHOW']:
-                    result = c.fetchall()
-                    if asDicts and get_column_names is None:
-                        get_column_names = []
-                    if get_column_names is not None:
-                        get_column_names.clear()
-                        for (name, type_code, display_size, internal_size, precision, scale, null_ok) in c.description:
-                            get_column_names.append(name)
-                    if asDicts:
-                        result = [OrderedDict(zip(get_column_names, row))
-                                  for row in result]
+                    rows = c.fetchall()
+                    names = [d[0] for d in c.description]
+                    if key is not None:
+                        result_cache.put(key, stmt.tables, rows, names, ttl=None if cache is True else cache,
+                                         generation=generation)
+                    result = DBMySQL.select_result(rows, names, asDicts, get_column_names)
                 elif verb in ['INSERT']:
                     result = c.lastrowid
                 elif verb in ['UPDATE', 'DELETE', 'UPDATE']:
                     result = c.rowcount
+                if verb in WRITE_VERBS:
+                    result_cache.invalidate(auth, stmt.tables)
+                statement_cache.record(stmt, time.time() - t0, c.rowcount)
+                query_hooks.finish(event, rowcount=c.rowcount)
+                event = None
                 c.close()  # close the cursor
                 if debug:
                     logging.warning(
@@ -585,25 +1679,303 @@ class DBMySQL(DBSQL):
                 return result
             except (pymysql.OperationalError, pymysql.InternalError) as e:
                 # These errors we do not retry
+                discard = True
+                error = e
                 logging.error("%s %s in CMD: %s  explained: %s",
                               e.args[0], e.args[1], cmd, DBMySQL.explain(cmd, vals))
                 if e.args[0] not in ERRORS_NO_RETRY:
                     raise
                 logging.warning(
                     f"OperationalError. RETRYING {i}/{DBMySQL.RETRIES}: {cmd} {vals} ")
-                auth.cache_clear()
-                pass
             except BlockingIOError as e:
+                discard = True
+                error = e
                 if i > 1:
                     logging.warning(e)
                     logging.warning(
                         f"BlockingIOError. RETRYING {i}/{DBMySQL.RETRIES}: {cmd} {vals} ")
-                auth.cache_clear()
-                pass
+            finally:
+                query_hooks.finish(event, error=error or sys.exc_info()[1])
+                auth.checkin(pool, db, discard=discard, pin=not autocommit)
             time.sleep(RETRY_DELAY_TIME)
         raise RuntimeError("Retries Exceeded")
 
+    @staticmethod
+    def csfr_many(auth, queries, *, threads=None, **kwargs):
+        """Run independent queries concurrently and return their results in order.
+        :param queries: - list of (cmd, vals) tuples, or of cmd strings without parameters.
+        :param threads: - concurrent queries; defaults to the number of connections the primary and replicas may open.
+        :param kwargs:  - passed to every csfr() call.
+        With replicas, the SELECTs are spread across them by route(). The first exception is raised."""
+        queries = [(q, []) if isinstance(q, str) else q for q in queries]
+        if not queries:
+            return []
+        threads = threads or POOL_SIZE * (1 + len(auth.replicas))
+        with ThreadPoolExecutor(max_workers=min(threads, len(queries))) as pool:
+            futures = [pool.submit(DBMySQL.csfr, auth, cmd, vals, **kwargs) for (cmd, vals) in queries]
+            return [f.result() for f in futures]
+
+    @staticmethod
+    def select_result(rows, names, asDicts, get_column_names):
+        """Return the csfr() result for rows, filling get_column_names if it is provided"""
+        if get_column_names is not None:
+            get_column_names[:] = names
+        if asDicts:
+            return [OrderedDict(zip(names, row)) for row in rows]
+        return rows
+
+    @staticmethod
+    def csfr_stream(auth, cmd, vals=[], *, asDicts=False, batch_size=None, time_zone=None, get_column_names=None,
+                    get_description=None, primary=False):
+        """Streaming variant of csfr() for large SELECTs. Executes cmd with a server-side (unbuffered)
+        SSCursor and yields the rows as they arrive, so memory use stays constant regardless of the
+        size of the result. Rows are tuples, or dictionaries if asDicts is True. If batch_size is given,
+        yields lists of up to batch_size rows instead.
+        The connection is held until the generator is exhausted or closed. Streams are not retried,
+        because rows may already have been consumed. A stream that is closed early discards its connection
+        rather than reading the rest of the result.
+        If get_description is a list, it is filled with cursor.description before the first row is yielded.
+        primary=True reads from the primary even if there are replicas, as with csfr().
+        """
+        stmt = statement_cache.get(cmd)
+        if stmt.nparams != len(vals):
+            raise ValueError(f"cmd={cmd} cmd.count('%s')={stmt.nparams} len(vals)={len(vals)}")
+        (pool, db) = auth.checkout(stmt.verb, primary or not stmt.replica_ok)
+        discard = True
+        event = None
+        count = 0
+        try:
+            c = db.conn.cursor(pymysql.cursors.SSCursor)
+            db.set_time_zone(c, time_zone)
+            t0 = time.time()
+            event = query_hooks.start(cmd, vals, connection_id=db.connection_id())
+            c.execute(cmd, vals)
+            names = [d[0] for d in c.description]
+            if get_column_names is not None:
+                get_column_names[:] = names
+            if get_description is not None:
+                get_description[:] = c.description
+            for item in DBSQL.stream_rows(c, names if asDicts else None, batch_size):
+                count += len(item) if batch_size else 1
+                yield item
+            statement_cache.record(stmt, time.time() - t0, count)
+            c.close()
+            discard = False
+        finally:
+            query_hooks.finish(event, rowcount=count, error=sys.exc_info()[1])
+            auth.checkin(pool, db, discard=discard)
+
+    @staticmethod
+    def csfr_columns(auth, cmd, vals=[], *, batch_size=COLUMN_BATCH_SIZE, time_zone=None):
+        """Run a SELECT and return a dictionary of typed NumPy arrays, one per column, without building a
+        Python object per row beyond what the driver returns. Rows are streamed with csfr_stream() and
+        converted batch_size rows at a time, using the column types in cursor.description
+        (see MYSQL_NUMPY_DTYPES). Requires numpy."""
+        description = []
+        return DBSQL.columns_from_batches(
+            DBMySQL.csfr_stream(auth, cmd, vals, batch_size=batch_size, time_zone=time_zone,
+                                get_description=description), description)
+
+    @staticmethod
+    def to_frame(auth, cmd, vals=[], *, batch_size=COLUMN_BATCH_SIZE, time_zone=None):
+        """Run a SELECT and return a pandas DataFrame built from csfr_columns(). Requires pandas."""
+        import pandas
+        return pandas.DataFrame(DBMySQL.csfr_columns(auth, cmd, vals, batch_size=batch_size, time_zone=time_zone),
+                                copy=False)
+
+    @staticmethod
+    def bulk_insert(auth, table, rows, *, columns=None, batch_size=BULK_BATCH_SIZE, ignore=False):
+        """Insert rows into table in batches of batch_size. Each batch is one executemany(), which pymysql
+        sends as a multi-row INSERT ... VALUES, inside an explicit transaction.
+        :param rows:    - iterable of sequences (in the order of columns) or of dictionaries.
+        :param columns: - column names; taken from the first row if rows are dictionaries.
+        :param ignore:  - use INSERT IGNORE.
+        Returns a dictionary with rows, seconds and rows_per_sec.
+        """
+        t0 = time.time()
+        count = 0
+        (columns, batches) = DBSQL.row_batches(rows, columns, batch_size)
+        if columns is None:
+            return DBSQL.bulk_insert_report(table, count, t0)
+        cmd = DBSQL.insert_statement(table, columns, ignore)
+        pool = auth.pool()
+        db = pool.checkout()
+        discard = False
+        try:
+            c = db.conn.cursor()
+            db.set_time_zone(c, None)
+            for batch in batches:
+                db.conn.begin()
+                try:
+                    c.executemany(cmd, batch)
+                    db.conn.commit()
+                except BaseException:
+                    db.conn.rollback()
+                    raise
+                count += len(batch)
+            c.close()
+        except (pymysql.OperationalError, BlockingIOError, OSError):
+            discard = True
+            raise
+        finally:
+            pool.checkin(db, discard=discard)
+            result_cache.invalidate(auth, statement_tables(cmd))
+        return DBSQL.bulk_insert_report(table, count, t0)
+
     @staticmethod
     def table_columns(auth, table_name):
         """Return a dictionary of the schema. This should probably be upgraded to return the ctools schema"""
         return [row[0] for row in DBMySQL.csfr(auth, "describe " + table_name)]
+
+
+class DBMySQLAsync:
+    """asyncio access to MySQL. Requires aiomysql.
+    Each event loop has a bounded aiomysql pool per DBMySQLAuth, so many concurrent coroutines share
+    POOL_SIZE connections without a thread each. Connections idle longer than POOL_MAX_LIFETIME are recycled,
+    and aiomysql drops connections the server has closed before handing them out.
+    """
+    pools = weakref.WeakKeyDictionary()     # event loop -> {auth: ((user, password), aiomysql pool)}
+    time_zones = weakref.WeakKeyDictionary()  # aiomysql connection -> session time zone set by csfr()
+
+    @staticmethod
+    async def pool(auth, *, size=POOL_SIZE):
+        """Return the aiomysql pool for auth in the running event loop, creating it if necessary"""
+        if aiomysql is None:
+            raise RuntimeError("DBMySQLAsync requires aiomysql")
+        pools = DBMySQLAsync.pools.setdefault(asyncio.get_running_loop(), {})
+        credentials = (auth.user, auth.password)
+        if auth in pools and pools[auth][0] != credentials:
+            pools.pop(auth)[1].close()        # refresh_secret() changed the credentials
+        if auth not in pools:
+            pool = await aiomysql.create_pool(host=auth.host, port=auth.port, user=auth.user, password=auth.password,
+                                              db=auth.database, minsize=0, maxsize=size, autocommit=True,
+                                              pool_recycle=POOL_MAX_LIFETIME)
+            pools.setdefault(auth, (credentials, pool))
+            if pools[auth][1] is not pool:    # another coroutine created one first
+                pool.close()
+        return pools[auth][1]
+
+    @staticmethod
+    async def close(auth=None):
+        """Close the pools of the running event loop (or just the pool for auth)"""
+        pools = DBMySQLAsync.pools.get(asyncio.get_running_loop(), {})
+        for key in [auth] if auth is not None else list(pools):
+            (credentials, pool) = pools.pop(key, (None, None))
+            if pool is not None:
+                pool.close()
+                await pool.wait_closed()
+
+    @staticmethod
+    async def csfr(auth, cmd, vals=[], *,
+                   quiet=True, rowcount=None, time_zone=None, setup=None, setup_vals=(),
+                   get_column_names=None, asDicts=False, debug=False, dry_run=False, nolog=[], ignore=[],
+                   autocommit=True):
+        """Connect, select, fetchall, and retry as necessary, without blocking the event loop.
+        Takes the same arguments as DBMySQL.csfr() and returns the same results.
+        Coroutines cannot keep a connection between calls, so each call with autocommit=False is its own
+        transaction: setup and cmd are committed together if they succeed and rolled back if they fail.
+        Connections with session state are closed rather than returned to the pool."""
+        stmt = statement_cache.get(cmd)
+        if stmt.nparams != len(vals):
+            raise ValueError(f"cmd={cmd} cmd.count('%s')={stmt.nparams} len(vals)={len(vals)}")
+        if (not quiet) or debug:
+            logging.warning("quiet:%s debug: %s cmd: %s  vals: %s", quiet, debug, cmd, vals)
+            logging.warning("EXPLAIN:")
+            logging.warning(DBMySQL.explain(cmd, vals))
+        if dry_run:
+            logging.warning("Would execute: %s,%s", cmd, vals)
+            return None
+
+        pool = await DBMySQLAsync.pool(auth)
+        for i in range(1, DBMySQL.RETRIES):
+            if i > 2:
+                logging.warning(f"Reconnecting. i={i}")
+            try:
+                conn = await pool.acquire()
+            except pymysql.OperationalError as e:
+                # A rotated secret shows up as access denied when a new connection is opened
+                if (e.args[0] == ER.ACCESS_DENIED_ERROR
+                        and await asyncio.get_running_loop().run_in_executor(None, auth.refresh_secret)):
+                    pool = await DBMySQLAsync.pool(auth)
+                    continue
+                raise
+            event = None
+            error = None
+            try:
+                if conn.get_autocommit() != autocommit:
+                    await conn.autocommit(autocommit)
+                async with conn.cursor() as c:
+                    if time_zone != DBMySQLAsync.time_zones.get(conn):
+                        await c.execute('SET @@session.time_zone = "{}"'.format(time_zone) if time_zone is not None
+                                        else 'SET @@session.time_zone = @@global.time_zone')
+                        DBMySQLAsync.time_zones[conn] = time_zone
+                    try:
+                        if setup is not None:
+                            await c.execute(setup, setup_vals)
+                        t0 = time.time()
+                        event = query_hooks.start(cmd, vals, retries=i - 1, connection_id=conn.thread_id())
+                        await c.execute(cmd, vals)
+                        if debug:
+                            logging.warning("TIME TO EXECUTE: %s", time.time() - t0)
+                        if (rowcount is not None) and (c.rowcount != rowcount):
+                            raise RuntimeError(f"{cmd} {vals} expected rowcount={rowcount} != {c.rowcount}")
+                    except (pymysql.ProgrammingError, pymysql.InternalError,
+                            pymysql.IntegrityError, pymysql.InterfaceError) as e:
+                        if e.args[0] in ignore:
+                            return DBMySQL.IGNORED
+                        if e.args[0] not in nolog:
+                            logging.error("setup: %s", setup)
+                            logging.error("setup_vals: %s", setup_vals)
+                            logging.error("cmd: %s", cmd)
+                            logging.error("vals: %s", vals)
+                            logging.error("explained: %s ", DBMySQL.explain(cmd, vals))
+                            logging.error("auth: %s", auth)
+                            logging.error(str(e))
+                        raise
+
+                    result = None
+                    if stmt.verb in ['SELECT', 'DESCRIBE', 'SHOW']:
+                        result = await c.fetchall()
+                        if asDicts and get_column_names is None:
+                            get_column_names = []
+                        if get_column_names is not None:
+                            get_column_names[:] = [d[0] for d in c.description]
+                        if asDicts:
+                            result = [OrderedDict(zip(get_column_names, row)) for row in result]
+                    elif stmt.verb in ['INSERT']:
+                        result = c.lastrowid
+                    elif stmt.verb in ['UPDATE', 'DELETE']:
+                        result = c.rowcount
+                    if stmt.verb in WRITE_VERBS:
+                        result_cache.invalidate(auth, stmt.tables)
+                    statement_cache.record(stmt, time.time() - t0, c.rowcount)
+                    query_hooks.finish(event, rowcount=c.rowcount)
+                    event = None
+                if not autocommit:
+                    await conn.commit()     # closing the connection below would roll the transaction back
+                if debug:
+                    logging.warning(" result=%s", json.dumps(result, default=str))
+                if i > 2:
+                    logging.warning(f"Success with i={i}")
+                return result
+            except (pymysql.OperationalError, pymysql.InternalError) as e:
+                error = e
+                conn.close()        # the pool discards closed connections
+                logging.error("%s %s in CMD: %s  explained: %s",
+                              e.args[0], e.args[1], cmd, DBMySQL.explain(cmd, vals))
+                if e.args[0] not in ERRORS_NO_RETRY:
+                    raise
+                logging.warning(f"OperationalError. RETRYING {i}/{DBMySQL.RETRIES}: {cmd} {vals} ")
+            except BlockingIOError as e:
+                error = e
+                conn.close()
+                if i > 1:
+                    logging.warning(e)
+                    logging.warning(f"BlockingIOError. RETRYING {i}/{DBMySQL.RETRIES}: {cmd} {vals} ")
+            finally:
+                query_hooks.finish(event, error=error or sys.exc_info()[1])
+                if not autocommit or setup is not None or stmt.verb in SESSION_VERBS:
+                    conn.close()
+                pool.release(conn)
+            await asyncio.sleep(RETRY_DELAY_TIME)
+        raise RuntimeError("Retries Exceeded")
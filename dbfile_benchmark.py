@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Benchmark loading rows into SQLite with dbfile.DBSqlite3.
+
+Compares rows/sec of the default settings with DBSqlite3.ingest() (WAL journaling,
+synchronous=OFF, memory-mapped I/O and deferred index creation), both for row-at-a-time
+csfr() INSERTs and for bulk_insert():
+
+    python dbfile_benchmark.py --rows 200000
+
+The database is a temporary file, so the numbers include the cost of syncing to disk.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from os.path import abspath, dirname
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from ctools.dbfile import DBSqlite3
+
+SCHEMA = """CREATE TABLE extract (id INTEGER, name TEXT, value REAL);
+            CREATE INDEX extract_id ON extract (id);
+            CREATE INDEX extract_name ON extract (name)"""
+INSERT = "INSERT INTO extract (id, name, value) VALUES (%s, %s, %s)"
+
+
+def rows(count):
+    return ((i, f"name{i % 10007}", i * 0.5) for i in range(count))
+
+
+def load_csfr(db, count, commit_every):
+    for (n, row) in enumerate(rows(count), 1):
+        db.csfr(None, INSERT, row)
+        if n % commit_every == 0:
+            db.commit()
+    db.commit()
+
+
+def load_bulk(db, count, commit_every):
+    db.bulk_insert(None, 'extract', rows(count), columns=['id', 'name', 'value'], batch_size=commit_every)
+
+
+def timed(label, count, tempdir, load, ingest, commit_every):
+    fname = os.path.join(tempdir, f"{label}.db")
+    db = DBSqlite3(fname=fname, dicts=False)
+    db.create_schema(SCHEMA)
+    db.commit()
+    t0 = time.time()
+    if ingest:
+        with db.ingest(commit_every=commit_every):
+            load(db, count, commit_every)
+    else:
+        load(db, count, commit_every)
+    t1 = time.time()
+    db.close()
+    print("   {:20} {:12.0f} rows/sec".format(label, count / (t1 - t0)))
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description="Benchmark SQLite loading with and without DBSqlite3.ingest()")
+    parser.add_argument("--rows", type=int, default=100000, help="rows to load in each test")
+    parser.add_argument("--commit_every", type=int, default=10000, help="rows per transaction")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        for (label, load) in [('csfr', load_csfr), ('bulk_insert', load_bulk)]:
+            print(f"{label}:")
+            timed(f"{label}-default", args.rows, tempdir, load, False, args.commit_every)
+            timed(f"{label}-ingest", args.rows, tempdir, load, True, args.commit_every)
@@ -141,14 +141,15 @@ def dpath_exists(path):
     return os.path.exists(path)
 
 
-def dopen(path, mode='r', encoding='utf-8'):
-    """open data relatively to ROOT. Allows opening UFS files or S3 files."""
+def dopen(path, mode='r', encoding='utf-8', cache=False):
+    """open data relatively to ROOT. Allows opening UFS files or S3 files.
+    With cache=True, S3 files are read through the local s3 readthrough cache."""
     logging.info("dopen: path:{} mode:{} encoding:{}".format(
         path, mode, encoding))
     path = dpath_expand(path)
 
     if path[0:5] == 's3://':
-        return s3open(path, mode=mode, encoding=encoding)
+        return s3open(path, mode=mode, encoding=encoding, cache=cache)
 
     if 'b' in mode:
         encoding = None
@@ -7,43 +7,129 @@ import subprocess
 import time
 import re
 import string
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 import queue
 import threading
-import random
+import logging
+import io
+import asyncio
+import itertools
+import hashlib
+import sqlite3
+import datetime
+import glob
+import shutil
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 
 from urllib.parse import urlparse
 
 import boto3
 import botocore
 import botocore.exceptions
+import botocore.config
 
-# note: boto3.resource acquire is not threadsafe, so we create this mutex
+# All S3 calls go through one client per process, built by s3_client() with the settings below.
+# boto3 clients are thread-safe and share a connection pool of MAX_POOL_CONNECTIONS connections.
+# The adaptive retry mode retries throttling (SlowDown) and transient errors with exponential backoff,
+# and rate-limits the client when S3 starts to throttle.
+MAX_POOL_CONNECTIONS = 64
+RETRY_MODE = 'adaptive'
+MAX_ATTEMPTS = 10
+
+# note: boto3 client and resource creation is not threadsafe, so we create this mutex
 boto3_resource_mutex = threading.Lock()
-s3_resources = {}               # per thread
+_clients = {}                   # (pid) -> client; a forked child makes its own
+_thread_local = threading.local()   # per thread resources; released when the thread exits
+
+
+class S3Stats:
+    """Per-operation call, error, retry and latency counters, collected from the client's event hooks"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = defaultdict(lambda: {'calls': 0, 'errors': 0, 'retries': 0, 'total_time': 0.0, 'max_time': 0.0})
+
+    def before_call(self, context, **kwargs):
+        context['ctools_t0'] = time.time()
+
+    def after_call(self, event_name, context, parsed=None, exception=None, **kwargs):
+        # event_name is after-call.s3.<Operation> or after-call-error.s3.<Operation>
+        elapsed = time.time() - context.get('ctools_t0', time.time())
+        metadata = (parsed or {}).get('ResponseMetadata', {})
+        with self.lock:
+            op = self.ops[event_name.rsplit('.', 1)[-1]]
+            op['calls'] += 1
+            op['retries'] += metadata.get('RetryAttempts', 0)
+            op['errors'] += 1 if (exception is not None or 'Error' in (parsed or {})) else 0
+            op['total_time'] += elapsed
+            op['max_time'] = max(op['max_time'], elapsed)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(op) for (name, op) in self.ops.items()}
+
+    def reset(self):
+        with self.lock:
+            self.ops.clear()
+
+
+s3stats = S3Stats()
+
+
+def s3_config():
+    """The botocore Config used for every S3 client and resource"""
+    return botocore.config.Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                                  retries={'mode': RETRY_MODE, 'max_attempts': MAX_ATTEMPTS})
+
+
+def _register_stats(client):
+    """Count the calls made by client in s3stats"""
+    client.meta.events.register('before-call.s3', s3stats.before_call)
+    client.meta.events.register('after-call.s3', s3stats.after_call)
+    client.meta.events.register('after-call-error.s3', s3stats.after_call)
+    return client
+
+
+def s3_client():
+    """Return the s3 client for this process, creating it on first use"""
+    pid = os.getpid()
+    if pid not in _clients:
+        with boto3_resource_mutex:
+            if pid not in _clients:
+                client = _register_stats(boto3.session.Session().client('s3', config=s3_config()))
+                _clients.clear()
+                _clients[pid] = client
+    return _clients[pid]
 
 
 def s3_resource():
-    """Return an s3 resource for this thread."""
-    if threading.get_ident() not in s3_resources:
-        boto3_resource_mutex.acquire()
-        s3_resources[threading.get_ident()] = boto3.resource('s3')
-        boto3_resource_mutex.release()
-    return s3_resources[threading.get_ident()]
+    """Return an s3 resource for this thread. Resources are not thread-safe, so each thread gets its own.
+    Its client has the same configuration and s3stats hooks as s3_client()."""
+    if getattr(_thread_local, 'resource', None) is None:
+        with boto3_resource_mutex:
+            resource = boto3.session.Session().resource('s3', config=s3_config())
+            _register_stats(resource.meta.client)
+            _thread_local.resource = resource
+    return _thread_local.resource
+
+
+def reset_s3_clients():
+    """Discard the cached client and this thread's resource, e.g. after changing the settings above"""
+    with boto3_resource_mutex:
+        _clients.clear()
+        _thread_local.resource = None
+
+
+def s3_stats():
+    """Return {operation: {calls, errors, retries, total_time, max_time}} for S3 calls made by this process"""
+    return s3stats.snapshot()
 
 
 def s3_object(bucket, key):
-    """This sometimes get NoCredentialsError, in which case we retry"""
-    retries = 0
-    while True:
-        try:
-            return s3_resource().Object(bucket, key)
-        except botocore.exceptions.NoCredentialsError as e:
-            print("NoCredentialsError. Waiting and retrying", file=sys.stderr)
-            if retries > 10:
-                raise
-            time.sleep(random.uniform(0, 0.5))
-            retries += 1
+    """Return an s3.Object from this thread's resource. Retries are handled by the client's retry config."""
+    return s3_resource().Object(bucket, key)
 
 
 #
@@ -56,16 +142,33 @@ _Key = 'Key'
 _Size = 'Size'
 _Prefix = 'Prefix'
 
-READ_CACHE_SIZE = 4096  # big enough for front and back caches
 MAX_READ = 65536 * 16
+BLOCK_SIZE = 65536 * 4          # S3File cache block size
+CACHE_BYTES = 65536 * 1024      # S3File cache memory cap (64 MiB)
+READ_AHEAD_BLOCKS = 16          # S3File maximum sequential read-ahead, in blocks
+DOWNLOAD_PART_SIZE = 8 * 1024 * 1024    # range size for parallel downloads
+DOWNLOAD_THREADS = 8                    # concurrent ranges for parallel downloads
+MIN_PART_SIZE = 5 * 1024 * 1024         # smallest part S3 accepts in a multipart upload (except the last)
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024  # largest part S3 accepts in a multipart upload
+MAX_PARTS = 10000                       # most parts S3 accepts in a multipart upload
+PART_GROWTH_PARTS = 1000                # S3MultipartWriter doubles its part size after this many parts
 global debug
 debug = False
 
-READTHROUGH_CACHE_DIR = '/mnt/tmp/s3cache'
+READTHROUGH_CACHE_DIR = os.environ.get('CTOOLS_S3CACHE_DIR', '/mnt/tmp/s3cache')
+READTHROUGH_CACHE_BYTES = 10 * 1024 * 1024 * 1024       # evict least recently used objects above 10 GiB
+READTHROUGH_OPEN_ATTEMPTS = 3                           # times ReadthroughCache.open() fetches a file evicted under it
+READTHROUGH_FILL_MAX_AGE = 3600                         # evict() removes fill files older than this (abandoned fills)
 
 AWS_CLI_LIST = ['/usr/bin/aws', '/usr/local/bin/aws', '/usr/local/aws/bin/aws']
 AWS_CLI = None
 
+# Object operations (put/get/head/delete/list) run in-process with boto3.
+# Set USE_AWS_CLI to True (or CTOOLS_S3_USE_CLI=1 in the environment) to fall back
+# to forking the aws CLI for each call, which is how this module originally worked.
+USE_AWS_CLI = os.environ.get('CTOOLS_S3_USE_CLI', '') not in ('', '0')
+NOT_FOUND_ERRORS = ['404', 'NoSuchKey', 'NoSuchBucket', 'NotFound']
+
 
 def is_hexadecimal(s):
     """Return true if s is hexadecimal string"""
@@ -144,17 +247,36 @@ def aws_s3api(cmd, debug=False):
         raise RuntimeError("s3 api {} failed data: {}".format(cmd, data))
 
 
+def boto3_s3api(method, **kwargs):
+    """In-process equivalent of aws_s3api(). Calls the named client method and returns the
+    response without the ResponseMetadata, so that results look like the CLI's JSON.
+    Missing objects raise FileNotFoundError and other S3 errors raise RuntimeError, as with the CLI."""
+    try:
+        res = getattr(s3_client(), method)(**kwargs)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in NOT_FOUND_ERRORS:
+            raise FileNotFoundError(
+                errno.ENOENT, os.strerror(errno.ENOENT), str(kwargs)) from e
+        raise RuntimeError("boto3_s3api. method={} args={} err={}".format(method, kwargs, e)) from e
+    res.pop('ResponseMetadata', None)
+    return res
+
+
 def getsize(bucket, key):
-    return s3_resource().Object(bucket, key).content_length
+    return s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
 
 
 def put_object(bucket, key, fname, use_acl=False):
     """Given a bucket and a key, upload a file"""
     assert os.path.exists(fname)
-    if use_acl:
-        return aws_s3api(['put-object', '--bucket', bucket, '--key', key, '--body', fname, '--acl', 'bucket-owner-full-control'])
+    if USE_AWS_CLI:
+        if use_acl:
+            return aws_s3api(['put-object', '--bucket', bucket, '--key', key, '--body', fname, '--acl', 'bucket-owner-full-control'])
+        return aws_s3api(['put-object', '--bucket', bucket, '--key', key, '--body', fname])
 
-    return aws_s3api(['put-object', '--bucket', bucket, '--key', key, '--body', fname])
+    extra = {'ACL': 'bucket-owner-full-control'} if use_acl else {}
+    with open(fname, 'rb') as f:
+        return boto3_s3api('put_object', Bucket=bucket, Key=key, Body=f, **extra)
 
 
 def put_s3url(s3url, fname, use_acl=False):
@@ -167,17 +289,29 @@ def get_object(bucket, key, fname):
     """Given a bucket and a key, download a file"""
     if os.path.exists(fname):
         raise FileExistsError(fname)
-    return aws_s3api(['get-object', '--bucket', bucket, '--key', key, fname])
+    if USE_AWS_CLI:
+        return aws_s3api(['get-object', '--bucket', bucket, '--key', key, fname])
+
+    res = boto3_s3api('get_object', Bucket=bucket, Key=key)
+    body = res.pop('Body')
+    with open(fname, 'wb') as f:
+        for chunk in body.iter_chunks(MAX_READ):
+            f.write(chunk)
+    return res
 
 
 def head_object(bucket, key):
     """Wrap the head-object api"""
-    return aws_s3api(['head-object', '--bucket', bucket, '--key', key])
+    if USE_AWS_CLI:
+        return aws_s3api(['head-object', '--bucket', bucket, '--key', key])
+    return boto3_s3api('head_object', Bucket=bucket, Key=key)
 
 
 def delete_object(bucket, key):
     """Wrap the delete-object api"""
-    return aws_s3api(['delete-object', '--bucket', bucket, '--key', key])
+    if USE_AWS_CLI:
+        return aws_s3api(['delete-object', '--bucket', bucket, '--key', key])
+    return boto3_s3api('delete_object', Bucket=bucket, Key=key)
 
 
 def delete_s3url(s3url):
@@ -196,6 +330,10 @@ def list_objects(bucket, prefix=None, limit=None, delimiter=None):
     if bucket.startswith('s3://') and (prefix is None):
         (bucket, prefix) = get_bucket_key(bucket)
 
+    if not USE_AWS_CLI:
+        yield from _list_objects_boto3(bucket, prefix, limit, delimiter)
+        return
+
     next_token = None
     total = 0
     while True:
@@ -227,6 +365,27 @@ def list_objects(bucket, prefix=None, limit=None, delimiter=None):
             return
 
 
+def _list_objects_boto3(bucket, prefix, limit, delimiter):
+    """In-process implementation of list_objects(), page by page, with the same results as the CLI."""
+    kwargs = {'Bucket': bucket, 'Prefix': prefix or '',
+              'PaginationConfig': {'PageSize': PAGE_SIZE}}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    total = 0
+    for page in s3_client().get_paginator('list_objects_v2').paginate(**kwargs):
+        if 'Contents' in page:
+            for data in page['Contents']:
+                yield data
+                total += 1
+                if limit and total >= limit:
+                    return
+        elif 'CommonPrefixes' in page:
+            yield from page['CommonPrefixes']
+            return
+        else:
+            return
+
+
 def search_objects(bucket, prefix=None, *, name, delimiter='/', limit=None, searchFoundPrefixes=True, threads=20,
                    callback=None):
     """Search for occurences of a name. Returns a list of all found keys as dictionaries.
@@ -245,7 +404,7 @@ def search_objects(bucket, prefix=None, *, name, delimiter='/', limit=None, sear
     # accumulates all the objects to be returned by the main thread
     # It's added to by the worker thread.
     found = []
-    s3client = boto3.client('s3')
+    s3client = s3_client()
 
     def worker():
         while True:
@@ -291,6 +450,197 @@ def search_objects(bucket, prefix=None, *, name, delimiter='/', limit=None, sear
     return found
 
 
+SHARD_ALPHABET = [chr(c) for c in range(32, 127)]     # split characters probed by list_objects_sharded
+
+
+def _shard_splits(client, bucket, prefix, shards):
+    """Choose up to shards-1 split strings for list_objects_sharded(). For a group prefix g, one key is sampled
+    after g+c for each character c in SHARD_ALPHABET (one MaxKeys=1 request each, run concurrently), which gives
+    the characters that actually follow g. Starting from prefix, every group is replaced by its sub-groups until
+    there are at least shards groups, so part-00000...part-99999 is split on the digits after "part-" and then
+    on the next digits if needed. The splits are spread evenly over the groups found."""
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        def next_chars(base):
+            def probe(c):
+                page = client.list_objects_v2(Bucket=bucket, Prefix=base, StartAfter=base + c, MaxKeys=1)
+                return [obj[_Key] for obj in page.get('Contents', [])]
+            first = client.list_objects_v2(Bucket=bucket, Prefix=base, MaxKeys=1).get('Contents', [])
+            keys = [obj[_Key] for obj in first] + list(itertools.chain(*pool.map(probe, SHARD_ALPHABET)))
+            return sorted(set(key[len(base)] for key in keys if len(key) > len(base)))
+
+        groups = [prefix]
+        for depth in range(64):
+            if len(groups) >= shards:
+                break
+            expanded = []
+            for group in groups:
+                expanded.extend([group + c for c in next_chars(group)] or [group])
+            if expanded == groups:
+                break
+            groups = expanded
+    # Each shard covers (split[i], split[i+1]]. The first group starts the first shard, so it is not a split.
+    step = max(1, len(groups) / shards)
+    return [groups[int(i * step)] for i in range(1, min(shards, len(groups)))]
+
+
+def list_objects_sharded(bucket, prefix='', *, shards=16, limit=None):
+    """Generator that lists a (flat) prefix in key order, with the keyspace split into up to shards ranges
+    that are listed concurrently with StartAfter. Each range is paged into a small bounded queue,
+    and the ranges are yielded one after another, so memory stays bounded and output order is the same
+    as list_objects(). Useful for prefixes with millions of keys and no delimiter structure."""
+    if bucket.startswith('s3://'):
+        (bucket, prefix) = get_bucket_key(bucket)
+    client = s3_client()
+    splits = _shard_splits(client, bucket, prefix, shards)
+    bounds = list(zip([None] + splits, splits + [None]))
+    queues = [queue.Queue(maxsize=4) for bound in bounds]
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                return q.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def lister(i):
+        (lo, hi) = bounds[i]
+        try:
+            kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': PAGE_SIZE}
+            if lo is not None:
+                kwargs['StartAfter'] = lo
+            while not stop.is_set():
+                page = client.list_objects_v2(**kwargs)
+                contents = page.get('Contents', [])
+                if hi is not None and contents and contents[-1][_Key] > hi:
+                    put(queues[i], [obj for obj in contents if obj[_Key] <= hi])
+                    break
+                put(queues[i], contents)
+                if not page.get('IsTruncated'):
+                    break
+                kwargs['ContinuationToken'] = page['NextContinuationToken']
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            put(queues[i], e)
+        finally:
+            put(queues[i], None)
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=len(bounds)) as pool:
+        futures = [pool.submit(lister, i) for i in range(len(bounds))]
+        try:
+            for (q, future) in zip(queues, futures):
+                while (contents := q.get()) is not None:
+                    if isinstance(contents, Exception):
+                        raise contents
+                    for data in contents:
+                        yield data
+                        total += 1
+                        if limit and total >= limit:
+                            return
+                future.result()     # raises any other error from the lister, rather than skipping its range
+        finally:
+            stop.set()
+
+
+async def list_objects_async(bucket, prefix=None, limit=None, delimiter=None):
+    """Async generator version of list_objects(). Each page is requested in a worker thread,
+    and the next page is requested while the current one is being consumed."""
+    if bucket.startswith('s3://') and (prefix is None):
+        (bucket, prefix) = get_bucket_key(bucket)
+    client = s3_client()
+    kwargs = {'Bucket': bucket, 'Prefix': prefix or '', 'MaxKeys': PAGE_SIZE}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    total = 0
+    task = asyncio.ensure_future(asyncio.to_thread(client.list_objects_v2, **kwargs))
+    try:
+        while task is not None:
+            page = await task
+            task = None
+            if page.get('IsTruncated'):
+                task = asyncio.ensure_future(asyncio.to_thread(client.list_objects_v2, **kwargs,
+                                                               ContinuationToken=page['NextContinuationToken']))
+            for data in page.get('Contents', []) or page.get('CommonPrefixes', []):
+                yield data
+                total += 1
+                if limit and total >= limit:
+                    return
+    finally:
+        if task is not None:
+            task.cancel()
+
+
+async def search_objects_async(bucket, prefix=None, *, name, delimiter='/', limit=None, concurrency=20):
+    """Async generator version of search_objects(). Yields each object whose basename is name
+    (or every object if name is None) as soon as its page is listed.
+    Prefixes are walked concurrently, with at most concurrency list requests outstanding at once;
+    each request runs in a worker thread, so the number of threads is bounded by concurrency
+    no matter how many prefixes are found. Stops listing as soon as limit objects have been yielded.
+    """
+    client = s3_client()
+    sem = asyncio.Semaphore(concurrency)
+    results = asyncio.Queue(maxsize=concurrency * PAGE_SIZE)      # back-pressure on the walkers
+    tasks = set()
+    done = object()
+    outstanding = 0
+
+    async def walk(prefix):
+        nonlocal outstanding
+        try:
+            kwargs = {'Bucket': bucket, 'Prefix': prefix or '', 'Delimiter': delimiter, 'MaxKeys': PAGE_SIZE}
+            while True:
+                async with sem:
+                    page = await asyncio.to_thread(client.list_objects_v2, **kwargs)
+                for obj in page.get('CommonPrefixes', []):
+                    spawn(obj['Prefix'])
+                for obj in page.get('Contents', []):
+                    if (name is None) or (os.path.basename(obj['Key']) == name):
+                        await results.put(obj)
+                if not page.get('IsTruncated'):
+                    break
+                kwargs['ContinuationToken'] = page['NextContinuationToken']
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            await results.put(e)
+        finally:
+            outstanding -= 1
+            if outstanding == 0:
+                await results.put(done)
+
+    def finished(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    def spawn(prefix):
+        nonlocal outstanding
+        outstanding += 1
+        task = asyncio.ensure_future(walk(prefix))
+        tasks.add(task)
+        task.add_done_callback(finished)
+
+    errors = []     # other errors from walkers, so that a failed prefix is not silently skipped
+    spawn(prefix)
+    count = 0
+    try:
+        while True:
+            obj = await results.get()
+            if obj is done:
+                await asyncio.sleep(0)      # let the last walker's finished() callback run
+            if errors:
+                raise errors[0]
+            if obj is done:
+                return
+            if isinstance(obj, Exception):
+                raise obj
+            yield obj
+            count += 1
+            if limit is not None and count >= limit:
+                return
+    finally:
+        for task in list(tasks):
+            task.cancel()
+
+
 def etag(obj):
     """Return the ETag of an object. It is a known bug that the S3 API returns ETags wrapped in quotes
     see https://github.com/aws/aws-sdk-net/issue/815"""
@@ -310,12 +660,104 @@ def sum_object_sizes(sobjs):
     return sum(object_sizes(sobjs))
 
 
+MIN_MULTIPART_COMBINE_OBJECT_SIZE = MIN_PART_SIZE     # smaller objects cannot be copied as their own part
+MAX_COPY_PART_SIZE = 5 * 1024 * 1024 * 1024           # largest part UploadPartCopy accepts
+
+
 def any_object_too_small(sobjs):
     """Return if any of the objects in sobjs is too small"""
-    MIN_MULTIPART_COMBINE_OBJECT_SIZE = 0
     return any([size < MIN_MULTIPART_COMBINE_OBJECT_SIZE for size in object_sizes(sobjs)])
 
 
+def _combine_parts(sobjs):
+    """Plan the parts of combine_objects(). Returns a list with, for each part, either ('copy', obj, start, end)
+    for a range copied server-side, or ('upload', ranges) for a list of small (obj, start, end) ranges that are
+    downloaded and concatenated."""
+    parts = []
+    ranges = []
+    buffered = 0
+
+    def flush():
+        nonlocal ranges, buffered
+        parts.append(('upload', ranges))
+        ranges = []
+        buffered = 0
+
+    for obj in sobjs:
+        size = obj[_Size]
+        start = 0
+        if size >= MIN_MULTIPART_COMBINE_OBJECT_SIZE and ranges:
+            # Top up the buffer from the head of this object so that it is a valid part
+            start = MIN_PART_SIZE - buffered
+            ranges.append((obj, 0, start))
+            flush()
+        if size - start < MIN_PART_SIZE:
+            if size > start:
+                ranges.append((obj, start, size))
+                buffered += size - start
+            if buffered >= MIN_PART_SIZE:
+                flush()
+            continue
+        while start < size:
+            end = min(start + MAX_COPY_PART_SIZE, size)
+            if size - end < MIN_PART_SIZE:
+                end = size - MIN_PART_SIZE if size > end else size    # don't leave a tail too small to copy
+            parts.append(('copy', obj, start, end))
+            start = end
+    if ranges or not parts:
+        flush()
+    return parts
+
+
+def combine_objects(bucket, sobjs, key, *, dest_bucket=None, threads=DOWNLOAD_THREADS):
+    """Concatenate the objects sobjs (dictionaries from list_objects(), in order) into s3://dest_bucket/key
+    with a multipart upload, without using local disk. Objects of at least MIN_MULTIPART_COMBINE_OBJECT_SIZE
+    are copied server-side with UploadPartCopy, running concurrently. Smaller objects are downloaded into
+    memory and coalesced into uploaded parts; when such a buffer comes before a large object, just enough of
+    the large object's head is downloaded to make the buffer a valid part, and the rest is copied.
+    Raises ValueError, before anything is uploaded, if this would take more than MAX_PARTS parts.
+    Returns the ETag of the new object.
+    """
+    dest_bucket = dest_bucket or bucket
+    plan = _combine_parts(sobjs)
+    if len(plan) > MAX_PARTS:
+        raise ValueError(f"combining {len(sobjs)} objects into s3://{dest_bucket}/{key} "
+                         f"would take {len(plan)} parts; S3 allows {MAX_PARTS}")
+    client = s3_client()
+    upload_id = client.create_multipart_upload(Bucket=dest_bucket, Key=key)['UploadId']
+
+    def download(obj, start, end):
+        return client.get_object(Bucket=bucket, Key=obj[_Key], Range=f'bytes={start}-{end - 1}')['Body'].read()
+
+    def copy_part(part_number, obj, start, end):
+        resp = client.upload_part_copy(Bucket=dest_bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                       CopySource={'Bucket': bucket, 'Key': obj[_Key]},
+                                       CopySourceRange=f'bytes={start}-{end - 1}')
+        return {'PartNumber': part_number, 'ETag': resp['CopyPartResult']['ETag']}
+
+    def upload_part(part_number, data):
+        resp = client.upload_part(Bucket=dest_bucket, Key=key, UploadId=upload_id,
+                                  PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': resp['ETag']}
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = []
+            for (part_number, part) in enumerate(plan, 1):
+                if part[0] == 'copy':
+                    futures.append(pool.submit(copy_part, part_number, *part[1:]))
+                else:
+                    data = b''.join(download(obj, start, end) for (obj, start, end) in part[1])
+                    futures.append(pool.submit(upload_part, part_number, data))
+            parts = [future.result() for future in futures]
+        resp = client.complete_multipart_upload(Bucket=dest_bucket, Key=key, UploadId=upload_id,
+                                                MultipartUpload={'Parts': parts})
+    except BaseException:
+        client.abort_multipart_upload(Bucket=dest_bucket, Key=key, UploadId=upload_id)
+        raise
+    return resp['ETag']
+
+
 def download_object(tempdir, bucket, obj):
     """Given a dictionary that defines an object, download it, and set the fname property to be where it was downloaded"""
     if 'fname' not in obj:
@@ -340,10 +782,305 @@ def concat_downloaded_objects(obj1, obj2):
     return
 
 
+# Error codes meaning S3 Select is not available for this account, bucket or object
+SELECT_UNSUPPORTED_ERRORS = ['MethodNotAllowed', 'NotImplemented', 'UnsupportedOperation']
+
+
+def s3select(bucket, key, expression, *, delimiter=',', header=False):
+    """Run an S3 Select SQL expression over a delimited text object (gzipped if key ends .gz), so that only
+    the selected columns and rows are transferred. The request is made immediately, so errors are raised
+    here; returns a generator of the result records as text lines in the same delimited format.
+    :param header: True if the first line of the object names the columns (they can then be used in expression).
+    """
+    resp = s3_client().select_object_content(
+        Bucket=bucket, Key=key, Expression=expression, ExpressionType='SQL',
+        InputSerialization={'CSV': {'FileHeaderInfo': 'USE' if header else 'NONE', 'FieldDelimiter': delimiter},
+                            'CompressionType': 'GZIP' if key.endswith('.gz') else 'NONE'},
+        OutputSerialization={'CSV': {'FieldDelimiter': delimiter}})
+
+    def records():
+        # Records events are not aligned to lines, so carry the partial last line over to the next event
+        partial = b''
+        for event in resp['Payload']:
+            if 'Records' in event:
+                lines = (partial + event['Records']['Payload']).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8')
+        if partial:
+            yield partial.decode('utf-8')
+    return records()
+
+
+def iter_ranges(bucket, key, start=0, end=None, *, etag=None, part_size=DOWNLOAD_PART_SIZE,
+                threads=DOWNLOAD_THREADS, client=None):
+    """Download bytes [start,end) of an object as a series of ranges fetched concurrently on a thread pool.
+    Yields the ranges in order. At most 2*threads ranges are in flight or waiting to be consumed, so memory
+    stays bounded and a slow consumer stops new requests from being issued (back-pressure).
+    If etag is given (or end is not), every range is requested with If-Match so that a concurrent
+    overwrite of the object raises an error rather than returning a mix of two versions.
+    """
+    client = client or s3_client()
+    if end is None:
+        head = client.head_object(Bucket=bucket, Key=key)
+        end = head['ContentLength']
+        etag = etag or head['ETag']
+    extra = {'IfMatch': etag} if etag else {}
+
+    def fetch(offset):
+        resp = client.get_object(Bucket=bucket, Key=key,
+                                 Range=f'bytes={offset}-{min(offset + part_size, end) - 1}', **extra)
+        return resp['Body'].read()
+
+    yield from _map_bounded(fetch, range(start, end, part_size), threads)
+
+
+class S3ParallelReader(io.RawIOBase):
+    """A read-only, non-seekable stream over an S3 object that is downloaded with iter_ranges().
+    Wrap it in io.BufferedReader (and io.TextIOWrapper for text); s3open() does this for reads."""
+
+    def __init__(self, path, *, part_size=DOWNLOAD_PART_SIZE, threads=DOWNLOAD_THREADS):
+        super().__init__()
+        (bucket, key) = get_bucket_key(path)
+        self.parts = iter_ranges(bucket, key, part_size=part_size, threads=threads)
+        self.buf = memoryview(b'')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos >= len(self.buf):
+            try:
+                self.buf = memoryview(next(self.parts))
+            except StopIteration:
+                return 0
+            self.pos = 0
+        n = min(len(b), len(self.buf) - self.pos)
+        b[:n] = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.parts.close()  # cancels ranges that have not started
+        super().close()
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """A write-only stream that uploads to S3 with a multipart upload. Data is buffered into parts of
+    part_size bytes, and each full part is uploaded on a thread pool while the caller keeps writing.
+    At most 2*threads parts are buffered; further writes block until a part finishes (back-pressure).
+    Objects smaller than one part are sent with a single PutObject. close() completes the upload and
+    returns the ETag; abort() discards everything written and aborts the multipart upload.
+    S3 accepts at most MAX_PARTS parts, so the part size doubles (up to MAX_PART_SIZE) after every
+    PART_GROWTH_PARTS parts; with the default part size, objects of several TiB fit. A write that would need
+    more than MAX_PARTS parts raises ValueError.
+    """
+
+    def __init__(self, path, *, part_size=DOWNLOAD_PART_SIZE, threads=DOWNLOAD_THREADS, client=None):
+        super().__init__()
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE}")
+        (self.bucket, self.key) = get_bucket_key(path)
+        self.part_size = part_size
+        self.threads = threads
+        self.client = client or s3_client()
+        self.buf = bytearray()
+        self.upload_id = None
+        self.pool = None
+        self.pending = deque()          # futures for parts being uploaded
+        self.parts = []                 # completed parts
+        self.aborted = False
+        self.etag = None
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.aborted:
+            return len(b)       # discard whatever is flushed after an abort
+        self.buf += b
+        while len(self.buf) >= self.part_size:
+            size = self.part_size
+            self._upload_part(bytes(self.buf[:size]))
+            del self.buf[:size]
+        return len(b)
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        part_number = len(self.parts) + len(self.pending) + 1
+        if part_number > MAX_PARTS:
+            raise ValueError(f"{self.key}: more than {MAX_PARTS} parts; use a larger part_size")
+        if part_number % PART_GROWTH_PARTS == 0:
+            self.part_size = min(self.part_size * 2, MAX_PART_SIZE)
+        while len(self.pending) >= self.threads * 2:
+            self.parts.append(self.pending.popleft().result())
+
+        def upload():
+            resp = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': resp['ETag']}
+        self.pending.append(self.pool.submit(upload))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.aborted:
+                pass
+            elif self.upload_id is None:
+                self.etag = self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buf))['ETag']
+            else:
+                try:
+                    if self.buf:
+                        self._upload_part(bytes(self.buf))
+                    while self.pending:
+                        self.parts.append(self.pending.popleft().result())
+                    resp = self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                                 UploadId=self.upload_id,
+                                                                 MultipartUpload={'Parts': self.parts})
+                    self.etag = resp['ETag']
+                except Exception:
+                    self.abort()
+                    raise
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+            self.buf = bytearray()
+            super().close()
+        return self.etag
+
+    def abort(self):
+        """Abandon the upload. Nothing is written to S3."""
+        self.aborted = True
+        self.buf = bytearray()
+        for future in self.pending:
+            future.cancel()
+        if self.pool:
+            self.pool.shutdown()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+
+class ReadthroughCache:
+    """A local, on-disk read-through cache of S3 objects, keyed by bucket, key and ETag, so a changed
+    object is never served stale. Fills are downloaded to a temporary file in the cache directory and
+    renamed into place, so concurrent processes sharing a cache directory never see a partial file
+    (at worst two processes download the same object once each). Each hit touches the file's mtime;
+    when the directory grows past max_bytes, the least recently used files are removed, but never the file
+    just filled. Another process may evict a file at any time, so use open() rather than opening the path
+    returned by get(): an open file can still be read after it is removed.
+    """
+
+    def __init__(self, directory=READTHROUGH_CACHE_DIR, max_bytes=READTHROUGH_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, bucket, key, etag):
+        digest = hashlib.sha256(f"{bucket}/{key}/{etag}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[0:2], digest)
+
+    def get(self, bucket, key, etag=None):
+        """Return the path of a local copy of s3://bucket/key, downloading it if necessary"""
+        if etag is None:
+            etag = s3_client().head_object(Bucket=bucket, Key=key)['ETag']
+        path = self.path_for(bucket, key, etag)
+        try:
+            os.utime(path)
+            self.hits += 1
+            return path
+        except FileNotFoundError:
+            pass
+
+        self.misses += 1
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.fill-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in iter_ranges(bucket, key, etag=etag):
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def open(self, bucket, key, etag=None):
+        """Return the local copy of s3://bucket/key opened for binary reading, downloading it if necessary.
+        If another process evicts the file between get() and opening it, it is fetched again."""
+        if etag is None:
+            etag = s3_client().head_object(Bucket=bucket, Key=key)['ETag']
+        for attempt in range(READTHROUGH_OPEN_ATTEMPTS):
+            try:
+                return open(self.get(bucket, key, etag), 'rb')
+            except FileNotFoundError as e:
+                error = e
+        raise error
+
+    def evict(self, keep=None):
+        """Remove least recently used files until the cache is no larger than max_bytes. keep is never removed.
+        Temporary fill files older than READTHROUGH_FILL_MAX_AGE, left by processes that died while
+        downloading, are removed too."""
+        entries = []
+        now = time.time()
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                    if fname.startswith('.fill-'):
+                        if now - st.st_mtime > READTHROUGH_FILL_MAX_AGE:
+                            os.unlink(path)
+                        continue
+                except FileNotFoundError:
+                    continue    # evicted or renamed by another process
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_readthrough_cache = None
+
+
+def readthrough_cache():
+    """Return the process-wide ReadthroughCache in READTHROUGH_CACHE_DIR"""
+    global _readthrough_cache
+    if _readthrough_cache is None or _readthrough_cache.directory != READTHROUGH_CACHE_DIR:
+        _readthrough_cache = ReadthroughCache(READTHROUGH_CACHE_DIR, READTHROUGH_CACHE_BYTES)
+    return _readthrough_cache
+
+
 class S3File:
-    """Open an S3 file that can be seeked. This is done by caching to the local file system."""
+    """Open an S3 file that can be seeked. Reads are served from an in-memory LRU cache of
+    fixed-size blocks. Sequential reads are detected and the read-ahead window grows, so that
+    a stream of small reads becomes a few large ranged GETs, while random seeks (zipfile, parquet)
+    only fetch the blocks they touch.
+    :param block_size: size of each cached block, in bytes.
+    :param cache_bytes: maximum memory used by the cache; least recently used blocks are evicted.
+    :param read_ahead: maximum number of blocks fetched in one request when reading sequentially.
+    :param cache: if True, the object is copied to the readthrough_cache() and read from local disk.
+    """
 
-    def __init__(self, name, mode='rb'):
+    def __init__(self, name, mode='rb', *, block_size=BLOCK_SIZE, cache_bytes=CACHE_BYTES, read_ahead=READ_AHEAD_BLOCKS,
+                 cache=False):
         self.name = name
         self.url = urlparse(name)
         if self.url.scheme != 's3':
@@ -352,68 +1089,109 @@ class S3File:
         self.bucket = self.url.netloc
         self.key = self.url.path[1:]
         self.fpos = 0
-        self.tf = tempfile.NamedTemporaryFile()
-        self.s3client = boto3.client('s3')
-        self.obj = self.s3client.get_object(Bucket=self.bucket, Key=self.key)
+        self.s3client = s3_client()
+        self.obj = self.s3client.head_object(Bucket=self.bucket, Key=self.key)
         self.length = self.obj['ContentLength']
         self.ETag = self.obj['ETag']
-
-        # Load the caches
-        # read the first 1024 bytes and get length of the file
-        self.frontcache = self._readrange(0, READ_CACHE_SIZE)
-        if self.length > READ_CACHE_SIZE:
-            self.backcache_start = self.length - READ_CACHE_SIZE
-            if debug:
-                print("backcache starts at {}".format(self.backcache_start))
-            self.backcache = self._readrange(
-                self.backcache_start, READ_CACHE_SIZE)
-        else:
-            self.backcache = None
+        self.localfile = None
+        if cache:
+            self.localfile = readthrough_cache().open(self.bucket, self.key, self.ETag)
+
+        self.block_size = block_size
+        self.max_blocks = max(1, cache_bytes // block_size)
+        self.read_ahead = max(1, min(read_ahead, self.max_blocks))
+        self.blocks = OrderedDict()      # block number -> bytes, in LRU order
+        self.window = 1                  # current read-ahead window, in blocks
+        self.last_block = None
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.bytes_fetched = 0
 
     def _readrange(self, start, length):
-        # This is gross; we copy everything to the named temporary file, rather than a pipe
-        # because the pipes weren't showing up in /dev/fd/?
-        # We probably want to cache also... That's coming
+        if self.localfile is not None:
+            self.localfile.seek(start)
+            return self.localfile.read(length)
         resp = self.s3client.get_object(
             Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{start+length-1}')
         data = resp['Body'].read()
+        self.requests += 1
+        self.bytes_fetched += len(data)
         return data
 
+    def _fetch_blocks(self, first, count):
+        """Fetch count blocks starting at block first with a single ranged GET and cache them"""
+        start = first * self.block_size
+        data = self._readrange(start, min(count * self.block_size, self.length - start))
+        for i in range(count):
+            block = data[i * self.block_size:(i + 1) * self.block_size]
+            if not block:
+                break
+            self.blocks[first + i] = block
+            self.blocks.move_to_end(first + i)
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+    def _get_block(self, n):
+        # Grow the read-ahead window while the caller walks the file in order; reset it on a seek.
+        if self.last_block is not None and n == self.last_block + 1:
+            self.window = min(self.window * 2, self.read_ahead)
+        elif n != self.last_block:
+            self.window = 1
+        self.last_block = n
+
+        if n in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(n)
+            return self.blocks[n]
+
+        self.misses += 1
+        last = (self.length - 1) // self.block_size
+        count = 1
+        while count < self.window and n + count <= last and (n + count) not in self.blocks:
+            count += 1
+        if debug:
+            print("fetch blocks {}..{}".format(n, n + count - 1))
+        self._fetch_blocks(n, count)
+        return self.blocks[n]
+
+    def cache_stats(self):
+        """Return a dictionary of the cache counters, for tuning block_size and cache_bytes"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'requests': self.requests,
+                'bytes_fetched': self.bytes_fetched,
+                'cached_blocks': len(self.blocks),
+                'block_size': self.block_size}
+
     def __repr__(self):
         return "FakeFile<name:{} url:{}>".format(self.name, self.url)
 
     def read(self, length=-1):
         # If length==-1, figure out the max we can read to the end of the file
         if length == -1:
-            length = min(MAX_READ, self.length - self.fpos + 1)
+            length = MAX_READ
+        length = max(0, min(length, self.length - self.fpos))
 
         if debug:
             print("read: fpos={}  length={}".format(self.fpos, length))
-        # Can we satisfy from the front cache?
-        if self.fpos < READ_CACHE_SIZE and self.fpos + length < READ_CACHE_SIZE:
-            if debug:
-                print("front cache")
-            buf = self.frontcache[self.fpos:self.fpos + length]
+        if length >= DOWNLOAD_PART_SIZE * 2 and self.localfile is None:
+            # Large reads bypass the cache and are fetched in parallel
+            buf = b''.join(iter_ranges(self.bucket, self.key, self.fpos, self.fpos + length,
+                                       etag=self.ETag, client=self.s3client))
             self.fpos += len(buf)
-            if debug:
-                print("return 1: buf=", buf)
             return buf
-
-        # Can we satisfy from the back cache?
-        if self.backcache and (self.length - READ_CACHE_SIZE < self.fpos):
-            if debug:
-                print("back cache")
-            buf = self.backcache[self.fpos -
-                                 self.backcache_start:self.fpos - self.backcache_start + length]
+        parts = []
+        while length > 0:
+            (n, offset) = divmod(self.fpos, self.block_size)
+            block = self._get_block(n)
+            buf = block[offset:offset + length]
+            parts.append(buf)
             self.fpos += len(buf)
-            if debug:
-                print("return 2: buf=", buf)
-            return buf
-
-        buf = self._readrange(self.fpos, length)
-        self.fpos += len(buf)
+            length -= len(buf)
+        buf = b''.join(parts)
         if debug:
-            print("return 3: buf=", buf)
+            print("return: buf=", buf)
         return buf
 
     def seek(self, offset, whence=0):
@@ -429,6 +1207,7 @@ class S3File:
             raise RuntimeError("whence={}".format(whence))
         if debug:
             print("   ={}  (self.length={})".format(self.fpos, self.length))
+        return self.fpos
 
     def seekable(self):
         return True
@@ -443,8 +1222,92 @@ class S3File:
         raise RuntimeError("Flush not supported")
 
     def close(self):
+        self.blocks.clear()
+        if self.localfile is not None:
+            self.localfile.close()
         return
 
+
+#
+# Input splits: process a large text object as independent line-aligned byte ranges,
+# the way Hadoop and Spark divide their input, but with a local process pool.
+#
+SPLIT_PROBE_SIZE = 65536        # bytes read at a time when looking for the newline after a split point
+SPLIT_TARGET_BYTES = 128 * 1024 * 1024  # map_line_splits() makes ranges no larger than this by default
+
+
+def _next_line_start(f, pos):
+    """Return the first offset >= pos in S3File f at which a line starts"""
+    if pos <= 0:
+        return 0
+    start = pos - 1
+    while start < f.length:
+        data = f._readrange(start, min(SPLIT_PROBE_SIZE, f.length - start))
+        i = data.find(b'\n')
+        if i >= 0:
+            return start + i + 1
+        start += len(data)
+    return f.length
+
+
+def line_splits(path, splits, *, max_split_bytes=None):
+    """Divide the S3 object at path into at most splits byte ranges (start, end) of roughly equal size.
+    Every range begins at the start of a line and ends just after a newline (or at the end of the object),
+    so the ranges can be read independently and together contain every line exactly once.
+    If max_split_bytes is given, splits is raised so that the ranges are about that size or smaller.
+    """
+    f = S3File(path)
+    if max_split_bytes:
+        splits = max(splits, (f.length + max_split_bytes - 1) // max_split_bytes)
+    bounds = [0]
+    for i in range(1, splits):
+        pos = _next_line_start(f, max(f.length * i // splits, bounds[-1]))
+        if pos >= f.length:
+            break
+        if pos > bounds[-1]:
+            bounds.append(pos)
+    bounds.append(f.length)
+    f.close()
+    return [(start, end) for (start, end) in zip(bounds, bounds[1:]) if start < end]
+
+
+def iter_split_lines(path, start, end, *, encoding='utf-8', chunk_size=DOWNLOAD_PART_SIZE):
+    """Yield the lines in the byte range [start, end) of the S3 object at path, as str with their newlines.
+    The range should come from line_splits(). It is fetched chunk_size bytes at a time."""
+    f = S3File(path)
+    partial_line = b''
+    while start < end:
+        data = f._readrange(start, min(chunk_size, end - start))
+        start += len(data)
+        lines = (partial_line + data).split(b'\n')
+        partial_line = lines.pop()
+        for line in lines:
+            yield line.decode(encoding) + '\n'
+    if partial_line:
+        yield partial_line.decode(encoding)
+    f.close()
+
+
+def _call_split(func, path, split):
+    return func(path, *split)
+
+
+def map_line_splits(path, func, *, splits=None, processes=None):
+    """Call func(path, start, end) for the line_splits() of the S3 object at path in a pool of worker processes
+    and yield the results in split order. func must be picklable (a module-level function or a partial of one);
+    it typically reads its range with iter_split_lines() and returns the parsed records.
+    :param splits: number of ranges; defaults to four per process, so that uneven ranges balance out, or
+                   more for a large object, so that no range is over SPLIT_TARGET_BYTES and a worker's
+                   result for one range fits in memory.
+    :param processes: number of worker processes; defaults to os.cpu_count().
+    """
+    processes = processes or os.cpu_count()
+    if splits:
+        ranges = line_splits(path, splits)
+    else:
+        ranges = line_splits(path, processes * 4, max_split_bytes=SPLIT_TARGET_BYTES)
+    yield from _map_bounded(partial(_call_split, func, path), ranges, processes, executor=ProcessPoolExecutor)
+
 #
 # S3 Cache
 #
@@ -458,7 +1321,8 @@ class S3File:
 
 
 class s3open:
-    def __init__(self, path, mode="r", encoding=sys.getdefaultencoding(), fsync=False):
+    def __init__(self, path, mode="r", encoding=sys.getdefaultencoding(), fsync=False,
+                 threads=DOWNLOAD_THREADS, part_size=DOWNLOAD_PART_SIZE, cache=False):
         """
         Open an s3 file for reading or writing. Can handle any size, but cannot seek.
         We could use boto3 or one of these packages:
@@ -468,7 +1332,15 @@ class s3open:
         This is legacy code from when we had systems that would not work with boto3.
 
         2020-02-17 - Removed file cache
+        2026-10-17 - Added the ETag-keyed readthrough_cache(), enabled with cache=True for reads
         :param fsync: if True and mode is writing, use object-exists to wait for the object to be created on exit.
+                      Only needed with USE_AWS_CLI; the multipart writer has created the object when it closes.
+        :param threads: the number of byte ranges (reading) or parts (writing) transferred concurrently.
+        :param part_size: the size of each byte range or part. Parts must be at least MIN_PART_SIZE.
+        :param cache: for reading, copy the object to the readthrough_cache() and read the local copy.
+
+        When writing, the ETag of the new object is available as .etag after the file is closed,
+        and is returned by close(). An exception inside a with statement aborts the upload.
         """
         if not path.startswith("s3://"):
             raise ValueError("Invalid path: " + path)
@@ -480,17 +1352,39 @@ class s3open:
         self.mode = mode
         self.encoding = encoding
         self.fsync = fsync
+        self.writer = None
 
         assert 'a' not in mode
         assert '+' not in mode
 
-        if "r" in mode:
+        if "r" in mode and cache:
+            self.p = None
+            (bucket, key) = get_bucket_key(path)
+            self.file_obj = readthrough_cache().open(bucket, key)
+            if "b" not in mode:
+                self.file_obj = io.TextIOWrapper(self.file_obj, encoding=encoding)
+
+        elif "r" in mode and not USE_AWS_CLI:
+            self.p = None
+            self.file_obj = io.BufferedReader(S3ParallelReader(path, part_size=part_size, threads=threads),
+                                              buffer_size=MAX_READ)
+            if encoding:
+                self.file_obj = io.TextIOWrapper(self.file_obj, encoding=encoding)
+
+        elif "r" in mode:
             self.p = subprocess.Popen([awscli(), 's3', 'cp', '--quiet', path, '-'],
                                       stdout=subprocess.PIPE,
                                       stderr=subprocess.PIPE,
                                       encoding=encoding)
             self.file_obj = self.p.stdout
 
+        elif "w" in mode and not USE_AWS_CLI:
+            self.p = None
+            self.writer = S3MultipartWriter(path, part_size=part_size, threads=threads)
+            self.file_obj = io.BufferedWriter(self.writer, buffer_size=MAX_READ)
+            if encoding:
+                self.file_obj = io.TextIOWrapper(self.file_obj, encoding=encoding)
+
         elif "w" in mode:
             self.p = subprocess.Popen([awscli(), 's3', 'cp', '--quiet', '-', path],
                                       stdin=subprocess.PIPE, encoding=encoding)
@@ -502,14 +1396,21 @@ class s3open:
         return self.file_obj
 
     def __exit__(self, exception_type, exception_value, traceback):
+        if self.writer is not None and exception_type is not None:
+            self.writer.abort()
         self.file_obj.close()
-        if self.fsync and "w" in self.mode:
+        if self.fsync and "w" in self.mode and self.p is not None:
             if self.p.wait() != 0:
                 raise RuntimeError(self.p.stderr.read())
             self.waitObjectExists()
 
+    @property
+    def etag(self):
+        """ETag of the object that was written, once it has been closed"""
+        return self.writer.etag if self.writer is not None else None
+
     def waitObjectExists(self):
-        if self.fsync and "w" in self.mode:
+        if self.fsync and "w" in self.mode and self.p is not None:
             (bucket, key) = get_bucket_key(self.path)
             aws_s3api(['wait', 'object-exists',
                       '--bucket', bucket, '--key', key])
@@ -529,7 +1430,8 @@ class s3open:
 
     def close(self):
         self.waitObjectExists()
-        return self.file_obj.close()
+        self.file_obj.close()
+        return self.etag
 
 
 def s3exists(path):
@@ -539,7 +1441,7 @@ def s3exists(path):
     """
     (bucket, key) = get_bucket_key(path)
     try:
-        s3_resource().Object(bucket, key).load()
+        s3_client().head_object(Bucket=bucket, Key=key)
         return True
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == '404':
@@ -552,18 +1454,287 @@ def s3exists(path):
 def s3rm(path):
     """Remove an S3 object"""
     (bucket, key) = get_bucket_key(path)
-    res = aws_s3api(['delete-object', '--bucket', bucket, '--key', key])
-    print("res:", res)
+    res = delete_object(bucket, key)
+    logging.debug("s3rm %s res: %s", path, res)
     # delete-object return no output in Staging, even though it successfully deleted the key
     # This is likely because bucket versioning is not enabled in Staging
     # See https://wiki.outscale.net/display/EN/Removing+Objects+from+a+Bucket
     # This results in an empty byte string when returned from aws_s3api
-    if res == b'' or res['DeleteMarker'] == True:
+    # The in-process path returns an empty dictionary in the same case.
+    if res == b'' or res == {} or res.get('DeleteMarker') == True:
         return
 
     raise RuntimeError("Unknown response from delete-object: {}".format(res))
 
 
+DELETE_BATCH_SIZE = 1000        # most keys DeleteObjects accepts in one request
+BATCH_THREADS = 16
+
+
+def _map_bounded(func, iterable, threads, executor=ThreadPoolExecutor):
+    """Like ThreadPoolExecutor.map, but consumes iterable lazily with at most 2*threads calls outstanding,
+    so it can be fed an iterator of millions of items. Yields the results in order.
+    Pass executor=ProcessPoolExecutor to run func in worker processes."""
+    items = iter(iterable)
+    with executor(max_workers=threads) as pool:
+        pending = deque(pool.submit(func, item) for item in itertools.islice(items, threads * 2))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for item in itertools.islice(items, 1):
+                    pending.append(pool.submit(func, item))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _batched(iterable, n):
+    items = iter(iterable)
+    while batch := list(itertools.islice(items, n)):
+        yield batch
+
+
+def _key_of(obj):
+    """Keys may be given as strings or as dictionaries from list_objects()"""
+    return obj[_Key] if isinstance(obj, dict) else obj
+
+
+def delete_objects(bucket, keys, *, threads=BATCH_THREADS):
+    """Delete many objects with DeleteObjects, DELETE_BATCH_SIZE keys per request, with up to
+    threads requests running at once. keys may be any iterable of keys or list_objects() dictionaries,
+    e.g. delete_objects(bucket, list_objects(bucket, prefix)). Returns the number of objects deleted;
+    raises RuntimeError listing the failures if any key could not be deleted."""
+    client = s3_client()
+
+    def delete_batch(batch):
+        resp = client.delete_objects(Bucket=bucket,
+                                     Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        return (len(batch), resp.get('Errors', []))
+
+    deleted = 0
+    errors = []
+    for (count, errs) in _map_bounded(delete_batch, _batched(map(_key_of, keys), DELETE_BATCH_SIZE), threads):
+        deleted += count - len(errs)
+        errors.extend(errs)
+    if errors:
+        raise RuntimeError("delete_objects: {} keys not deleted, e.g. {}".format(len(errors), errors[0:10]))
+    return deleted
+
+
+def head_objects(bucket, keys, *, threads=BATCH_THREADS):
+    """Run HEAD on many objects, with up to threads requests running at once. keys may be any iterable of
+    keys or list_objects() dictionaries. Returns a dictionary mapping each key to its size, or to None
+    if the object does not exist."""
+    client = s3_client()
+
+    def head(key):
+        try:
+            return (key, client.head_object(Bucket=bucket, Key=key)['ContentLength'])
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in NOT_FOUND_ERRORS:
+                return (key, None)
+            raise
+    return dict(_map_bounded(head, map(_key_of, keys), threads))
+
+
+#
+# Sync: mirror a local directory to an S3 prefix or an S3 prefix to a local directory,
+# transferring only the files that differ.
+#
+
+ETAG_PART_SIZES = [DOWNLOAD_PART_SIZE, 8 * 1024 * 1024, 16 * 1024 * 1024, MIN_PART_SIZE,
+                   64 * 1024 * 1024, 100 * 1024 * 1024]      # part sizes used by common upload tools
+PARTIAL_SUFFIX = '.s3sync'
+
+SyncAction = namedtuple('SyncAction', ['action', 'src', 'dst', 'size', 'reason'])
+
+
+def local_etag(fname, part_size=None):
+    """Return the ETag S3 would give fname: the MD5 of the contents if it was uploaded with PutObject,
+    or, if it was uploaded with part_size parts, the MD5 of the parts' MD5s followed by -<number of parts>"""
+    digests = []
+    with open(fname, 'rb') as f:
+        if part_size is None:
+            md5 = hashlib.md5()
+            while chunk := f.read(MAX_READ):
+                md5.update(chunk)
+            return md5.hexdigest()
+        while chunk := f.read(part_size):
+            digests.append(hashlib.md5(chunk).digest())
+    return hashlib.md5(b''.join(digests)).hexdigest() + '-' + str(len(digests))
+
+
+def etag_matches(fname, remote_etag):
+    """Return True if the local file has the given ETag. The part size of a multipart ETag isn't recorded,
+    so the common part sizes that give the right number of parts are tried. ETags of SSE-KMS objects are not
+    MD5s and never match, which just means those files are always transferred."""
+    remote_etag = remote_etag.strip('"')
+    if '-' not in remote_etag:
+        return local_etag(fname) == remote_etag
+    parts = int(remote_etag.split('-')[1])
+    size = os.path.getsize(fname)
+    MiB = 1024 * 1024
+    candidates = ETAG_PART_SIZES + [-(-size // parts // MiB) * MiB]
+    for part_size in dict.fromkeys(candidates):
+        if -(-size // part_size) == parts and local_etag(fname, part_size) == remote_etag:
+            return True
+    return False
+
+
+def _timestamp(last_modified):
+    if isinstance(last_modified, str):     # from the aws CLI
+        return datetime.datetime.fromisoformat(last_modified).timestamp()
+    return last_modified.timestamp()
+
+
+def _sync_prefix(prefix):
+    return prefix if (prefix == '' or prefix.endswith('/')) else prefix + '/'
+
+
+def _local_files(root):
+    files = {}
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for fname in filenames:
+            if fname.endswith(PARTIAL_SUFFIX):
+                continue
+            path = os.path.join(dirpath, fname)
+            files[os.path.relpath(path, root).replace(os.sep, '/')] = os.stat(path)
+    return files
+
+
+def _unchanged(fname, st, obj, checksum, upload):
+    """Return (True, None) if the local file fname (with stat st) is the same as the S3 object obj, otherwise (False, reason)"""
+    if st.st_size != obj[_Size]:
+        return (False, 'size')
+    last_modified = _timestamp(obj[_LastModified])
+    if abs(st.st_mtime - last_modified) < 0.001:
+        return (True, None)     # downloads set mtime to exactly LastModified
+    if checksum:
+        return (True, None) if etag_matches(fname, obj[_ETag]) else (False, 'etag')
+    if upload and int(st.st_mtime) <= last_modified:
+        return (True, None)     # the object was written after the file last changed (to the second)
+    return (False, 'mtime')
+
+
+def sync_plan(src, dst, *, delete=False, checksum=True):
+    """Return the list of SyncActions that will make dst the same as src. One of src and dst must be an
+    s3:// prefix and the other a local directory. Files differ if their sizes differ, or if their contents
+    don't match the object's ETag (multipart ETags included); files whose mtime equals the object's
+    LastModified are assumed to be the same without reading them. With checksum=False, the ETag is not
+    checked: a file to upload differs if it changed after the object was written (LastModified has a
+    resolution of one second), and a file to download differs if its mtime is not LastModified.
+    With delete=True, files in dst that are not in src are deleted."""
+    upload = not src.startswith('s3://')
+    (local_root, url) = (src, dst) if upload else (dst, src)
+    if not url.startswith('s3://'):
+        raise ValueError("sync requires one s3:// location: {} {}".format(src, dst))
+    (bucket, prefix) = get_bucket_key(url)
+    prefix = _sync_prefix(prefix)
+    remote = {obj[_Key][len(prefix):]: obj for obj in list_objects(bucket, prefix)}
+    local = _local_files(local_root) if os.path.isdir(local_root) else {}
+
+    plan = []
+    for rel in sorted(set(local) | set(remote)):
+        fname = os.path.join(local_root, *rel.split('/'))
+        s3url = f"s3://{bucket}/{prefix}{rel}"
+        if upload and rel in local:
+            (same, reason) = _unchanged(fname, local[rel], remote[rel], checksum, True) if rel in remote else (False, 'new')
+            if not same:
+                plan.append(SyncAction('upload', fname, s3url, local[rel].st_size, reason))
+        elif (not upload) and rel in remote:
+            (same, reason) = _unchanged(fname, local[rel], remote[rel], checksum, False) if rel in local else (False, 'new')
+            if not same:
+                plan.append(SyncAction('download', s3url, fname, remote[rel][_Size], reason))
+        elif delete:
+            plan.append(SyncAction('delete', None, s3url if upload else fname, 0, 'extra'))
+    return plan
+
+
+def _sync_upload(fname, s3url):
+    writer = S3MultipartWriter(s3url)
+    try:
+        with open(fname, 'rb') as f:
+            shutil.copyfileobj(f, writer, DOWNLOAD_PART_SIZE)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def _sync_download(s3url, fname):
+    """Download to a partial file named for the object's ETag and rename it into place. If an earlier
+    sync was interrupted, the partial file is resumed from where it stopped. Partial files of earlier
+    versions of the object are removed."""
+    (bucket, key) = get_bucket_key(s3url)
+    head = s3_client().head_object(Bucket=bucket, Key=key)
+    tag = etag(head)
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    partial = f"{fname}.{tag}{PARTIAL_SUFFIX}"
+    for stale in glob.glob(glob.escape(fname) + '.*' + PARTIAL_SUFFIX):
+        if stale != partial:
+            os.unlink(stale)
+    start = os.path.getsize(partial) if os.path.exists(partial) else 0
+    with open(partial, 'ab') as f:
+        if start < head['ContentLength']:
+            for data in iter_ranges(bucket, key, start, head['ContentLength'], etag=head['ETag']):
+                f.write(data)
+    os.replace(partial, fname)
+    ts = _timestamp(head[_LastModified])
+    os.utime(fname, (ts, ts))
+
+
+def _sync_do(action):
+    if action.action == 'upload':
+        _sync_upload(action.src, action.dst)
+    elif action.action == 'download':
+        _sync_download(action.src, action.dst)
+    else:
+        os.unlink(action.dst)
+    return action
+
+
+def _remove_partials(root):
+    """Remove the partial downloads left in root by syncs that were interrupted"""
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for fname in filenames:
+            if fname.endswith(PARTIAL_SUFFIX):
+                os.unlink(os.path.join(dirpath, fname))
+
+
+def print_sync_plan(plan, file=sys.stdout):
+    for action in plan:
+        print("{:8} {:>15,} {} ({})".format(action.action, action.size,
+                                           action.dst if action.src is None else f"{action.src} -> {action.dst}",
+                                           action.reason), file=file)
+
+
+def sync(src, dst, *, delete=False, checksum=True, dry_run=False, threads=DOWNLOAD_THREADS):
+    """Make dst the same as src, transferring only the files in sync_plan(), threads files at a time.
+    Interrupted syncs can simply be run again: completed files are skipped and partial downloads resume.
+    Once a download completes, partial files that are no longer needed are removed. S3 objects are
+    deleted with delete_objects(). With dry_run=True, print the plan and transfer nothing. Returns the plan."""
+    plan = sync_plan(src, dst, delete=delete, checksum=checksum)
+    if dry_run:
+        print_sync_plan(plan)
+        return plan
+    actions = []
+    s3_deletes = []
+    for action in plan:
+        if action.action == 'delete' and action.dst.startswith('s3://'):
+            s3_deletes.append(get_bucket_key(action.dst))
+        else:
+            actions.append(action)
+    for action in _map_bounded(_sync_do, actions, threads):
+        logging.info("sync: %s %s", action.action, action.dst)
+    if s3_deletes:
+        deleted = delete_objects(s3_deletes[0][0], [key for (bucket, key) in s3_deletes])
+        logging.info("sync: deleted %s objects from %s", deleted, dst)
+    if not dst.startswith('s3://') and os.path.isdir(dst):
+        _remove_partials(dst)
+    return plan
+
+
 class DuCounter:
     def __init__(self):
         self.total_bytes = 0
@@ -574,33 +1745,43 @@ class DuCounter:
         self.total_files += 1
 
 
-def print_du(root):
-    """Print a DU output using aws cli to generate the usage"""
+def print_du(root, index=None):
+    """Print a DU output of the objects under the s3:// prefix root, listed with list_objects().
+    If index is an S3Index, the usage is taken from the index instead."""
     prefixes = defaultdict(DuCounter)
+    MiB = 1024 * 1024
+    if index is not None:
+        (bucket, prefix) = get_bucket_key(root)
+        for (path, files, bytes_) in index.du(prefix):
+            prefixes[path].total_files = files
+            prefixes[path].total_bytes = bytes_
+        ct = sum(counter.total_files for counter in prefixes.values())
+        total_bytes = sum(counter.total_bytes for counter in prefixes.values())
+        _print_du_report(prefixes, ct, total_bytes)
+        return
 
-    cmd = [awscli(), 's3', 'ls', '--recursive', root]
-    print(" ".join(cmd))
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, encoding='utf-8')
-    part_re = re.compile(r"(\d\d\d\d-\d\d-\d\d) (\d\d:\d\d:\d\d)\s+(\d+) (.*)")
+    (bucket, prefix) = get_bucket_key(root)
     total_bytes = 0
-    MiB = 1024 * 1024
+    ct = 0
     try:
-        for (ct, line) in enumerate(p.stdout):
-            parts = part_re.search(line)
-            if parts is None:
-                print("Cannot parse: ", line, file=sys.stderr, flush=True)
-                continue
-            bytes_ = int(parts.group(3))
-            path = parts.group(4)
+        for obj in list_objects(bucket, prefix):
+            bytes_ = obj[_Size]
+            path = obj[_Key]
             total_bytes += bytes_
             prefixes[os.path.dirname(path)].count(bytes_)
 
             if ct % 1000 == 0:
                 print(
-                    f"files: {ct}  MiB: {int(total_bytes/MiB):,}  {parts.group(4)}", flush=True)
+                    f"files: {ct}  MiB: {int(total_bytes/MiB):,}  {path}", flush=True)
+            ct += 1
     except KeyboardInterrupt as e:
         print("*** interrupted ***")
 
+    _print_du_report(prefixes, ct, total_bytes)
+
+
+def _print_du_report(prefixes, ct, total_bytes):
+    MiB = 1024 * 1024
     print(f"Total lines: {ct}  MiB: {int(total_bytes/MiB):,},")
     fmt1 = "{:>10}{:>20}  {}"
     fmt2 = "{:>10}{:>20,}  {}"
@@ -622,6 +1803,127 @@ def print_du(root):
             break
 
 
+class S3Index:
+    """A local SQLite index of the objects under a bucket, holding each key's size, ETag and LastModified,
+    so that repeated ls, du and search queries are answered without listing S3.
+
+    The index is built one delimiter level ("directory") at a time. Each level records when it was last
+    listed. refresh() relists only the levels that are older than max_age or that have been marked
+    stale with invalidate(), descending through the sub-prefixes already recorded for levels that
+    are still fresh. Sub-prefixes that have disappeared are removed along with everything below them.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, dir TEXT, name TEXT,
+                                        size INTEGER, etag TEXT, last_modified TEXT,
+                                        PRIMARY KEY (bucket, key));
+    CREATE INDEX IF NOT EXISTS objects_dir ON objects (bucket, dir);
+    CREATE INDEX IF NOT EXISTS objects_name ON objects (bucket, name);
+    CREATE TABLE IF NOT EXISTS prefixes (bucket TEXT, prefix TEXT, parent TEXT, refreshed REAL,
+                                         PRIMARY KEY (bucket, prefix));
+    CREATE INDEX IF NOT EXISTS prefixes_parent ON prefixes (bucket, parent);
+    """
+    KEY_MAX = chr(0x10ffff)     # sorts after every other character, for prefix range queries
+
+    def __init__(self, fname, bucket, *, delimiter='/', threads=20):
+        self.fname = fname
+        self.bucket = bucket
+        self.delimiter = delimiter
+        self.threads = threads
+        self.levels_listed = 0
+        self.conn = sqlite3.connect(fname)
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _list_level(self, prefix):
+        """List one level of the bucket. Returns (objects, sub-prefixes)"""
+        objs = []
+        subs = []
+        pages = s3_client().get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=prefix, Delimiter=self.delimiter)
+        for page in pages:
+            objs.extend(page.get('Contents', []))
+            subs.extend(obj['Prefix'] for obj in page.get('CommonPrefixes', []))
+        return (objs, subs)
+
+    def _children(self, prefix):
+        return [row[0] for row in self.conn.execute(
+            "SELECT prefix FROM prefixes WHERE bucket=? AND parent=?", (self.bucket, prefix))]
+
+    def _is_fresh(self, prefix, now, max_age):
+        row = self.conn.execute("SELECT refreshed FROM prefixes WHERE bucket=? AND prefix=?",
+                                (self.bucket, prefix)).fetchone()
+        return (row is not None) and (max_age is not None) and (now - row[0] <= max_age)
+
+    def _store_level(self, prefix, parent, objs, subs, now):
+        c = self.conn
+        with c:
+            c.execute("DELETE FROM objects WHERE bucket=? AND dir=?", (self.bucket, prefix))
+            c.executemany("INSERT OR REPLACE INTO objects (bucket, key, dir, name, size, etag, last_modified) "
+                          "VALUES (?,?,?,?,?,?,?)",
+                          [(self.bucket, obj[_Key], prefix, os.path.basename(obj[_Key]), obj[_Size],
+                            etag(obj), str(obj[_LastModified])) for obj in objs])
+            for gone in set(self._children(prefix)) - set(subs):
+                c.execute("DELETE FROM objects WHERE bucket=? AND key>=? AND key<?",
+                          (self.bucket, gone, gone + self.KEY_MAX))
+                c.execute("DELETE FROM prefixes WHERE bucket=? AND prefix>=? AND prefix<?",
+                          (self.bucket, gone, gone + self.KEY_MAX))
+            c.execute("INSERT OR REPLACE INTO prefixes (bucket, prefix, parent, refreshed) VALUES (?,?,?,?)",
+                      (self.bucket, prefix, parent, now))
+
+    def refresh(self, prefix='', *, max_age=None):
+        """Bring the index for prefix up to date.
+        :param max_age: levels listed within this many seconds are not relisted. None relists everything.
+        """
+        now = time.time()
+        frontier = [(prefix, None)]
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            while frontier:
+                stale = []
+                next_frontier = []
+                for (p, parent) in frontier:
+                    if self._is_fresh(p, now, max_age):
+                        next_frontier.extend((child, p) for child in self._children(p))
+                    else:
+                        stale.append((p, parent))
+                for ((p, parent), (objs, subs)) in zip(stale, pool.map(lambda pp: self._list_level(pp[0]), stale)):
+                    self.levels_listed += 1
+                    self._store_level(p, parent, objs, subs, now)
+                    next_frontier.extend((sub, p) for sub in subs)
+                frontier = next_frontier
+
+    def invalidate(self, key):
+        """Mark the level containing key (an object key or a prefix) so that the next refresh relists it"""
+        parent = key[:key.rstrip(self.delimiter).rfind(self.delimiter) + 1]
+        with self.conn:
+            self.conn.execute("UPDATE prefixes SET refreshed=0 WHERE bucket=? AND prefix IN (?,?)",
+                              (self.bucket, parent, key))
+
+    def list_objects(self, prefix='', limit=None):
+        """Generator of the indexed objects under prefix, in key order, as list_objects() dictionaries"""
+        cmd = ("SELECT key, size, etag, last_modified FROM objects WHERE bucket=? AND key>=? AND key<? ORDER BY key"
+               + (" LIMIT {}".format(int(limit)) if limit else ""))
+        for (key, size, etag_, last_modified) in self.conn.execute(cmd, (self.bucket, prefix, prefix + self.KEY_MAX)):
+            yield {_Key: key, _Size: size, _ETag: etag_, _LastModified: last_modified}
+
+    def search(self, prefix='', name=None, limit=None):
+        """Indexed equivalent of search_objects(). Returns the objects under prefix whose basename is name"""
+        if name is None:
+            return list(self.list_objects(prefix, limit=limit))
+        cmd = ("SELECT key, size, etag, last_modified FROM objects WHERE bucket=? AND name=? AND key>=? AND key<? "
+               "ORDER BY key" + (" LIMIT {}".format(int(limit)) if limit else ""))
+        return [{_Key: key, _Size: size, _ETag: etag_, _LastModified: last_modified}
+                for (key, size, etag_, last_modified)
+                in self.conn.execute(cmd, (self.bucket, name, prefix, prefix + self.KEY_MAX))]
+
+    def du(self, prefix=''):
+        """Return (path, files, bytes) for each level under prefix, with paths named like os.path.dirname()"""
+        return [(os.path.dirname(dir_ + 'x'), files, bytes_) for (dir_, files, bytes_) in self.conn.execute(
+            "SELECT dir, COUNT(*), SUM(size) FROM objects WHERE bucket=? AND key>=? AND key<? GROUP BY dir",
+            (self.bucket, prefix, prefix + self.KEY_MAX))]
+
+
 if __name__ == "__main__":
     t0 = time.time()
     count = 0
@@ -637,14 +1939,50 @@ if __name__ == "__main__":
     parser.add_argument("--search", help="Search for something")
     parser.add_argument(
         "--threads", help="For searching, the number of threads to use", type=int, default=20)
+    parser.add_argument("--shards", type=int, default=1,
+                        help="for --ls without --delimiter, split the keyspace into this many concurrent listings")
+    parser.add_argument("--index", help="answer --ls, --du and --search from this SQLite index file")
+    parser.add_argument("--refresh", action='store_true',
+                        help="with --index, refresh the levels of the index that are older than --max_age")
+    parser.add_argument("--max_age", type=float, default=3600,
+                        help="with --refresh, seconds before a level of the index is relisted")
+    parser.add_argument("--sync", help="copy only the changed files from each root (local or s3://) to this destination")
+    parser.add_argument("--delete", action='store_true', help="with --sync, delete files not in the source")
+    parser.add_argument("--dry_run", action='store_true', help="with --sync, print what would be transferred")
     parser.add_argument("roots", nargs="+")
     args = parser.parse_args()
     if args.debug:
         debug = args.debug
     for root in args.roots:
+        if args.sync:
+            plan = sync(root, args.sync, delete=args.delete, dry_run=args.dry_run, threads=args.threads)
+            print(f"{len(plan)} files {'to transfer' if args.dry_run else 'transferred'}", file=sys.stderr)
+            continue
         (bucket, prefix) = get_bucket_key(root)
+        if args.index:
+            index = S3Index(args.index, bucket, threads=args.threads)
+            if args.refresh:
+                index.refresh(prefix, max_age=args.max_age)
+                print(f"Levels listed: {index.levels_listed}", file=sys.stderr)
+            if args.ls:
+                for data in index.list_objects(prefix):
+                    print("{:18,} {}".format(data[_Size], data[_Key]))
+                    count += 1
+            if args.search:
+                what = None if args.search == 'all' else args.search
+                for data in index.search(prefix, what):
+                    print("{:18,} {}".format(data[_Size], data[_Key]))
+                    count += 1
+            if args.du:
+                print_du(root, index=index)
+            index.close()
+            continue
         if args.ls:
-            for data in list_objects(bucket, prefix, delimiter=args.delimiter):
+            if args.shards > 1 and not args.delimiter:
+                listing = list_objects_sharded(bucket, prefix, shards=args.shards)
+            else:
+                listing = list_objects(bucket, prefix, delimiter=args.delimiter)
+            for data in listing:
                 print("{:18,} {}".format(data[_Size], data[_Key]))
                 count += 1
         if args.search:
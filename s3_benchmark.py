@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark the s3.py object operations.
+
+Compares ops/sec of the in-process boto3 path with the aws CLI fallback
+(s3.USE_AWS_CLI) for put/head/get/delete/list. By default it runs against a
+local moto server, so no AWS account is needed:
+
+    pip install 'moto[server]'
+    python s3_benchmark.py --count 50
+
+Use --endpoint to point at another S3 stand-in that is already running.
+The CLI path is skipped if no aws executable can be found.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from os.path import abspath, dirname
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+import ctools.s3 as s3
+
+BUCKET = 'ctools-benchmark'
+
+
+def start_moto_server(port):
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # one line per request otherwise
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    return server
+
+
+def timed(label, count, func):
+    t0 = time.time()
+    for i in range(count):
+        func(i)
+    t1 = time.time()
+    print("   {:8} {:10.1f} ops/sec".format(label, count / (t1 - t0)))
+
+
+def run_benchmark(count, fname, tempdir):
+    timed('put', count, lambda i: s3.put_object(BUCKET, f"bench/{i}", fname))
+    timed('head', count, lambda i: s3.head_object(BUCKET, f"bench/{i}"))
+    timed('get', count, lambda i: s3.get_object(BUCKET, f"bench/{i}",
+                                                os.path.join(tempdir, f"{i}.{s3.USE_AWS_CLI}")))
+    timed('list', count, lambda i: list(s3.list_objects(BUCKET, 'bench/')))
+    timed('delete', count, lambda i: s3.delete_object(BUCKET, f"bench/{i}"))
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description="Benchmark s3.py with boto3 and with the aws CLI")
+    parser.add_argument("--count", type=int, default=20, help="operations per test")
+    parser.add_argument("--size", type=int, default=4096, help="object size in bytes")
+    parser.add_argument("--port", type=int, default=5055, help="port for the moto server")
+    parser.add_argument("--endpoint", help="use this S3 endpoint rather than starting a moto server")
+    args = parser.parse_args()
+
+    server = None
+    if args.endpoint is None:
+        server = start_moto_server(args.port)
+        args.endpoint = f"http://127.0.0.1:{args.port}"
+        for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+            os.environ.setdefault(var, 'testing')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    # Both boto3 and the aws CLI honor this variable, so both paths talk to the same server.
+    os.environ['AWS_ENDPOINT_URL_S3'] = args.endpoint
+    s3.s3_client().create_bucket(Bucket=BUCKET)
+
+    modes = [False]
+    try:
+        s3.awscli()
+        modes.append(True)
+    except RuntimeError as e:
+        print(f"{e}; skipping the CLI benchmark", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        fname = os.path.join(tempdir, 'object')
+        with open(fname, 'wb') as f:
+            f.write(os.urandom(args.size))
+        for mode in modes:
+            s3.USE_AWS_CLI = mode
+            print("aws CLI:" if mode else "boto3:")
+            run_benchmark(args.count, fname, tempdir)
+
+    if server:
+        server.stop()
@@ -3,8 +3,11 @@ import sys
 # import pandas
 from collections import OrderedDict
 import logging
+import csv
 
-from ctools.dconfig import dopen
+from ctools.dconfig import dopen, dpath_expand
+import ctools.s3 as s3
+import botocore.exceptions
 
 import ctools.schema as schema
 from ctools.schema import vtype_for_numpy_type
@@ -232,6 +235,58 @@ class Schema:
                     if limit and count >= limit:
                         break
 
+    def select_records(self, *, filename=None, tablename, columns=None, where=(), limit=None, s3select=True):
+        """Like read_records_as_dicts(), but returns only the named columns of the records that match
+        every (varname, op, value) predicate in where, typed by the table's Variables.
+        For delimited files on S3, the projection and predicates are pushed down to S3 Select so only the
+        selected data is transferred. Otherwise (or if S3 Select is unavailable, or s3select=False) the file
+        is streamed with dopen(), which reads S3 objects as parallel byte ranges, and filtered here.
+        .csv files are assumed to have a header line naming the columns.
+        """
+        table = self.get_table(tablename)
+        if filename == None and table.filename:
+            filename = table.filename
+        columns = list(table.varnames()) if columns is None else list(columns)
+        path = dpath_expand(filename)
+        header = os.path.splitext(path)[1] == schema.CSV_EXT
+        delimiter = table.delimiter or (',' if header else None)
+        count = 0
+
+        if s3select and path.startswith('s3://') and delimiter is not None:
+            (bucket, key) = s3.get_bucket_key(path)
+            try:
+                lines = s3.s3select(bucket, key, table.s3select_expression(columns, where, header=header),
+                                    delimiter=delimiter, header=header)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in s3.SELECT_UNSUPPORTED_ERRORS:
+                    raise
+                logging.warning("S3 Select unavailable for %s (%s); filtering locally", path, e)
+            else:
+                vars = [table.get_variable(name) for name in columns]
+                for fields in csv.reader(lines, delimiter=delimiter):
+                    if not fields:
+                        continue
+                    yield {v.name: v.python_type(field) for (v, field) in zip(vars, fields)}
+                    count += 1
+                    if limit and count >= limit:
+                        return
+                return
+
+        with dopen(filename) as f:
+            if header:
+                names = next(csv.reader([f.readline()], delimiter=delimiter))
+                rows = ({name: table.get_variable(name).python_type(field) for (name, field) in zip(names, fields)
+                         if name in table.vardict}
+                        for fields in csv.reader(f, delimiter=delimiter))
+            else:
+                rows = (table.parse_line_to_dict(line.rstrip("\r\n")) for line in f)
+            for data in rows:
+                if table.record_matches(data, where):
+                    yield {name: data[name] for name in columns}
+                    count += 1
+                    if limit and count >= limit:
+                        return
+
     ################################################################
     # Recode support
     ################################################################
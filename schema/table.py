@@ -1,10 +1,13 @@
 import os
 import logging
 import time
+import decimal
+import operator
 
 from ctools.schema import valid_sql_name, SAS_TEMPLATE, SCHEMA_SUPPORT_FUNCTIONS, SQL_SCHEMA, MYSQL, SQLITE3, SQL_TYPE_MAP, sql_type_for_python_value
 from ctools.schema.variable import Variable
 from collections import OrderedDict
+from functools import partial
 
 import ctools.schema as schema
 
@@ -376,6 +379,61 @@ class Table:
             return {v.name: v.python_type(fields[v.position]) for v in self.vars()}
         return {v.name: v.python_type(line[v.column: v.column+v.width]) for v in self.vars() if (v.column is not None)}
 
+    def parse_s3_rows(self, path, *, splits=None, processes=None):
+        """Parse a large text file on S3 with parse_line_to_row() in a pool of worker processes.
+        The object is divided into line-aligned byte ranges with s3.line_splits(); each worker reads
+        and parses one range at a time. Yields the rows in file order. Blank lines are skipped."""
+        import ctools.s3 as s3
+        for rows in s3.map_line_splits(path, partial(_parse_split_rows, self), splits=splits, processes=processes):
+            yield from rows
+
+    ###
+    # selection (projection and predicates)
+    ###
+
+    SELECT_OPS = {'=': operator.eq, '!=': operator.ne, '<>': operator.ne,
+                  '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+    SELECT_CASTS = {int: 'INT', float: 'FLOAT', decimal.Decimal: 'DECIMAL'}
+
+    def s3select_expression(self, columns=None, where=(), header=False):
+        """Return an S3 Select SQL expression for a delimited file of this table that returns the
+        named columns (default all) of the rows matching every (varname, op, value) predicate in where.
+        Columns are referenced by field position (s._1 is position 0) or, if header is True, by name."""
+        def ref(v):
+            if header:
+                return 's."{}"'.format(v.name)
+            if v.position is None:
+                raise RuntimeError("S3 Select requires a field position for variable {}".format(v.name))
+            return 's._{}'.format(v.position + 1)
+
+        def literal(v, value):
+            value = v.python_type(value)
+            if isinstance(value, str):
+                return "'" + value.replace("'", "''") + "'"
+            return str(value)
+
+        columns = list(self.varnames()) if columns is None else columns
+        conditions = []
+        for (varname, op, value) in where:
+            if op not in self.SELECT_OPS:
+                raise ValueError("unsupported operator: {}".format(op))
+            v = self.get_variable(varname)
+            col = ref(v)
+            if v.python_type in self.SELECT_CASTS:
+                col = "CAST({} AS {})".format(col, self.SELECT_CASTS[v.python_type])
+            conditions.append("{} {} {}".format(col, op, literal(v, value)))
+        expr = "SELECT " + ", ".join(ref(self.get_variable(name)) for name in columns) + " FROM S3Object s"
+        if conditions:
+            expr += " WHERE " + " AND ".join(conditions)
+        return expr
+
+    def record_matches(self, d, where=()):
+        """Evaluate the (varname, op, value) predicates of s3select_expression() against a parsed record"""
+        for (varname, op, value) in where:
+            if not self.SELECT_OPS[op](d[varname], self.get_variable(varname).python_type(value)):
+                return False
+        return True
+
     def parse_and_write_line(self, line, extra=[]):
         self.write_row(self.parse_line_to_row(line), extra=extra)
 
@@ -422,3 +480,10 @@ class Table:
     def write_row(self, row, extra=[]):
         """Write a row using the CSV writer"""
         self.csv_writer.write_row(row + extra)
+
+
+def _parse_split_rows(table, path, start, end):
+    """Worker for Table.parse_s3_rows(): parse the lines in one byte range of path"""
+    import ctools.s3 as s3
+    return [table.parse_line_to_row(line.rstrip("\r\n"))
+            for line in s3.iter_split_lines(path, start, end) if line.strip()]
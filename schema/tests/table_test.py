@@ -98,6 +98,22 @@ SQL_CREATE1 = """    CREATE TABLE output (
 """
 
 
+def test_select_expression():
+    t = Table(name="people", delimiter='|')
+    t.add_variable(Variable(name="name", vtype='VARCHAR(10)', position=0))
+    t.add_variable(Variable(name="age", vtype='INTEGER(2)', position=1))
+    t.add_variable(Variable(name="city", vtype='VARCHAR(10)', position=2))
+
+    assert t.s3select_expression() == "SELECT s._1, s._2, s._3 FROM S3Object s"
+    assert (t.s3select_expression(['name'], [('age', '>=', '21'), ('city', '=', "O'Hare")]) ==
+            "SELECT s._1 FROM S3Object s WHERE CAST(s._2 AS INT) >= 21 AND s._3 = 'O''Hare'")
+    assert t.s3select_expression(['city'], header=True) == 'SELECT s."city" FROM S3Object s'
+
+    row = t.parse_line_to_dict("jack|25|Boston")
+    assert t.record_matches(row, [('age', '>', 21), ('city', '!=', 'Paris')])
+    assert not t.record_matches(row, [('age', '<', '21')])
+
+
 def test_sql_parse_create():
     sql = sql_parse_create(SQL_CREATE1)
     assert sql['table'] == 'output'
@@ -0,0 +1,549 @@
+"""
+dbfile test. These tests use SQLite3, so they do not need a MySQL server.
+"""
+
+import gc
+import os
+import sys
+import sqlite3
+import threading
+import time
+import weakref
+from os.path import dirname, abspath
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+import pytest
+
+from ctools.dbfile import (DBMySQLAuth, DBPool, DBSqlite3, ResultCache, StatementCache, result_cache,
+                           result_key, statement_cache, statement_tables)
+
+
+def test_dbpool_reuse():
+    pool = DBPool(lambda: DBSqlite3(fname=':memory:'), size=2)
+    db1 = pool.checkout()
+    pool.checkin(db1)
+    assert pool.checkout() is db1
+    db2 = pool.checkout()
+    assert db2 is not db1
+    assert len(pool) == 2
+
+    # The pool is full, so checkout() waits for a checkin
+    threading.Timer(0.1, pool.checkin, [db2]).start()
+    assert pool.checkout() is db2
+    assert pool.stats['waited'] == 1
+
+    pool.timeout = 0.01
+    with pytest.raises(TimeoutError):
+        pool.checkout()
+
+    # A discarded connection frees its slot
+    pool.checkin(db1, discard=True)
+    assert len(pool) == 1
+    assert pool.checkout() is not db1
+    pool.close()
+
+
+def test_dbpool_expiry():
+    pool = DBPool(lambda: DBSqlite3(fname=':memory:'), size=2, idle_timeout=0.05, ping_after=0)
+    db1 = pool.checkout()
+    pool.checkin(db1)
+    assert pool.checkout() is db1
+    assert pool.stats['pinged'] == 1
+
+    # Connections idle longer than idle_timeout are not reused, nor are dead connections
+    pool.checkin(db1)
+    time.sleep(0.1)
+    db2 = pool.checkout()
+    assert db2 is not db1
+    db2.close()
+    pool.checkin(db2)
+    assert pool.checkout() is not db2
+    assert pool.stats['opened'] == 3
+
+
+def test_bulk_insert():
+    db = DBSqlite3(fname=':memory:')
+    db.create_schema("CREATE TABLE t (a INTEGER PRIMARY KEY, b TEXT)")
+    stats = db.bulk_insert(None, 't', ((i, str(i)) for i in range(2500)), columns=['a', 'b'], batch_size=1000)
+    assert stats['rows'] == 2500
+    assert db.csfr(None, "SELECT COUNT(*), MAX(b) FROM t")[0][:] == (2500, '999')
+
+    # Dictionaries supply their own column names; ignore=True becomes INSERT OR IGNORE
+    db.bulk_insert(None, 't', [{'a': 1, 'b': 'dup'}, {'a': 3000, 'b': 'new'}], ignore=True)
+    assert db.csfr(None, "SELECT b FROM t WHERE a IN (%s, %s) ORDER BY a", [1, 3000])[0][0] == '1'
+    assert db.csfr(None, "SELECT COUNT(*) FROM t")[0][0] == 2501
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db.bulk_insert(None, 't', [(1, 'dup')], columns=['a', 'b'])
+    assert db.bulk_insert(None, 't', [])['rows'] == 0
+
+
+def test_csfr_stream():
+    db = DBSqlite3(fname=':memory:')
+    db.create_schema("CREATE TABLE t (a INTEGER, b TEXT)")
+    db.bulk_insert(None, 't', ((i, str(i)) for i in range(25)), columns=['a', 'b'])
+
+    rows = db.csfr_stream(None, "SELECT a, b FROM t WHERE a < %s ORDER BY a", [10])
+    assert tuple(next(rows)) == (0, '0')
+    assert len(list(rows)) == 9
+
+    names = []
+    batches = list(db.csfr_stream(None, "SELECT a, b FROM t ORDER BY a", asDicts=True, batch_size=10,
+                                  get_column_names=names))
+    assert names == ['a', 'b']
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert batches[2][4] == {'a': 24, 'b': '24'}
+
+
+def test_statement_cache():
+    cache = StatementCache(maxsize=2)
+    stmt = cache.get("INSERT IGNORE INTO t (a) VALUES (%s)")
+    assert (stmt.verb, stmt.nparams, stmt.sqlite_cmd) == ('INSERT', 1, "INSERT OR IGNORE INTO t (a) VALUES (?)")
+    assert cache.get("INSERT IGNORE INTO t (a) VALUES (%s)") is stmt
+    cache.get("SELECT 1")
+    cache.get("SELECT 2")
+    assert cache.get("INSERT IGNORE INTO t (a) VALUES (%s)") is not stmt    # evicted
+
+    db = DBSqlite3(fname=':memory:')
+    db.create_schema("CREATE TABLE s (a INTEGER)")
+    statement_cache.clear()
+    for i in range(10):
+        db.csfr(None, "INSERT INTO s (a) VALUES (%s)", [i])
+    db.csfr(None, "SELECT a FROM s")
+    report = {r['cmd']: r for r in statement_cache.report()}
+    assert report["INSERT INTO s (a) VALUES (%s)"]['calls'] == 10
+    assert report["SELECT a FROM s"]['rows'] == 10
+    assert report["SELECT a FROM s"]['p99_time'] >= 0
+
+
+def test_statement_tables():
+    assert statement_tables("SELECT a FROM t1, `db`.T2 AS x JOIN t3 ON x.a=t3.a WHERE b=%s") == {'t1', 't2', 't3'}
+    assert statement_tables("INSERT IGNORE INTO t (a) VALUES (%s)") == {'t'}
+    assert statement_tables("UPDATE t SET a=1") == {'t'}
+    assert statement_tables("SELECT a FROM t WHERE b IN (SELECT b FROM u)") == set()
+    assert statement_tables("DELETE FROM t WHERE id IN (SELECT id FROM u)") == {'t', 'u'}
+    assert statement_tables("TRUNCATE TABLE t") == set()
+
+
+def test_result_cache():
+    db = DBSqlite3(fname=':memory:', dicts=False)
+    db.create_schema("CREATE TABLE r (a INTEGER); CREATE TABLE q (a INTEGER)")
+    db.csfr(None, "INSERT INTO r (a) VALUES (%s)", [1])
+    query = "SELECT SUM(a) FROM r WHERE a > %s"
+    assert db.csfr(None, query, [0], cache=True) == [(1,)]
+
+    # A write from outside csfr is not seen until the entry expires
+    db.conn.execute("INSERT INTO r (a) VALUES (2)")
+    assert db.csfr(None, query, [0], cache=True) == [(1,)]
+    assert db.csfr(None, query, [0]) == [(3,)]
+
+    # A write to another table does not invalidate; a write to r does
+    db.csfr(None, "INSERT INTO q (a) VALUES (%s)", [1])
+    assert db.csfr(None, query, [0], cache=True) == [(1,)]
+    db.csfr(None, "DELETE FROM r WHERE a=%s", [1])
+    assert db.csfr(None, query, [0], cache=True) == [(2,)]
+    db.bulk_insert(None, 'r', [(3,), (4,)], columns=['a'])
+    assert db.csfr(None, query, [0], cache=True) == [(9,)]
+
+    # A write with a subquery invalidates its target, as does one through execute()
+    db.csfr(None, "DELETE FROM r WHERE a IN (SELECT a FROM q)", [])
+    assert db.csfr(None, query, [0], cache=True) == [(9,)]
+    db.csfr(None, "INSERT INTO q (a) VALUES (%s)", [4])
+    db.csfr(None, "DELETE FROM r WHERE a IN (SELECT a FROM q)", [])
+    assert db.csfr(None, query, [0], cache=True) == [(5,)]
+    db.execute("INSERT INTO r (a) VALUES (4)")
+    assert db.csfr(None, query, [0], cache=True) == [(9,)]
+
+    # A write whose tables are not known invalidates everything for the database
+    key = result_key(db, statement_cache.get(query), [0])
+    result_cache.invalidate(db, frozenset())
+    assert result_cache.get(key) is None
+    assert db.csfr(None, query, [0], cache=True) == [(9,)]
+
+    # Expiry and the memory cap
+    cache = ResultCache(ttl=0.05, max_bytes=2000)
+    cache.put(('auth', 'SELECT 1', ()), {'t'}, [(1,)], ['x'])
+    assert cache.get(('auth', 'SELECT 1', ())) == ([(1,)], ['x'])
+    time.sleep(0.1)
+    assert cache.get(('auth', 'SELECT 1', ())) is None
+    for i in range(100):
+        cache.put(('auth', 'SELECT 1', (i,)), {'t'}, [(i, 'value')], ['x', 'y'])
+    assert 0 < len(cache.entries) < 100
+    assert cache.nbytes <= 2000
+
+    # A result read before a write is not cached after the write invalidated it
+    key = result_key(db, statement_cache.get(query), [0])
+    generation = result_cache.generation(key, {'r'})
+    db.csfr(None, "INSERT INTO r (a) VALUES (%s)", [5])
+    result_cache.put(key, {'r'}, [(9,)], None, generation=generation)
+    assert db.csfr(None, query, [0], cache=True) == [(14,)]
+
+    # Cached results do not keep the connection alive
+    ref = weakref.ref(db)
+    del db
+    gc.collect()
+    assert ref() is None
+
+
+def test_ingest(tmp_path):
+    db = DBSqlite3(fname=str(tmp_path / 'ingest.db'), dicts=False)
+    db.create_schema("CREATE TABLE t (a INTEGER, b TEXT); CREATE INDEX t_b ON t (b)")
+    with db.ingest(commit_every=100) as ingest:
+        assert db.pragma('journal_mode') == 'wal'
+        assert db.pragma('synchronous') == 0
+        assert db.csfr(None, "SELECT name FROM sqlite_master WHERE type='index'") == []
+        for i in range(250):
+            ingest.csfr(None, "INSERT INTO t (a, b) VALUES (%s, %s)", [i, str(i)])
+        assert db.uncommitted == 50
+        db.bulk_insert(None, 't', [(i, str(i)) for i in range(250, 300)], columns=['a', 'b'])
+    assert db.pragma('journal_mode') == 'delete'
+    assert db.pragma('synchronous') == 2
+    assert db.pragma('mmap_size') == 0
+    assert db.csfr(None, "SELECT name FROM sqlite_master WHERE type='index'") == [('t_b',)]
+    assert db.csfr(None, "SELECT COUNT(*) FROM t") == [(300,)]
+
+
+def test_csfr_columns():
+    numpy = pytest.importorskip("numpy")
+    db = DBSqlite3(fname=':memory:')
+    db.create_schema("CREATE TABLE c (i INTEGER, f REAL, s TEXT, n INTEGER)")
+    db.bulk_insert(None, 'c', [(k, k / 2, str(k), None if k % 2 else k) for k in range(25)],
+                   columns=['i', 'f', 's', 'n'])
+    cols = db.csfr_columns(None, "SELECT i, f, s, n FROM c ORDER BY i", batch_size=10)
+    assert list(cols) == ['i', 'f', 's', 'n']
+    assert cols['i'].dtype == numpy.int64 and cols['i'].tolist() == list(range(25))
+    assert cols['f'].dtype == numpy.float64 and cols['f'][3] == 1.5
+    assert cols['s'][24] == '24'
+    assert cols['n'].dtype == numpy.float64 and numpy.isnan(cols['n'][1]) and cols['n'][2] == 2
+
+    empty = db.csfr_columns(None, "SELECT i, s FROM c WHERE i < 0")
+    assert list(empty) == ['i', 's'] and len(empty['i']) == 0
+
+    # The dtype is widened when a later batch needs it
+    db.create_schema("CREATE TABLE w (a, b, c)")
+    db.bulk_insert(None, 'w', [(k, None, k) for k in range(10)] + [(10.5, 3, None), (11, 'x', 12)],
+                   columns=['a', 'b', 'c'])
+    cols = db.csfr_columns(None, "SELECT a, b, c FROM w ORDER BY rowid", batch_size=5)
+    assert cols['a'].dtype == numpy.float64 and cols['a'][10] == 10.5 and cols['a'][9] == 9
+    assert cols['b'].dtype == object and cols['b'][0] is None and cols['b'][11] == 'x'
+    assert cols['c'].dtype == numpy.float64 and numpy.isnan(cols['c'][10]) and cols['c'][11] == 12
+
+
+def test_dbpool_session_state():
+    class Connection:
+        def __init__(self):
+            self.clean = True
+
+        def reusable(self):
+            return self.clean
+
+        def close(self):
+            pass
+
+    # A connection left with session state is closed rather than reused
+    pool = DBPool(Connection, size=2)
+    db1 = pool.checkout()
+    db1.clean = False
+    pool.checkin(db1)
+    assert len(pool) == 0 and pool.checkout() is not db1
+
+    # A pinned connection is returned to the same thread until it is released
+    auth = DBMySQLAuth(host='h', database='db', user='u', password='p')
+    auth.dbcache[os.getpid()] = DBPool(Connection, size=2)
+    (pool, db) = auth.checkout('UPDATE')
+    auth.checkin(pool, db, pin=True)
+    assert auth.checkout('SELECT') == (pool, db)
+    auth.checkin(pool, db)
+    other = []
+    thread = threading.Thread(target=lambda: other.append(auth.checkout('SELECT')[1]))
+    thread.start()
+    thread.join()
+    assert other[0] is not db
+    auth.checkin(pool, db, pin=False)
+    assert pool.pinned() is None and pool.outstanding() == 1
+    assert auth.checkout('SELECT')[1] is db
+
+
+def test_replica_routing():
+    auth = DBMySQLAuth(host='primary', database='db', user='u', password='p', replicas=['r1', 'r2'])
+    assert [r.host for r in auth.replicas] == ['r1', 'r2']
+    assert auth.replicas[0].user == 'u'
+    for a in [auth] + auth.replicas:
+        a.dbcache[os.getpid()] = DBPool(lambda: DBSqlite3(fname=':memory:'))
+    assert auth.route('INSERT') is auth
+    assert {auth.route('SELECT'), auth.route('SELECT')} == set(auth.replicas)
+
+    # Reads go to the replica with the fewest outstanding requests, and ties are taken in turn
+    (pool, db) = auth.checkout('SELECT')
+    busy = auth.replicas[0] if pool is auth.replicas[0].pool() else auth.replicas[1]
+    idle = auth.replicas[1] if busy is auth.replicas[0] else auth.replicas[0]
+    assert auth.route('SHOW') is idle
+    assert auth.route('SHOW') is idle
+    pool.checkin(db)
+    assert auth.route('SELECT', primary=True) is auth
+    (pool, db) = auth.checkout('SELECT', primary=True)
+    assert pool is auth.pool()
+    pool.checkin(db)
+
+    # Reads of session state and locking reads go to the primary
+    assert statement_cache.get("SELECT a FROM t WHERE b=%s").replica_ok
+    for cmd in ["SELECT LAST_INSERT_ID()", "SELECT @total", "SELECT a FROM t WHERE b=1 FOR UPDATE",
+                "INSERT INTO t (a) VALUES (1)"]:
+        assert not statement_cache.get(cmd).replica_ok
+    assert DBMySQLAuth(host='h', database='db', user='u', password='p').route('SELECT').host == 'h'
+    assert (DBMySQLAuth(host='h', database='db', user='u', password='p', port=3307)
+            != DBMySQLAuth(host='h', database='db', user='u', password='p'))
+
+    # The deprecated per-thread cache_get() and cache_store() keep one pooled connection for the thread
+    with pytest.deprecated_call():
+        db = auth.cache_get()
+    with pytest.deprecated_call():
+        assert auth.cache_get() is db
+    assert auth.checkout('INSERT') == (auth.pool(), db)
+    with pytest.deprecated_call():
+        auth.cache_store(db)
+    assert auth.pool().pinned() is db
+    auth.checkin(auth.pool(), db, pin=False)
+    assert auth.pool().pinned() is None
+
+    # A replica that cannot be reached is skipped until REPLICA_RETRY_AFTER has passed
+    def unreachable():
+        raise OSError("connection refused")
+    auth.replicas[0].dbcache[os.getpid()] = DBPool(unreachable)
+    try:
+        pools = set()
+        for i in range(4):
+            (pool, db) = auth.checkout('SELECT')
+            pools.add(pool)
+            pool.checkin(db)
+        assert auth.replicas[0].pool() not in pools
+        assert (auth.replicas[0].host, auth.replicas[0].port) in DBMySQLAuth.down
+        assert all(auth.route('SELECT') is auth.replicas[1] for i in range(4))
+        DBMySQLAuth.down[('r2', auth.port)] = time.time() + 60
+        assert auth.route('SELECT') is auth
+    finally:
+        DBMySQLAuth.down.clear()
+
+
+def test_secret_cache(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import json
+    from ctools import dbfile
+    for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        monkeypatch.setenv(var, 'testing')
+    with moto.mock_aws():
+        monkeypatch.setattr(dbfile, 'secret_cache', dbfile.SecretCache(ttl=60, refresh_before=10))
+        client = dbfile.secret_cache.client('us-east-1')
+
+        def put_secret(password):
+            secret = json.dumps({'host': 'h', 'username': 'u', 'password': password, 'dbname': 'd', 'port': 3306})
+            client.put_secret_value(SecretId='db', SecretString=secret)
+
+        client.create_secret(Name='db', SecretString='{}')
+        put_secret('p1')
+        section = {'AWS_SECRET_NAME': 'db', 'AWS_REGION_NAME': 'us-east-1'}
+        auth = DBMySQLAuth.FromConfig(section)
+        assert (auth.user, auth.password, auth.secret) == ('u', 'p1', ('db', 'us-east-1'))
+        assert DBMySQLAuth.FromConfig(section).password == 'p1'
+        assert dbfile.secret_cache.fetches == 1
+
+        # After rotation, the cached secret is still used until refresh_secret()
+        put_secret('p2')
+        assert DBMySQLAuth.FromConfig(section).password == 'p1'
+        pools = {auth: 'pool'}
+        auth.replicas = [DBMySQLAuth(host='r1', database='d', user='u', password='p1'),
+                         DBMySQLAuth(host='r2', database='d', user='other', password='x', secret=('db', 'us-east-1'))]
+        assert auth.refresh_secret() is True
+        assert auth.password == 'p2'
+        assert auth.refresh_secret() is False
+
+        # The hash does not depend on the credentials, and the replicas get the new ones
+        assert pools[auth] == 'pool'
+        assert [(r.user, r.password) for r in auth.replicas] == [('u', 'p2'), ('u', 'p2')]
+        auth.replicas = []
+
+        # Near expiry, the secret is refreshed in the background
+        dbfile.secret_cache.ttl = 5
+        put_secret('p3')
+        assert DBMySQLAuth.FromConfig(section).password == 'p2'
+        for i in range(100):
+            if not dbfile.secret_cache.refreshing:
+                break
+            time.sleep(0.01)
+        assert DBMySQLAuth.FromConfig(section).password == 'p3'
+
+
+def test_query_hooks(caplog):
+    from ctools.dbfile import query_hooks, fingerprint, install_default_hooks
+    assert fingerprint("SELECT * FROM t WHERE a=%s AND b='x''y' AND c IN (1, 2,3)") == \
+        "SELECT * FROM t WHERE a=? AND b=? AND c IN (...)"
+    assert fingerprint("INSERT INTO t VALUES (1,'a'), (2,'b')") == "INSERT INTO t VALUES (...)"
+
+    events = []
+    query_hooks.register(before=lambda e: events.append(('before', e.cmd)), after=events.append)
+    (slow_log, histogram) = install_default_hooks(slow_query_seconds=0)
+    try:
+        db = DBSqlite3(fname=':memory:', dicts=False)
+        db.execute("CREATE TABLE h (a INTEGER)")
+        for i in range(3):
+            db.csfr(None, "INSERT INTO h (a) VALUES (%s)", [i])
+        db.csfr(None, "SELECT a FROM h WHERE a > %s", [0])
+        with pytest.raises(RuntimeError):
+            db.csfr(None, "SELECT nothing FROM nowhere")
+        db.execute("CREATE UNIQUE INDEX h_a ON h (a)")
+        with pytest.raises(sqlite3.IntegrityError):
+            db.csfr(None, "INSERT INTO h (a) VALUES (%s)", [1])
+        with pytest.raises(RuntimeError):
+            db.csfr(None, "PRAGMA user_version")
+    finally:
+        for hook in [events.append, slow_log, histogram] + query_hooks.before:
+            query_hooks.unregister(hook)
+
+    # Without hooks, execute() does not add its statements to the statement cache
+    db.execute("CREATE TABLE unhooked (a INTEGER)")
+    assert "CREATE TABLE unhooked (a INTEGER)" not in statement_cache.statements
+
+    after = [e for e in events if not isinstance(e, tuple)]
+    assert len(after) == 9
+    assert isinstance(after[7].error, sqlite3.IntegrityError)
+    assert isinstance(after[8].error, RuntimeError)
+    assert ('before', "SELECT a FROM h WHERE a > %s") in events
+    select = after[4]
+    assert (select.rowcount, select.vals, select.retries, select.connection_id) == (2, [0], 0, id(db.conn))
+    assert select.duration >= 0 and select.error is None
+    assert isinstance(after[5].error, sqlite3.OperationalError)
+    assert "slow query" in caplog.text
+
+    report = {r['fingerprint']: r for r in histogram.report()}
+    assert report["INSERT INTO h (a) VALUES (...)"]['calls'] == 4     # including the one that failed
+    assert 0 < report["INSERT INTO h (a) VALUES (...)"]['p99_time'] <= 1
+
+
+def test_ingest_unique_index(tmp_path):
+    db = DBSqlite3(fname=str(tmp_path / 'unique.db'), dicts=False)
+    db.create_schema("CREATE TABLE t (a INTEGER, b TEXT); CREATE UNIQUE INDEX t_a ON t (a); CREATE INDEX t_b ON t (b)")
+    with db.ingest():
+        # The unique index is kept, so INSERT OR IGNORE still skips duplicates
+        assert db.csfr(None, "SELECT name FROM sqlite_master WHERE type='index'") == [('t_a',)]
+        db.csfr(None, "INSERT IGNORE INTO t (a, b) VALUES (%s, %s)", [1, 'x'])
+        db.csfr(None, "INSERT IGNORE INTO t (a, b) VALUES (%s, %s)", [1, 'y'])
+    assert db.csfr(None, "SELECT COUNT(*) FROM t") == [(1,)]
+    assert sorted(db.csfr(None, "SELECT name FROM sqlite_master WHERE type='index'")) == [('t_a',), ('t_b',)]
+
+    # If an index cannot be rebuilt, the others are rebuilt and the settings are still restored
+    db.create_schema("CREATE TABLE u (a INTEGER); CREATE INDEX u_a ON u (a)")
+    with pytest.raises(sqlite3.Error):
+        with db.ingest():
+            db.csfr(None, "DROP TABLE t")
+    assert db.pragma('journal_mode') == 'delete'
+    assert db.pragma('synchronous') == 2
+    assert db.csfr(None, "SELECT name FROM sqlite_master WHERE type='index'") == [('u_a',)]
+
+
+def test_dbmysql_async(monkeypatch):
+    import asyncio
+    import pymysql
+    from ctools import dbfile
+    from ctools.dbfile import DBMySQL, DBMySQLAsync
+    auth = DBMySQLAuth(host='h', database='db', user='u', password='p')
+
+    assert asyncio.run(DBMySQLAsync.csfr(auth, "SELECT %s", [1], dry_run=True)) is None
+    with pytest.raises(ValueError):
+        asyncio.run(DBMySQLAsync.csfr(auth, "SELECT %s", []))
+    monkeypatch.setattr(dbfile, 'aiomysql', None)
+    with pytest.raises(RuntimeError):
+        asyncio.run(DBMySQLAsync.csfr(auth, "SELECT 1"))
+
+    class Cursor:
+        rowcount = 1
+        lastrowid = 7
+        description = [('a',)]
+
+        def __init__(self, conn):
+            self.conn = conn
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def execute(self, cmd, vals=()):
+            if self.conn.errors:
+                raise self.conn.errors.pop(0)
+
+        async def fetchall(self):
+            return [(1,)]
+
+    class Connection:
+        def __init__(self, errors):
+            self.errors = errors
+            self.closed = False
+
+        def get_autocommit(self):
+            return True
+
+        def thread_id(self):
+            return id(self)
+
+        def cursor(self):
+            return Cursor(self)
+
+        def close(self):
+            self.closed = True
+
+        async def autocommit(self, value):
+            pass
+
+        async def commit(self):
+            self.committed = True
+
+    class Pool:
+        def __init__(self, errors, acquire_errors=()):
+            self.errors = errors
+            self.acquire_errors = list(acquire_errors)
+            self.conns = []
+
+        async def acquire(self):
+            if self.acquire_errors:
+                raise self.acquire_errors.pop(0)
+            self.conns.append(Connection(self.errors))
+            return self.conns[-1]
+
+        def release(self, conn):
+            pass
+
+    async def run(errors, *args, acquire_errors=(), **kwargs):
+        pool = Pool(errors, acquire_errors)
+
+        async def get_pool(auth):
+            return pool
+        monkeypatch.setattr(DBMySQLAsync, 'pool', get_pool)
+        return (await DBMySQLAsync.csfr(auth, *args, **kwargs), pool)
+
+    monkeypatch.setattr(dbfile, 'RETRY_DELAY_TIME', 0)
+    monkeypatch.setattr(dbfile, 'ERRORS_NO_RETRY', [2013])
+    (result, pool) = asyncio.run(run([pymysql.OperationalError(2013, 'lost connection'), BlockingIOError()],
+                                     "SELECT a FROM t"))
+    assert result == [(1,)]
+    assert len(pool.conns) == 3 and pool.conns[0].closed and pool.conns[1].closed and not pool.conns[2].closed
+
+    (result, pool) = asyncio.run(run([pymysql.IntegrityError(1062, 'duplicate')], "INSERT INTO t VALUES (1)",
+                                     ignore=[1062]))
+    assert result == DBMySQL.IGNORED
+    with pytest.raises(pymysql.OperationalError):
+        asyncio.run(run([pymysql.OperationalError(1045, 'denied')], "SELECT a FROM t"))
+
+    # A transaction is committed before its connection is closed
+    (result, pool) = asyncio.run(run([], "INSERT INTO t VALUES (1)", autocommit=False))
+    assert result == 7
+    assert pool.conns[0].committed and pool.conns[0].closed
+
+    # Access denied when a connection is opened refreshes the secret and retries
+    with pytest.raises(pymysql.OperationalError):
+        asyncio.run(run([], "SELECT a FROM t", acquire_errors=[pymysql.OperationalError(1045, 'denied')]))
+    monkeypatch.setattr(DBMySQLAuth, 'refresh_secret', lambda self: True)
+    (result, pool) = asyncio.run(run([], "SELECT a FROM t", acquire_errors=[pymysql.OperationalError(1045, 'denied')]))
+    assert result == [(1,)]
+    assert len(pool.conns) == 1
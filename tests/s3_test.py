@@ -8,6 +8,8 @@ import pytest
 import warnings
 import sys
 import os
+import asyncio
+import time
 3  # !/usr/bin/env python3
 # Test S3 code
 
@@ -43,6 +45,25 @@ def s3root():
         return None
 
 
+MOTO_BUCKET = 'ctools-test-bucket'
+
+
+@pytest.fixture
+def moto_bucket(monkeypatch):
+    """A bucket on an in-process mock of S3, so the boto3 code paths can be tested without AWS."""
+    moto = pytest.importorskip('moto')
+    for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_ENDPOINT_URL_S3', raising=False)
+    monkeypatch.setattr(s3, 'USE_AWS_CLI', False)
+    with moto.mock_aws():
+        s3.reset_s3_clients()
+        s3.s3_client().create_bucket(Bucket=MOTO_BUCKET)
+        yield MOTO_BUCKET
+    s3.reset_s3_clients()
+
+
 @pytest.fixture
 def s3_tempfile():
     path = os.path.join(s3root(), f"tmp/tmp.{uuid.uuid4()}")
@@ -123,6 +144,479 @@ def test_s3zipfile_support(s3_tempfile):
     assert hello == b'Hello World!\n'
 
 
+def test_native_object_ops(moto_bucket, tmp_path):
+    src = tmp_path / 'src.txt'
+    src.write_text(TEST_STRING)
+    res = s3.put_object(moto_bucket, 'a/b.txt', str(src))
+    assert 'ETag' in res
+
+    head = s3.head_object(moto_bucket, 'a/b.txt')
+    assert head['ContentLength'] == len(TEST_STRING)
+    assert s3.etag(head) == s3.etag(res)
+
+    dst = tmp_path / 'dst.txt'
+    s3.get_object(moto_bucket, 'a/b.txt', str(dst))
+    assert dst.read_text() == TEST_STRING
+
+    objs = list(s3.list_objects(moto_bucket, 'a/'))
+    assert [obj[s3._Key] for obj in objs] == ['a/b.txt']
+
+    s3.s3rm(f"s3://{moto_bucket}/a/b.txt")
+    assert not s3.s3exists(f"s3://{moto_bucket}/a/b.txt")
+    with pytest.raises(FileNotFoundError):
+        s3.head_object(moto_bucket, 'a/b.txt')
+
+
+def test_s3file_block_cache(moto_bucket):
+    data = os.urandom(100000)
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='blocks', Body=data)
+    f = s3.S3File(f"s3://{moto_bucket}/blocks", block_size=1000, cache_bytes=8000)
+
+    # Sequential reads are served from read-ahead blocks
+    buf = b''
+    while len(buf) < len(data):
+        buf += f.read(300)
+    assert buf == data
+    stats = f.cache_stats()
+    assert stats['requests'] < 100
+    assert stats['cached_blocks'] <= 8
+
+    # Random reads return the right bytes and repeated reads hit the cache
+    for pos in [99990, 5, 50000, 5, 99990, 0]:
+        f.seek(pos)
+        assert f.read(20) == data[pos:pos + 20]
+    assert f.cache_stats()['hits'] > stats['hits']
+    f.seek(-10, 2)
+    assert f.read() == data[-10:]
+
+
+def test_s3file_zipfile(moto_bucket):
+    s3.s3_client().upload_file(TEST_ZIPFILE, moto_bucket, 'testfile.zip')
+    zf = zipfile.ZipFile(s3.S3File(f"s3://{moto_bucket}/testfile.zip", block_size=512))
+    assert zf.open('hello.txt').read() == b'Hello World!\n'
+
+
+def test_parallel_download(moto_bucket, monkeypatch):
+    lines = [f"line {i}\n" for i in range(10000)]
+    data = "".join(lines).encode('utf-8')
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='lines.txt', Body=data)
+    path = f"s3://{moto_bucket}/lines.txt"
+
+    assert b''.join(s3.iter_ranges(moto_bucket, 'lines.txt', part_size=1000, threads=4)) == data
+    with s3.s3open(path, "r", part_size=1000, threads=4) as f:
+        assert list(f) == lines
+    with s3.s3open(path, "rb", part_size=777, threads=3) as f:
+        assert f.read() == data
+
+    # Stopping early cancels the remaining ranges
+    parts = s3.iter_ranges(moto_bucket, 'lines.txt', part_size=100, threads=2)
+    assert next(parts) == data[:100]
+    parts.close()
+
+    # Large S3File reads bypass the block cache
+    monkeypatch.setattr(s3, 'DOWNLOAD_PART_SIZE', 1000)
+    f = s3.S3File(path)
+    f.seek(10)
+    assert f.read(len(data)) == data[10:]
+    assert f.cache_stats()['cached_blocks'] == 0
+
+
+def test_multipart_upload(moto_bucket):
+    path = f"s3://{moto_bucket}/upload.bin"
+    data = os.urandom(s3.MIN_PART_SIZE * 2 + 1000)
+    with s3.s3open(path, "wb", part_size=s3.MIN_PART_SIZE, threads=2) as f:
+        for i in range(0, len(data), 100000):
+            f.write(data[i:i + 100000])
+    head = s3.head_object(moto_bucket, 'upload.bin')
+    assert head['ContentLength'] == len(data)
+    assert s3.etag(head).endswith('-3')      # three parts
+
+    # Small objects use a single PutObject and report their ETag
+    f = s3.s3open(f"s3://{moto_bucket}/small.txt", "w")
+    f.write(TEST_STRING)
+    assert f.close() == s3.head_object(moto_bucket, 'small.txt')['ETag']
+
+    # An exception aborts the upload and leaves nothing behind
+    with pytest.raises(KeyError):
+        with s3.s3open(f"s3://{moto_bucket}/aborted.bin", "wb", part_size=s3.MIN_PART_SIZE) as f:
+            f.write(data)
+            raise KeyError('abort')
+    assert not s3.s3exists(f"s3://{moto_bucket}/aborted.bin")
+    assert 'Uploads' not in s3.s3_client().list_multipart_uploads(Bucket=moto_bucket)
+
+
+def test_multipart_part_limit(moto_bucket, monkeypatch):
+    monkeypatch.setattr(s3, 'PART_GROWTH_PARTS', 2)
+    monkeypatch.setattr(s3, 'MAX_PARTS', 3)
+    data = os.urandom(s3.MIN_PART_SIZE * 4 + 1000)
+
+    # The part size doubles after every PART_GROWTH_PARTS parts, so the object fits in MAX_PARTS parts
+    f = s3.S3MultipartWriter(f"s3://{moto_bucket}/grown.bin", part_size=s3.MIN_PART_SIZE)
+    f.write(data[1001:])
+    assert f.part_size == s3.MIN_PART_SIZE * 2
+    f.close()
+    head = s3.head_object(moto_bucket, 'grown.bin')
+    assert head['ContentLength'] == len(data) - 1001 and s3.etag(head).endswith('-3')
+
+    # Past MAX_PARTS, the write fails before the part is uploaded
+    monkeypatch.setattr(s3, 'PART_GROWTH_PARTS', 100)
+    f = s3.S3MultipartWriter(f"s3://{moto_bucket}/toomany.bin", part_size=s3.MIN_PART_SIZE)
+    with pytest.raises(ValueError):
+        f.write(data)
+    f.abort()
+    f.close()
+    assert not s3.s3exists(f"s3://{moto_bucket}/toomany.bin")
+
+
+def test_readthrough_cache(moto_bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(s3, 'READTHROUGH_CACHE_DIR', str(tmp_path))
+    path = f"s3://{moto_bucket}/cached.txt"
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='cached.txt', Body=TEST_STRING.encode('utf-8'))
+
+    with s3.s3open(path, "r", cache=True) as f:
+        assert f.read() == TEST_STRING
+    with s3.s3open(path, "r", cache=True) as f:
+        assert f.read() == TEST_STRING
+    cache = s3.readthrough_cache()
+    assert (cache.misses, cache.hits) == (1, 1)
+
+    f = s3.S3File(path, cache=True)
+    assert f.read() == TEST_STRING.encode('utf-8')
+    assert f.cache_stats()['requests'] == 0
+    f.close()
+
+    # A new version of the object has a new ETag, so it is fetched again
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='cached.txt', Body=b'changed')
+    with s3.s3open(path, "rb", cache=True) as f:
+        assert f.read() == b'changed'
+    assert cache.misses == 2
+
+    # Least recently used objects are evicted when the cache is full
+    cache.max_bytes = len(b'changed')
+    cache.evict()
+    files = [fname for (dirpath, dirnames, filenames) in os.walk(tmp_path) for fname in filenames]
+    assert len(files) == 1
+
+    # A file evicted by another process before it is opened is fetched again
+    get = cache.get
+    evicted = []
+
+    def get_evicted(*args):
+        path = get(*args)
+        if not evicted:
+            evicted.append(path)
+            os.unlink(path)
+        return path
+    monkeypatch.setattr(cache, 'get', get_evicted)
+    with cache.open(moto_bucket, 'cached.txt') as f:
+        assert f.read() == b'changed'
+    assert cache.misses == 3
+
+    # A fill larger than the cache is not evicted before it is returned
+    cache.max_bytes = 1
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='cached.txt', Body=b'larger')
+    with open(get(moto_bucket, 'cached.txt'), 'rb') as f:
+        assert f.read() == b'larger'
+
+    # Fill files abandoned by a process that died are removed once they are old; fills in progress are not
+    stale = tmp_path / '.fill-stale'
+    fresh = tmp_path / '.fill-fresh'
+    stale.write_bytes(b'x')
+    fresh.write_bytes(b'x')
+    old = time.time() - s3.READTHROUGH_FILL_MAX_AGE - 60
+    os.utime(stale, (old, old))
+    cache.evict()
+    assert not stale.exists() and fresh.exists()
+
+
+def test_async_listing(moto_bucket, monkeypatch):
+    monkeypatch.setattr(s3, 'PAGE_SIZE', 7)      # exercise pagination
+    client = s3.s3_client()
+    keys = [f"top/{a}/{b}/{name}" for a in range(5) for b in range(4) for name in ['data', 'README']]
+    for key in keys:
+        client.put_object(Bucket=moto_bucket, Key=key, Body=b'x')
+
+    async def collect(agen):
+        return [obj async for obj in agen]
+
+    found = asyncio.run(collect(s3.search_objects_async(moto_bucket, 'top/', name='README', concurrency=3)))
+    assert sorted(obj[s3._Key] for obj in found) == sorted(key for key in keys if key.endswith('README'))
+
+    found = asyncio.run(collect(s3.search_objects_async(moto_bucket, 'top/', name=None, limit=7)))
+    assert len(found) == 7
+
+    # An unexpected error while walking a prefix is raised rather than skipping the prefix
+    class FailingClient:
+        def list_objects_v2(self, **kwargs):
+            if kwargs['Prefix'] == 'top/4/':
+                raise RuntimeError("walk failed")
+            return client.list_objects_v2(**kwargs)
+    with monkeypatch.context() as m:
+        m.setattr(s3, 's3_client', FailingClient)
+        with pytest.raises(RuntimeError):
+            asyncio.run(collect(s3.search_objects_async(moto_bucket, 'top/', name='README')))
+
+    listed = asyncio.run(collect(s3.list_objects_async(moto_bucket, 'top/')))
+    assert [obj[s3._Key] for obj in listed] == sorted(keys)
+    listed = asyncio.run(collect(s3.list_objects_async(moto_bucket, 'top/', delimiter='/')))
+    assert [obj[s3._Prefix] for obj in listed] == [f"top/{a}/" for a in range(5)]
+
+
+def test_s3index(moto_bucket, tmp_path, capsys):
+    client = s3.s3_client()
+    for a in range(3):
+        for b in range(2):
+            client.put_object(Bucket=moto_bucket, Key=f"top/{a}/{b}/data", Body=b'x' * (a + 1))
+    index = s3.S3Index(str(tmp_path / 'index.db'), moto_bucket)
+    index.refresh('top/')
+    assert index.levels_listed == 1 + 3 + 6
+    assert [obj[s3._Key] for obj in index.list_objects('top/1/')] == ['top/1/0/data', 'top/1/1/data']
+    assert len(index.search('top/', 'data')) == 6
+    assert dict((path, (files, bytes_)) for (path, files, bytes_) in index.du('top/2/')) == \
+        {'top/2/0': (1, 3), 'top/2/1': (1, 3)}
+
+    # Only stale levels are relisted
+    client.put_object(Bucket=moto_bucket, Key='top/1/1/more', Body=b'yy')
+    s3.s3rm(f"s3://{moto_bucket}/top/2/0/data")
+    index.invalidate('top/1/1/more')
+    index.invalidate('top/2/0/')
+    index.levels_listed = 0
+    index.refresh('top/', max_age=3600)
+    assert index.levels_listed == 2
+    assert [obj[s3._Key] for obj in index.list_objects('top/1/1/')] == ['top/1/1/data', 'top/1/1/more']
+    assert list(index.list_objects('top/2/0/')) == []
+    assert index.search('top/', 'more')[0][s3._Size] == 2
+    s3.print_du(f"s3://{moto_bucket}/top/", index=index)
+    index.close()
+    s3.print_du(f"s3://{moto_bucket}/top/")
+    assert 'top/1/1' in capsys.readouterr().out
+
+
+def test_combine_objects(moto_bucket, monkeypatch):
+    MiB = 1024 * 1024
+    monkeypatch.setattr(s3, 'MAX_COPY_PART_SIZE', 11 * MiB)    # so that part D is split
+    client = s3.s3_client()
+    sizes = [6 * MiB, 100, 200, 12 * MiB, MiB, 5 * MiB + 10, 0, 50]
+    datas = [os.urandom(size) for size in sizes]
+    for (i, data) in enumerate(datas):
+        client.put_object(Bucket=moto_bucket, Key=f"parts/part-{i:05}", Body=data)
+    sobjs = list(s3.list_objects(moto_bucket, 'parts/'))
+    assert s3.any_object_too_small(sobjs)
+
+    etag = s3.combine_objects(moto_bucket, sobjs, 'combined')
+    combined = client.get_object(Bucket=moto_bucket, Key='combined')['Body'].read()
+    assert combined == b''.join(datas)
+    assert etag == s3.head_object(moto_bucket, 'combined')['ETag']
+
+    s3.combine_objects(moto_bucket, sobjs[1:3], 'small')
+    assert client.get_object(Bucket=moto_bucket, Key='small')['Body'].read() == datas[1] + datas[2]
+
+    # Too many parts is refused before the upload is created
+    monkeypatch.setattr(s3, 'MAX_PARTS', 3)
+    with pytest.raises(ValueError):
+        s3.combine_objects(moto_bucket, sobjs, 'too-many')
+    assert client.list_multipart_uploads(Bucket=moto_bucket).get('Uploads', []) == []
+
+
+def test_batch_delete_and_head(moto_bucket, monkeypatch):
+    monkeypatch.setattr(s3, 'DELETE_BATCH_SIZE', 7)
+    client = s3.s3_client()
+    keys = [f"out/part-{i:05}" for i in range(50)]
+    for (i, key) in enumerate(keys):
+        client.put_object(Bucket=moto_bucket, Key=key, Body=b'x' * i)
+
+    heads = s3.head_objects(moto_bucket, keys[0:10] + ['out/missing'], threads=4)
+    assert heads['out/missing'] is None
+    assert [heads[key] for key in keys[0:10]] == list(range(10))
+
+    assert s3.delete_objects(moto_bucket, s3.list_objects(moto_bucket, 'out/'), threads=3) == 50
+    assert list(s3.list_objects(moto_bucket, 'out/')) == []
+
+
+def test_s3_stats(moto_bucket):
+    s3.s3stats.reset()
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='stats', Body=b'x')
+    for i in range(3):
+        s3.head_object(moto_bucket, 'stats')
+    assert not s3.s3exists(f"s3://{moto_bucket}/missing")
+    stats = s3.s3_stats()
+    assert stats['PutObject']['calls'] == 1
+    assert stats['HeadObject']['calls'] == 4
+    assert stats['HeadObject']['errors'] == 1
+    assert stats['HeadObject']['total_time'] >= stats['HeadObject']['max_time'] > 0
+    assert s3.s3_client().meta.config.retries['mode'] == 'adaptive'
+
+    # Resources share the configuration and the hooks
+    assert s3.s3_object(moto_bucket, 'stats').get()['Body'].read() == b'x'
+    assert s3.s3_stats()['GetObject']['calls'] == 1
+    assert s3.s3_resource().meta.client.meta.config.retries['mode'] == 'adaptive'
+
+
+def test_sync(moto_bucket, tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'a.txt').write_text('aaaa')
+    (src / 'sub' / 'b.txt').write_text('bbbbbb')
+    url = f"s3://{moto_bucket}/mirror"
+
+    plan = s3.sync(str(src), url)
+    assert sorted(action.dst for action in plan) == [url + '/a.txt', url + '/sub/b.txt']
+    assert s3.sync_plan(str(src), url) == []
+
+    # Same size, different contents: found by the ETag
+    (src / 'a.txt').write_text('AAAA')
+    plan = s3.sync(str(src), url, dry_run=True)
+    assert [(action.action, action.reason) for action in plan] == [('upload', 'etag')]
+    s3.sync(str(src), url)
+
+    # Download, then nothing to do; deletes only with delete=True
+    dst = tmp_path / 'dst'
+    s3.sync(url, str(dst))
+    assert (dst / 'a.txt').read_text() == 'AAAA'
+    assert (dst / 'sub' / 'b.txt').read_text() == 'bbbbbb'
+    (dst / 'extra').write_text('x')
+    assert s3.sync_plan(url, str(dst)) == []
+    s3.sync(url, str(dst), delete=True)
+    assert not (dst / 'extra').exists()
+
+    # An interrupted download resumes from the partial file
+    (dst / 'sub' / 'b.txt').unlink()
+    tag = s3.etag(s3.head_object(moto_bucket, 'mirror/sub/b.txt'))
+    (dst / 'sub' / f"b.txt.{tag}{s3.PARTIAL_SUFFIX}").write_text('bbb')
+    s3.sync(url, str(dst))
+    assert (dst / 'sub' / 'b.txt').read_text() == 'bbbbbb'
+    assert os.listdir(dst / 'sub') == ['b.txt']
+
+    # Partial files of an earlier version of an object are removed
+    (dst / f"a.txt.0123{s3.PARTIAL_SUFFIX}").write_text('old')
+    s3.sync(url, str(dst))
+    assert sorted(os.listdir(dst)) == ['a.txt', 'sub']
+
+    # Without checksums, files that have not changed since they were uploaded are not uploaded again
+    assert s3.sync_plan(str(src), url, checksum=False) == []
+    (src / 'a.txt').write_text('ZZZZ')
+    os.utime(src / 'a.txt', (time.time() + 10, time.time() + 10))
+    assert [(a.action, a.reason) for a in s3.sync_plan(str(src), url, checksum=False)] == [('upload', 'mtime')]
+
+    # Extra objects are deleted in a batch
+    (src / 'sub' / 'b.txt').unlink()
+    plan = s3.sync(str(src), url, delete=True)
+    assert sorted((a.action, a.dst) for a in plan) == [('delete', url + '/sub/b.txt'), ('upload', url + '/a.txt')]
+    assert [obj['Key'] for obj in s3.list_objects(moto_bucket, 'mirror/')] == ['mirror/a.txt']
+
+
+def test_multipart_etag(moto_bucket, tmp_path):
+    fname = tmp_path / 'big'
+    fname.write_bytes(os.urandom(s3.MIN_PART_SIZE * 2 + 5))
+    with open(fname, 'rb') as f, s3.s3open(f"s3://{moto_bucket}/big", "wb", part_size=s3.MIN_PART_SIZE) as out:
+        out.write(f.read())
+    remote = s3.head_object(moto_bucket, 'big')['ETag']
+    assert remote.endswith('-3"')
+    assert s3.etag_matches(str(fname), remote)
+    assert not s3.etag_matches(str(fname), s3.local_etag(str(fname), s3.MIN_PART_SIZE + 1))
+
+
+def test_list_objects_sharded(moto_bucket, monkeypatch):
+    monkeypatch.setattr(s3, 'PAGE_SIZE', 7)
+    client = s3.s3_client()
+    keys = [f"flat/part-{i:05}" for i in range(0, 200, 3)] + ['flat/part-', 'flat/a', 'flat/zz', 'flat/~']
+    for key in keys:
+        client.put_object(Bucket=moto_bucket, Key=key, Body=b'')
+    client.put_object(Bucket=moto_bucket, Key='other', Body=b'')
+
+    listed = [obj[s3._Key] for obj in s3.list_objects_sharded(moto_bucket, 'flat/', shards=4)]
+    assert listed == sorted(keys)
+    assert [obj[s3._Key] for obj in s3.list_objects_sharded(f"s3://{moto_bucket}/flat/part-", shards=8)] == \
+        sorted(key for key in keys if key.startswith('flat/part-'))
+    assert len(list(s3.list_objects_sharded(moto_bucket, 'flat/', shards=4, limit=10))) == 10
+    assert list(s3.list_objects_sharded(moto_bucket, 'nothing/')) == []
+
+    # An unexpected error in a lister is raised rather than skipping its range
+    client = s3.s3_client()
+
+    class FailingClient:
+        def list_objects_v2(self, **kwargs):
+            if kwargs.get('StartAfter'):
+                raise RuntimeError("lister failed")
+            return client.list_objects_v2(**kwargs)
+    monkeypatch.setattr(s3, 's3_client', FailingClient)
+    with pytest.raises(RuntimeError):
+        list(s3.list_objects_sharded(moto_bucket, 'flat/', shards=4))
+
+
+def test_schema_select_records(moto_bucket, monkeypatch):
+    import botocore.exceptions
+    from ctools.schema.schema import Schema
+    from ctools.schema.table import Table
+    from ctools.schema.variable import Variable
+    sch = Schema()
+    t = Table(name="people", delimiter='|')
+    t.add_variable(Variable(name="name", vtype='VARCHAR(10)', position=0))
+    t.add_variable(Variable(name="age", vtype='INTEGER(2)', position=1))
+    sch.add_table(t)
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='people.txt', Body=b'jack|25\nmary|17\nsue|40\n')
+
+    records = list(sch.select_records(filename=f"s3://{moto_bucket}/people.txt", tablename='people',
+                                      columns=['name'], where=[('age', '>', 18)], s3select=False))
+    assert records == [{'name': 'jack'}, {'name': 'sue'}]
+
+    # moto's S3 Select only understands SELECT *, so push down the whole table
+    monkeypatch.setattr(Table, 's3select_expression', lambda self, *args, **kwargs: "SELECT * FROM S3Object")
+    s3.s3stats.reset()
+    records = list(sch.select_records(filename=f"s3://{moto_bucket}/people.txt", tablename='people', limit=2))
+    assert records == [{'name': 'jack', 'age': 25}, {'name': 'mary', 'age': 17}]
+    assert s3.s3_stats()['SelectObjectContent']['calls'] == 1 and 'GetObject' not in s3.s3_stats()
+
+    # If S3 Select is not available the file is read and filtered locally; other errors are raised
+    def unavailable(code):
+        def select(*args, **kwargs):
+            raise botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, 'SelectObjectContent')
+        return select
+    monkeypatch.setattr(s3, 's3select', unavailable('NotImplemented'))
+    records = list(sch.select_records(filename=f"s3://{moto_bucket}/people.txt", tablename='people',
+                                      columns=['name'], where=[('age', '>', 18)]))
+    assert records == [{'name': 'jack'}, {'name': 'sue'}]
+    monkeypatch.setattr(s3, 's3select', unavailable('AccessDenied'))
+    with pytest.raises(botocore.exceptions.ClientError):
+        list(sch.select_records(filename=f"s3://{moto_bucket}/people.txt", tablename='people'))
+
+
+def test_line_splits(moto_bucket):
+    lines = [f"{i}|name{i}|{'x' * (i % 17)}\n" for i in range(1000)]
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='big.txt', Body=''.join(lines).encode('utf-8'))
+    path = f"s3://{moto_bucket}/big.txt"
+
+    ranges = s3.line_splits(path, 7)
+    assert len(ranges) == 7
+    assert ranges[0][0] == 0
+    assert all(a[1] == b[0] for (a, b) in zip(ranges, ranges[1:]))
+    got = []
+    for (start, end) in ranges:
+        got.extend(s3.iter_split_lines(path, start, end, chunk_size=100))
+    assert got == lines
+
+    # More splits than lines still returns every line once
+    assert len(s3.line_splits(path, 5000)) == 1000
+
+    # A size cap raises the number of ranges for a large object
+    ranges = s3.line_splits(path, 2, max_split_bytes=1000)
+    assert len(ranges) > 2
+    assert all(end - start < 1100 for (start, end) in ranges)
+
+
+def test_parse_s3_rows(moto_bucket):
+    from ctools.schema.table import Table
+    from ctools.schema.variable import Variable
+    t = Table(name="people", delimiter='|')
+    t.add_variable(Variable(name="id", vtype='INTEGER(4)', position=0))
+    t.add_variable(Variable(name="name", vtype='VARCHAR(10)', position=1))
+    body = ''.join(f"{i}|name{i}\n" for i in range(500))
+    s3.s3_client().put_object(Bucket=moto_bucket, Key='people.txt', Body=body.encode('utf-8'))
+
+    rows = list(t.parse_s3_rows(f"s3://{moto_bucket}/people.txt", splits=5, processes=2))
+    assert rows == [[i, f"name{i}"] for i in range(500)]
+
+
 if __name__ == "__main__":
     test_s3open()
     test_s3open_write_fsync()
@@ -1,4 +1,4 @@
-from ctools.s3 import S3File
+from ctools.s3 import S3File, BLOCK_SIZE, CACHE_BYTES
 import zipfile
 from urllib.parse import urlparse
 from subprocess import run, Popen, PIPE
@@ -19,12 +19,14 @@ if __name__ == "__main__":
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument("zipfile", help="zipfile to list")
+    parser.add_argument("--block_size", type=int, default=BLOCK_SIZE, help="S3File cache block size")
+    parser.add_argument("--cache_bytes", type=int, default=CACHE_BYTES, help="S3File cache memory cap")
     args = parser.parse_args()
 
     if not args.zipfile.startswith("s3://"):
         print("Please specify a zipfile that is on Amazon S3")
         exit(1)
-    s3 = S3File(args.zipfile)
+    s3 = S3File(args.zipfile, block_size=args.block_size, cache_bytes=args.cache_bytes)
     zf = zipfile.ZipFile(s3, mode='r', allowZip64=True)
     print("Files in {}:".format(args.zipfile))
     first = None
@@ -35,3 +37,4 @@ if __name__ == "__main__":
     print("\n")
     print("Contents of {}:".format(first))
     print(zf.open(name).read().decode('utf-8'))
+    print("S3File cache:", s3.cache_stats())